@@ -22,11 +22,13 @@
 # i.e. shorter BLs are averaged more, and write a new MS
 
 import os, sys
-import optparse, itertools
+import optparse
 import logging
+import multiprocessing
 import numpy as np
 from scipy.ndimage.filters import gaussian_filter1d as gfilter
 import pyrap.tables as pt
+from lib_multiproc import multiprocManager
 logging.basicConfig(level=logging.DEBUG)
 
 def addcol(ms, incol, outcol):
@@ -40,6 +42,90 @@ def addcol(ms, incol, outcol):
         logging.info('Set '+outcol+'='+incol)
         pt.taql("update $ms set "+outcol+"="+incol)
 
+def baseline_index(ant1, ant2, time):
+    """
+    Sort the rows by baseline and then by time
+    Return the sorting index and, in the sorted order, the first and last+1 row of each baseline
+    """
+    order = np.lexsort((time, ant2, ant1))
+    ant1 = ant1[order]
+    ant2 = ant2[order]
+    edges = np.flatnonzero((ant1[1:] != ant1[:-1]) | (ant2[1:] != ant2[:-1])) + 1
+    starts = np.concatenate(([0], edges))
+    ends = np.concatenate((edges, [len(order)]))
+    return order, starts, ends
+
+def smooth_baselines(all_data, all_weights, starts, ends, stddevs, onlyamp=False):
+    """
+    Smooth in time data and weights of each baseline, in place
+    all_data, all_weights: arrays with rows sorted by baseline (see baseline_index)
+    starts, ends: first and last+1 row of each baseline
+    stddevs: sigma (in samples) for each baseline, 0 to leave the baseline untouched
+    """
+    for start, end, stddev in zip(starts, ends, stddevs):
+
+        if stddev == 0: continue # fix for missing anstennas
+
+        #Multiply every element of the data by the weights, convolve both the scaled data and the weights, and then
+        #divide the convolved data by the convolved weights (translating flagged data into weight=0). That's basically the equivalent of a
+        #running weighted average with a Gaussian window function.
+
+        # get cycle values
+        weights = all_weights[start:end]
+        data = all_data[start:end]
+
+        # set bad data to 0 so nans do not propagate
+        data = np.nan_to_num(data*weights)
+
+        # smear weighted data and weights
+        if onlyamp:
+            dataAMP = gfilter(np.abs(data), stddev, axis=0)
+            dataPH = np.angle(data)
+        else:
+            dataR = gfilter(np.real(data), stddev, axis=0)#, truncate=4.)
+            dataI = gfilter(np.imag(data), stddev, axis=0)#, truncate=4.)
+
+        weights = gfilter(weights, stddev, axis=0)#, truncate=4.)
+
+        # re-create data
+        if onlyamp:
+            data = dataAMP * ( np.cos(dataPH) + 1j*np.sin(dataPH) )
+        else:
+            data = (dataR + 1j * dataI)
+        data[(weights != 0)] /= weights[(weights != 0)] # avoid divbyzero
+        all_data[start:end] = data
+        all_weights[start:end] = weights
+
+def shared_empty(shape, dtype):
+    """
+    Return an empty array in shared memory, processes forked afterwards write in the same memory
+    """
+    dtype = np.dtype(dtype)
+    buf = multiprocessing.RawArray('b', max(1, int(np.prod(shape))*dtype.itemsize))
+    return np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def smooth_baselines_parallel(all_data, all_weights, starts, ends, stddevs, onlyamp=False, ncpu=1):
+    """
+    Same as smooth_baselines() but spreading the baselines over ncpu processes
+    all_data, all_weights: must be in shared memory (see shared_empty)
+    """
+    def smooth_block(first_bl, last_bl, outQueue=None):
+        smooth_baselines(all_data, all_weights, starts[first_bl:last_bl], ends[first_bl:last_bl], stddevs[first_bl:last_bl], onlyamp)
+        outQueue.put(last_bl-first_bl)
+
+    # blocks of consecutive baselines with similar cost (rows x kernel length),
+    # a few blocks per process to balance the load
+    cost = np.cumsum((ends-starts)*(1.+stddevs)*(stddevs != 0))
+    nblocks = min(4*ncpu, len(starts))
+    edges = np.searchsorted(cost, cost[-1]*np.arange(1, nblocks)/nblocks)
+    edges = np.unique(np.concatenate(([0], edges, [len(starts)])))
+
+    mpm = multiprocManager(ncpu, smooth_block)
+    for first_bl, last_bl in zip(edges[:-1], edges[1:]):
+        mpm.put([first_bl, last_bl])
+    mpm.wait()
+    for r in mpm.get(): pass
+
 opt = optparse.OptionParser(usage="%prog [options] MS", version="%prog 0.1")
 opt.add_option('-f', '--ionfactor', help='Gives an indication on how strong is the ionosphere [default: 0.2]', type='float', default=0.2)
 opt.add_option('-s', '--bscalefactor', help='Gives an indication on how the smoothing varies with BL-lenght [default: 0.5]', type='float', default=0.5)
@@ -49,6 +135,8 @@ opt.add_option('-w', '--weight', help='Save the newly computed WEIGHT_SPECTRUM,
 opt.add_option('-r', '--restore', help='If WEIGHT_SPECTRUM_ORIG exists then restore it before smoothing [default: False]', action="store_true", default=False)
 opt.add_option('-b', '--nobackup', help='Do not backup the old WEIGHT_SPECTRUM in WEIGHT_SPECTRUM_ORIG [default: do backup if -w]', action="store_true", default=False)
 opt.add_option('-a', '--onlyamp', help='Smooth only amplitudes [default: smooth real/imag]', action="store_true", default=False)
+opt.add_option('-n', '--ncpu', help='Number of processes used to smooth the baselines [default: 1]', type='int', default=1)
+opt.add_option('-m', '--maxmem', help='Memory ceiling in GB, the MS is processed in chunks of channels (and baselines) to stay below it [default: no limit]', type='float', default=None)
 (options, msfile) = opt.parse_args()
 
 if msfile == []:
@@ -71,7 +159,7 @@ timepersample = ms.getcell('INTERVAL',0)
 all_time = ms.getcol('TIME_CENTROID')
 
 # check if ms is time-ordered
-if not all(all_time[i] <= all_time[i+1] for i in xrange(len(all_time)-1)):
+if not np.all(all_time[:-1] <= all_time[1:]):
     logging.critical('This code cannot handle MS that are not time-sorted.')
     sys.exit(1)
 
@@ -88,92 +176,113 @@ elif options.weight and not options.nobackup:
 ant1 = ms.getcol('ANTENNA1')
 ant2 = ms.getcol('ANTENNA2')
 
-all_uvw = ms.getcol('UVW')
-# iteration on baseline combination
-# do for loop twice to remove all_uvw and save memory
-stddevs = np.zeros( len(set(ant1)) * len(set(ant2)) )
-for i, ant in enumerate(itertools.product(set(ant1), set(ant2))):
+# index rows by baseline, each baseline is then a contiguous block of time-sorted rows
+order, starts, ends = baseline_index(ant1, ant2, all_time)
 
+nchans = len(pt.table(msfile+"/SPECTRAL_WINDOW",ack=False)[0]["CHAN_FREQ"])
+nrows = ms.nrows()
+
+# chunk sizes to stay below the memory ceiling, each visibility takes ~32 bytes
+# (data, weights and flags and the baseline-sorted copies)
+if options.maxmem == None:
+    chan_chunk = nchans
+    row_chunk = nrows
+else:
+    vis_chunk = max(1, int(options.maxmem*1024**3/32))
+    chan_chunk = max(1, min(nchans, vis_chunk//nrows))
+    row_chunk = max(1, vis_chunk//chan_chunk)
+    logging.info('Memory ceiling %.2f GB: chunks of %i channels and %i rows.' % (options.maxmem, chan_chunk, row_chunk))
+
+all_uvw_dist = np.empty(nrows)
+for row in range(0, nrows, row_chunk):
+    all_uvw = ms.getcol('UVW', row, row_chunk)
+    all_uvw_dist[row:row+row_chunk] = np.sqrt(all_uvw[:, 0]**2 + all_uvw[:, 1]**2 + all_uvw[:, 2]**2)
+    del all_uvw
+all_uvw_dist = all_uvw_dist[order]
+stddevs = np.zeros( len(starts) )
+for i, (start, end) in enumerate(zip(starts, ends)):
+
+    ant = (ant1[order[start]], ant2[order[start]])
     if ant[0] >= ant[1]: continue
-    sel = (ant1 == ant[0]) & (ant2 == ant[1])
 
     # compute the FWHM
-    uvw = all_uvw[sel,:]
-    uvw_dist = np.sqrt(uvw[:, 0]**2 + uvw[:, 1]**2 + uvw[:, 2]**2)
-    dist = np.mean(uvw_dist) / 1.e3
+    dist = np.mean(all_uvw_dist[start:end]) / 1.e3
     if np.isnan(dist): continue # fix for missing anstennas
-    
+
     stddev = options.ionfactor * (25.e3 / dist)**options.bscalefactor * (freq / 60.e6) # in sec
     stddev = stddev/timepersample # in samples
     logging.debug("For BL %i - %i (dist = %.1f km): sigma=%.2f samples." % (ant[0], ant[1], dist, stddev))
     stddevs[i] = stddev
 
-del all_uvw
+del all_uvw_dist
+
+# group consecutive baselines in chunks of at most row_chunk rows (a baseline is never split)
+groups = []
+first_bl = 0
+group_rows = 0
+for i, (start, end) in enumerate(zip(starts, ends)):
+    if group_rows > 0 and group_rows + end-start > row_chunk:
+        groups.append((first_bl, i))
+        first_bl = i
+        group_rows = 0
+    group_rows += end-start
+    if end-start > row_chunk:
+        logging.warning('Baseline %i - %i is larger than the memory ceiling.' % (ant1[order[start]], ant2[order[start]]))
+groups.append((first_bl, len(starts)))
 
-nchans = len(pt.table(msfile+"/SPECTRAL_WINDOW",ack=False)[0]["CHAN_FREQ"])
 pols = [0,1,2,3] # full-pol smoothing
-for pol in pols:
-    logging.debug("Workign on pol %i" % pol)
-    all_data = ms.getcolslice(options.outcol, [0,pol], [nchans-1,pol])
-    all_weights = ms.getcolslice('WEIGHT_SPECTRUM', [0,pol], [nchans-1,pol])
-    all_flags = ms.getcolslice('FLAG', [0,pol], [nchans-1,pol])
-
-    all_flags[ np.isnan(all_data) ] = True # flag NaNs
-    all_weights[all_flags] = 0 # set weight of flagged data to 0
-    del all_flags
-    
-    # iteration on baseline combination
-    logging.info('Smoothing baselines')
-    for i, ant in enumerate(itertools.product(set(ant1), set(ant2))):
-    
-        if ant[0] >= ant[1]: continue
-        if stddevs[i] == 0: continue # fix for missing anstennas
-    
-        sel = (ant1 == ant[0]) & (ant2 == ant[1])
-    
-        #Multiply every element of the data by the weights, convolve both the scaled data and the weights, and then
-        #divide the convolved data by the convolved weights (translating flagged data into weight=0). That's basically the equivalent of a
-        #running weighted average with a Gaussian window function.
-    
-        # get cycle values
-        weights = all_weights[sel]
-        data = all_data[sel]
-    
-        # set bad data to 0 so nans do not propagate
-        data = np.nan_to_num(data*weights)
-    
-        # smear weighted data and weights
-        if options.onlyamp:
-            dataAMP = gfilter(np.abs(data), stddevs[i], axis=0)
-            dataPH = np.angle(data)
-        else:
-            dataR = gfilter(np.real(data), stddevs[i], axis=0)#, truncate=4.)
-            dataI = gfilter(np.imag(data), stddevs[i], axis=0)#, truncate=4.)
+for first_bl, last_bl in groups:
 
-        weights = gfilter(weights, stddevs[i], axis=0)#, truncate=4.)
-    
-        # re-create data
-        if options.onlyamp:
-            data = dataAMP * ( np.cos(dataPH) + 1j*np.sin(dataPH) )
-        else:
-            data = (dataR + 1j * dataI)
-        data[(weights != 0)] /= weights[(weights != 0)] # avoid divbyzero
-        all_data[sel] = data
-        all_weights[sel] = weights
-    
-        #print np.count_nonzero(data[~flags]), np.count_nonzero(data[flags]), 100*np.count_nonzero(data[flags])/np.count_nonzero(data)
-        #print "NANs in flagged data: ", np.count_nonzero(np.isnan(data[flags]))
-        #print "NANs in unflagged data: ", np.count_nonzero(np.isnan(data[~flags]))
-        #print "NANs in weights: ", np.count_nonzero(np.isnan(weights))
-    
-    logging.warning('Writing %s column.' % options.outcol)
-    ms.putcolslice(options.outcol, all_data, [0,pol], [nchans-1,pol])
-    del all_data
-
-    if options.weight:
-        logging.warning('Writing WEIGHT_SPECTRUM column.')
-        ms.putcol('WEIGHT_SPECTRUM', all_weights, [0,pol], [nchans-1,pol])
-        del all_weights
+    if len(groups) == 1:
+        t = ms
+        t_order, t_starts, t_ends = order, starts, ends
+    else:
+        logging.debug("Working on baselines %i to %i" % (first_bl, last_bl-1))
+        rows = np.sort(order[starts[first_bl]:ends[last_bl-1]])
+        t = ms.selectrows(rows)
+        t_order, t_starts, t_ends = baseline_index(ant1[rows], ant2[rows], all_time[rows])
+        del rows
+    t_stddevs = stddevs[first_bl:last_bl]
+
+    for pol in pols:
+        logging.debug("Workign on pol %i" % pol)
+        for chan in range(0, nchans, chan_chunk):
+            blc = [chan, pol]
+            trc = [min(chan+chan_chunk, nchans)-1, pol]
+            all_data = t.getcolslice(options.outcol, blc, trc)
+            all_weights = t.getcolslice('WEIGHT_SPECTRUM', blc, trc)
+            all_flags = t.getcolslice('FLAG', blc, trc)
+
+            all_flags[ np.isnan(all_data) ] = True # flag NaNs
+            all_weights[all_flags] = 0 # set weight of flagged data to 0
+            del all_flags
+
+            # iteration on baselines, sorted by baseline
+            logging.info('Smoothing baselines')
+            if options.ncpu > 1:
+                all_data_bl = shared_empty(all_data.shape, all_data.dtype)
+                all_weights_bl = shared_empty(all_weights.shape, all_weights.dtype)
+                np.take(all_data, t_order, axis=0, out=all_data_bl)
+                np.take(all_weights, t_order, axis=0, out=all_weights_bl)
+                smooth_baselines_parallel(all_data_bl, all_weights_bl, t_starts, t_ends, t_stddevs, options.onlyamp, options.ncpu)
+            else:
+                all_data_bl = all_data[t_order]
+                all_weights_bl = all_weights[t_order]
+                smooth_baselines(all_data_bl, all_weights_bl, t_starts, t_ends, t_stddevs, options.onlyamp)
+            all_data[t_order] = all_data_bl
+            all_weights[t_order] = all_weights_bl
+            del all_data_bl, all_weights_bl
+
+            logging.warning('Writing %s column.' % options.outcol)
+            t.putcolslice(options.outcol, all_data, blc, trc)
+            del all_data
+
+            if options.weight:
+                logging.warning('Writing WEIGHT_SPECTRUM column.')
+                t.putcolslice('WEIGHT_SPECTRUM', all_weights, blc, trc)
+            del all_weights
+
+    if t is not ms: t.close()
 
 ms.close()
 logging.info("Done.")
@@ -1,12 +1,78 @@
 #!/usr/bin/python
 # apply tec in one direction
 
-import os, sys, optparse
+import os, sys, optparse, hashlib, socket
 from numpy import sin, cos
 import tables
 import casacore.tables as pt
 import numpy as np
 
+def file_key(filename):
+    """
+    Return a string identifying a version of a file: path, size and modification time
+    """
+    st = os.stat(filename)
+    return '%s:%i:%r' % (os.path.abspath(filename), st.st_size, st.st_mtime)
+
+def get_solutions(h5file, dirname, ms_times, cachedir=''):
+    """
+    Return TEC, scalarphase and a mask of missing solutions on the MS time grid, arrays are (time, ant)
+    h5file: H5parm with tec000 and scalarphase000
+    dirname: direction name
+    ms_times: sorted unique times of the MS, each must have a solution
+    cachedir: if set, the results are stored/loaded there, keyed on the H5parm path/size/mtime, the direction and ms_times
+    """
+    if cachedir != '':
+        key = hashlib.sha1((file_key(h5file)+dirname).encode()+ms_times.tobytes()).hexdigest()
+        cachefile = os.path.join(cachedir, key+'.npz')
+        if os.path.exists(cachefile):
+            print "Using cached solutions: %s" % cachefile
+            with np.load(cachefile) as cache:
+                return cache['tec'], cache['csp'], cache['bad']
+
+    h5 = tables.open_file(h5file)
+    soltab_tec = h5.root.sol000.tec000
+    soltab_csp = h5.root.sol000.scalarphase000
+    directions = h5.root.sol000.source
+    direction = np.argwhere(directions[:]['name'] == dirname)[0][0]
+
+    print "Applying dir %s" % h5.root.sol000.tec000.dir[direction]
+    #print "CSP HAVE A MINUS TO COMPENSATE NDPPP BUG"
+
+    sols_tec = np.squeeze(soltab_tec.val) # remove freq axis with squeeze
+    wgts_tec = np.squeeze(soltab_tec.weight)
+    sols_csp = np.squeeze(soltab_csp.val)
+    wgts_csp = np.squeeze(soltab_csp.weight)
+    times = soltab_tec.time[:]
+    h5.close()
+
+    # solution timestep of each MS time
+    timestep = np.searchsorted(times, ms_times)
+    assert (times[np.minimum(timestep, len(times)-1)] == ms_times).all()
+
+    # antennas with no valid solution
+    nant = sols_tec.shape[0]
+    bad = ((wgts_tec[:,direction] == 0).reshape(nant, len(times), -1).all(axis=2)) | \
+          ((wgts_csp[:,direction] == 0).reshape(nant, len(times), -1).all(axis=2))
+
+    tec = sols_tec[:,direction][:,timestep].T
+    csp = sols_csp[:,direction][:,timestep].T
+    bad = bad[:,timestep].T
+
+    if cachedir != '':
+        # other subbands (also on other nodes) may be creating/reading the cache at the same time
+        try:
+            os.makedirs(cachedir)
+        except OSError:
+            if not os.path.isdir(cachedir): raise
+        # write and rename, the temporary name is unique across the nodes sharing cachedir
+        tmpfile = cachefile+'.'+socket.gethostname()+'.'+str(os.getpid())
+        with open(tmpfile, 'wb') as f:
+            np.savez(f, tec=tec, csp=csp, bad=bad)
+        os.rename(tmpfile, cachefile)
+
+    return tec, csp, bad
+
 opt = optparse.OptionParser()
 opt.add_option('-i','--inms',help='Input MS',default='')
 opt.add_option('--incol',help='Input column',default='DATA')
@@ -14,57 +80,46 @@ opt.add_option('--outcol',help='Output column',default='CORRECTED_DATA')
 opt.add_option('--inh5',help='Input H5parm',default='')
 opt.add_option('-d','--dir',help='Direction (string)',default=None)
 opt.add_option('-c','--corrupt',action="store_true",default=False,help='Corrupt')
+opt.add_option('--chunk',help='Number of rows read and corrected at once',type='int',default=100000)
+opt.add_option('--cachedir',help='Directory where to cache the solutions on the MS time grid, reused by other runs/subbands [default: no cache]',default='')
 o, args = opt.parse_args()
 
 t = pt.table(o.inms, readonly=False)
-h5 = tables.open_file(o.inh5)
-soltab_tec = h5.root.sol000.tec000
-soltab_csp = h5.root.sol000.scalarphase000
-directions = h5.root.sol000.source
-direction = np.argwhere(directions[:]['name'] == o.dir)[0][0]
 
-print "Applying dir %s" % h5.root.sol000.tec000.dir[direction]
-#print "CSP HAVE A MINUS TO COMPENSATE NDPPP BUG"
+ms_times = np.unique(t.getcol("TIME"))
+sols_tec, sols_csp, bad = get_solutions(o.inh5, o.dir, ms_times, o.cachedir)
+freqs = pt.table(o.inms+"/SPECTRAL_WINDOW",ack=False)[0]["CHAN_FREQ"]
+
+for row in xrange(0, t.nrows(), o.chunk):
+    print "Rows %i-%i of %i" % (row, min(row+o.chunk, t.nrows()), t.nrows())
 
-sols_tec = np.squeeze(soltab_tec.val) # remove freq axis with squeeze
-wgts_tec = np.squeeze(soltab_tec.weight)
-sols_csp = np.squeeze(soltab_csp.val)
-wgts_csp = np.squeeze(soltab_csp.weight)
+    # timestep of each row
+    timestep = np.searchsorted(ms_times, t.getcol("TIME", row, o.chunk))
 
-times = soltab_tec.time
-freqs = pt.table(o.inms+"/SPECTRAL_WINDOW",ack=False)[0]["CHAN_FREQ"]
+    ant1 = t.getcol("ANTENNA1", row, o.chunk)
+    ant2 = t.getcol("ANTENNA2", row, o.chunk)
+    data = t.getcol(o.incol, row, o.chunk)
+    flag = t.getcol("FLAG", row, o.chunk)
+
+    # flag baselines with an antenna without solutions
+    flagged = bad[timestep,ant1] | bad[timestep,ant2]
+    flag[flagged,:,:] = True
+    if flagged.any(): print "skip flagged %i rows" % flagged.sum()
+
+    # per-antenna, per-channel gains for the timesteps in this chunk (time, ant, chan)
+    steps, step_idx = np.unique(timestep, return_inverse=True)
+    g = sols_csp[steps][:,:,np.newaxis] - sols_tec[steps][:,:,np.newaxis] * 8.44797245e9 / freqs
+    g = cos(g) + 1j*sin(g)
+
+    good = ~flagged
+    g1 = g[step_idx[good], ant1[good]]
+    g2 = g[step_idx[good], ant2[good]]
+    if o.corrupt:
+        data[good] *= ( g1 * np.conj(g2) )[:,:,np.newaxis]
+    else:
+        data[good] /= ( g1 * np.conj(g2) )[:,:,np.newaxis]
+
+    t.putcol(o.outcol, data, row, o.chunk)
+    t.putcol("FLAG", flag, row, o.chunk)
 
-for timestep, buf in enumerate(t.iter("TIME")):
-    if timestep % 10 == 0: print "Timestep", timestep
-
-    assert buf.getcell("TIME",0) == times[timestep]
-
-    data = buf.getcol(o.incol)
-    flag = buf.getcol("FLAG")
-
-    for rownr, row in enumerate(buf):
-        ant1 = row["ANTENNA1"]
-        ant2 = row["ANTENNA2"]
-        if (wgts_tec[ant1,direction,timestep] == 0).all() or (wgts_tec[ant2,direction,timestep] == 0).all() \
-                or (wgts_csp[ant1,direction,timestep] == 0).all() or (wgts_csp[ant2,direction,timestep] == 0).all():
-            flag[rownr,:,:] = True
-            print "skip flagged ",
-            continue
-
-        g1 = sols_csp[ant1,direction,timestep] - sols_tec[ant1,direction,timestep] * 8.44797245e9 / freqs
-        #g1 = -1. * sols_tec[ant1,direction,timestep] * 8.44797245e9 / freqs
-        g1 = cos(g1) + 1j*sin(g1)
-        g2 = sols_csp[ant2,direction,timestep] - sols_tec[ant2,direction,timestep] * 8.44797245e9 / freqs
-        #g2 = -1. * sols_tec[ant2,direction,timestep] * 8.44797245e9 / freqs
-        g2 = cos(g2) + 1j*sin(g2)
-        for pol in range(4):
-            if o.corrupt:
-                data[rownr,:,pol] *= ( g1 * np.conj(g2) )
-            else:
-                data[rownr,:,pol] /= ( g1 * np.conj(g2) )
-
-    buf.putcol(o.outcol, data)
-    buf.putcol("FLAG", flag) 
-
-h5.close()
 t.close()
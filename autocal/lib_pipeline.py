@@ -1,4 +1,4 @@
-import os, sys, re, pickle, random, shutil
+import os, sys, re, pickle, random, shutil, time, json, hashlib
 import numpy as np
 import matplotlib as mpl
 mpl.use("Agg")
@@ -20,7 +20,62 @@ def check_rm(regexp):
             os.system('rm -r '+f)
 
 
-def run_losoto(s, c, mss, parsets, outtab='', inglobaldb='globaldb', outglobaldb='globaldb', ininstrument='instrument', outinstrument='instrument', putback=False):
+def copy_tables(pairs, link=False, ncpu=8):
+    """
+    Copy in parallel the directories (e.g. tables) src -> dst, for each (src, dst) in pairs
+    link : hardlink the files instead of copying them (falls back to a copy where links are
+    not possible, e.g. across filesystems), only for tables that are not modified in place afterwards
+    ncpu : number of parallel copies
+    Each copy is checked to have the same files with the same sizes of its source.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    def tree(top):
+        files = []
+        for root, dirs, fs in os.walk(top):
+            for f in fs+[d for d in dirs if os.path.islink(os.path.join(root, d))]:
+                path = os.path.join(root, f)
+                files.append((os.path.relpath(path, top), os.lstat(path).st_size))
+        return sorted(files)
+
+    def hardlink(src, dst):
+        os.makedirs(dst)
+        for root, dirs, fs in os.walk(src):
+            outroot = os.path.join(dst, os.path.relpath(root, src))
+            for d in dirs:
+                if os.path.islink(os.path.join(root, d)): os.symlink(os.readlink(os.path.join(root, d)), os.path.join(outroot, d))
+                else: os.mkdir(os.path.join(outroot, d))
+            for f in fs:
+                if os.path.islink(os.path.join(root, f)): os.symlink(os.readlink(os.path.join(root, f)), os.path.join(outroot, f))
+                else: os.link(os.path.join(root, f), os.path.join(outroot, f))
+
+    def copy(pair):
+        src, dst = pair
+        if not os.path.exists(src):
+            logger.warning('Cannot copy %s: not found.' % src)
+            return
+        if os.path.lexists(dst): shutil.rmtree(dst)
+        if link:
+            try:
+                hardlink(src, dst)
+                if tree(src) == tree(dst): return
+                logger.warning('Linked %s differs from %s, copying.' % (dst, src))
+            except OSError as e:
+                logger.debug('Cannot link %s (%s), copying.' % (src, e))
+            shutil.rmtree(dst, ignore_errors=True)
+        shutil.copytree(src, dst, symlinks=True)
+        if tree(src) != tree(dst):
+            raise Exception('Copy of %s to %s failed.' % (src, dst))
+
+    pool = ThreadPool(ncpu)
+    try:
+        pool.map(copy, pairs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_losoto(s, c, mss, parsets, outtab='', inglobaldb='globaldb', outglobaldb='globaldb', ininstrument='instrument', outinstrument='instrument', putback=False, link=True):
     """
     s : scheduler
     c : cycle name, e.g. "final"
@@ -28,40 +83,48 @@ def run_losoto(s, c, mss, parsets, outtab='', inglobaldb='globaldb', outglobaldb
     parsets : lists of parsets to execute
     outtab : strings with soltab to output e.g. 'amplitudeSmooth000,phaseOrig000'
     putback : put back in MS the instrument tables
+    link : hardlink the MS tables into the globaldbs instead of copying them
     """
 
     logger.info('Running LoSoTo...')
 
     # prepare globaldbs
-    check_rm('plots-'+c)
-    check_rm(inglobaldb)
-    os.system('mkdir '+inglobaldb)
-    if inglobaldb != outglobaldb: 
-        check_rm(outglobaldb)
-        os.system('mkdir '+outglobaldb)
-
-    for i, ms in enumerate(mss):
-        if i == 0: os.system('cp -r '+ms+'/ANTENNA '+ms+'/FIELD '+ms+'/sky '+inglobaldb)
-        if inglobaldb != outglobaldb:
-            if i == 0: os.system('cp -r '+ms+'/ANTENNA '+ms+'/FIELD '+ms+'/sky '+outglobaldb)
+    if not s.skip_step('losoto '+c+': stage globaldb'):
+        start = time.time()
+        check_rm('plots-'+c)
+        check_rm(inglobaldb)
+        os.system('mkdir '+inglobaldb)
+        if inglobaldb != outglobaldb: 
+            check_rm(outglobaldb)
+            os.system('mkdir '+outglobaldb)
+
+        # the tables in the globaldbs are only read (the exporter writes new sol000_* tables), so they can be linked
+        tables = []
+        for i, ms in enumerate(mss):
+            if i == 0: tables += [(ms+'/'+t, inglobaldb+'/'+t) for t in ['ANTENNA','FIELD','sky']]
+            if inglobaldb != outglobaldb:
+                if i == 0: tables += [(ms+'/'+t, outglobaldb+'/'+t) for t in ['ANTENNA','FIELD','sky']]
         
-        # necessary for self step
-        try:
-            tnum = re.findall(r't\d+', ms)[0][1:]
-            sbnum = re.findall(r'SB\d+', ms)[0][2:]
-            gbinst = 'instrument-'+str(tnum)+'-'+str(sbnum)
-        except:
-            gbinst = 'instrument-'+str(i)
+            # necessary for self step
+            try:
+                tnum = re.findall(r't\d+', ms)[0][1:]
+                sbnum = re.findall(r'SB\d+', ms)[0][2:]
+                gbinst = 'instrument-'+str(tnum)+'-'+str(sbnum)
+            except:
+                gbinst = 'instrument-'+str(i)
 
-        os.system('cp -r '+ms+'/'+ininstrument+' '+inglobaldb+'/'+gbinst)
+            tables.append((ms+'/'+ininstrument, inglobaldb+'/'+gbinst))
        
-        if inglobaldb != outglobaldb:
-            os.system('cp -r '+ms+'/'+outinstrument+' '+outglobaldb+'/'+gbinst)
-    
-    check_rm('plots')
-    os.makedirs('plots')
-    check_rm('cal-'+c+'.h5')
+            if inglobaldb != outglobaldb:
+                tables.append((ms+'/'+outinstrument, outglobaldb+'/'+gbinst))
+
+        copy_tables(tables, link=link)
+        logger.info('Staging of %i tables in globaldb took %.1f s.' % (len(tables), time.time()-start))
     
+        check_rm('plots')
+        os.makedirs('plots')
+        check_rm('cal-'+c+'.h5')
+
     s.add('H5parm_importer.py -v cal-'+c+'.h5 globaldb', log='losoto-'+c+'.log', cmd_type='python', processors='max')
     s.run(check=True)
     
@@ -70,13 +133,17 @@ def run_losoto(s, c, mss, parsets, outtab='', inglobaldb='globaldb', outglobaldb
         s.add('losoto -v cal-'+c+'.h5 '+parset, log='losoto-'+c+'.log', log_append=True, cmd_type='python', processors='max')
         s.run(check=True)
 
-    os.system('mv plots plots-'+c)
+    if not s.skip_step('losoto '+c+': plots'):
+        os.system('mv plots plots-'+c)
     
     if outtab != '':
         s.add('H5parm_exporter.py -v -c --soltab '+outtab+' cal-'+c+'.h5 '+outglobaldb, log='losoto-'+c+'.log', log_append=True, cmd_type='python', processors='max')
         s.run(check=True)
 
-    if putback:
+    if putback and not s.skip_step('losoto '+c+': put back'):
+        # real copies: the MS tables are modified in place by the next calibrations, the globaldb is kept
+        start = time.time()
+        tables = []
         for i, ms in enumerate(mss):
             try:
                 tnum = re.findall(r't\d+', ms)[0][1:]
@@ -86,17 +153,25 @@ def run_losoto(s, c, mss, parsets, outtab='', inglobaldb='globaldb', outglobaldb
                 gbinst = 'instrument-'+str(i)
 
             check_rm(ms+'/'+outinstrument)
-            os.system('cp -r '+outglobaldb+'/sol000_'+gbinst+' '+ms+'/'+outinstrument)
+            tables.append((outglobaldb+'/sol000_'+gbinst, ms+'/'+outinstrument))
+
+        copy_tables(tables, link=False)
+        logger.info('Putting back %i tables took %.1f s.' % (len(tables), time.time()-start))
 
 
 class Scheduler():
-    def __init__(self, qsub = None, max_threads = None, max_processors = None, log_dir = 'logs', dry = False):
+    def __init__(self, qsub = None, max_threads = None, max_processors = None, max_memory = None, log_dir = 'logs', dry = False, journal = None):
         """
         qsub: if true call a shell script which call qsub and then wait 
         for the process to finish before returning
         max_threads: max number of parallel processes
         dry: don't schedule job
-        max_processors: max number of processors in a node (ignored if qsub=False)
+        max_processors: max number of processors in a node, jobs are packed on this budget if qsub=False
+        max_memory: max memory (GB) in a node, jobs are packed on this budget if qsub=False (default: node total memory)
+        journal: file where finished jobs and steps (see skip_step()) are recorded, on a rerun they are skipped
+        until the first one left to do (which must be the last point reached), remove the file to start from scratch
+
+        Timing and resources of every job are written in log_dir/jobs.json, one json dict per line
         """
         self.cluster = self.get_cluster()
         self.qsub = qsub
@@ -127,17 +202,39 @@ class Scheduler():
         else:
             self.max_processors = max_processors
 
+        if max_memory == None:
+            self.max_memory = self.get_memory()
+        else:
+            self.max_memory = max_memory
+
         self.dry = dry
-        logger.info("Scheduler initialized for cluster "+self.cluster+" (Nproc: "+str(self.max_threads)+", multinode: "+str(self.qsub)+", max_processors: "+str(self.max_processors)+").")
+        logger.info("Scheduler initialized for cluster "+self.cluster+" (Nproc: "+str(self.max_threads)+", multinode: "+str(self.qsub)+", max_processors: "+str(self.max_processors)+", max_memory: "+str(self.max_memory)+" GB).")
 
-        self.action_list = []
-        self.log_list = [] # list of 2-lenght tuple of the type: (log filename, type of action)
+        self.action_list = [] # list of jobs, each a dict with cmd, log, log_append, cmd_type, processors, mem, name, depends...
 
         if not os.path.isdir(log_dir):
             logger.info('Creating log dir "'+log_dir+'".')
             os.makedirs(log_dir)
         self.log_dir = log_dir
 
+        # per-job report of this pipeline run
+        self.report = self.log_dir+'/jobs.json'
+        check_rm(self.report)
+        self.step = 0
+
+        # journal of finished jobs/steps: key -> number of times it has been done
+        self.journal = journal
+        self.journal_done = {}
+        self.journal_replay = False
+        self.journal_steps = [] # steps done since the last run, recorded when the next step or run starts
+        if self.journal != None and os.path.exists(self.journal):
+            with open(self.journal) as f:
+                for line in f:
+                    key = line.split()[0]
+                    self.journal_done[key] = self.journal_done.get(key, 0) + 1
+            self.journal_replay = len(self.journal_done) > 0
+            logger.info('Resuming from journal "'+self.journal+'" ('+str(sum(self.journal_done.values()))+' jobs/steps done).')
+
 
     def get_cluster(self):
         """
@@ -153,7 +250,21 @@ class Scheduler():
             return 'Unknown'
 
 
-    def add(self, cmd='', log='', log_append=False, cmd_type='', processors=None):
+    def get_memory(self):
+        """
+        Find the total memory of the node in GB
+        """
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemTotal:'): return int(line.split()[1])/1024.**2
+        except IOError:
+            pass
+        logger.warning('Cannot find node memory, memory is not used to pack jobs.')
+        return float('inf')
+
+
+    def add(self, cmd='', log='', log_append=False, cmd_type='', processors=None, mem=0, name=None, depends=None, inputs=None, outputs=None):
         """
         Add cmd to the scheduler list
         cmd: the command to run
@@ -161,38 +272,148 @@ class Scheduler():
         log_append: if true append, otherwise replace
         cmd_type: can be a list of known command types as "BBS", "NDPPP"...
         processors: number of processors to use, can be "max" to automatically use max number of processors per node
+        without qsub only a number is used to pack the job on the node, "max" (or a guessed value) counts as one slot
+        mem: expected peak memory of the job in GB
+        name: name of the job, used by other jobs of the same run to depend on it
+        depends: list of job names that must finish (and pass the log check) before this job starts
+        inputs: list of files read by the job, their mtimes are part of the journal key
+        outputs: list of files/dirs made by the job and kept until the end of the pipeline, part of the journal key
+        and checked to exist when the job is skipped
         """
         if log != '': log = self.log_dir+'/'+log
         if log != '' and not log_append: cmd += ' > '+log+' 2>&1'
         if log != '' and log_append: cmd += ' >> '+log+' 2>&1'
 
+        # cores used to pack local jobs: only when declared, otherwise one slot as the job always had
+        if processors == None or processors == 'max': cores = 1
+        else: cores = processors
+
         if processors != None and processors == 'max': processors = self.max_processors
 
-        if self.qsub:
-            # if number of processors not specified, try to find automatically
-            if processors == None:
-                processors = 1 # default use single CPU
-                if "calibrate-stand-alone" == cmd[:21]: processors = 1
-                if "NDPPP" == cmd[:5]: processors = 1
-                if "wsclean" == cmd[:7]: processors = self.max_processors
-                if "awimager" == cmd[:8]: processors = self.max_processors
-            if processors > self.max_processors: processors = self.max_processors
-            self.action_list.append([str(processors),'\''+cmd+'\''])
-        else:
-            self.action_list.append(cmd)
+        # if number of processors not specified, try to find automatically (for qsub)
+        if processors == None:
+            processors = 1 # default use single CPU
+            if "calibrate-stand-alone" == cmd[:21]: processors = 1
+            if "NDPPP" == cmd[:5]: processors = 1
+            if "wsclean" == cmd[:7]: processors = self.max_processors
+            if "awimager" == cmd[:8]: processors = self.max_processors
+
+        if self.qsub: cmd = '\''+cmd+'\''
+
+        self.add_job(cmd, log, cmd_type, processors, mem, name, depends, inputs, outputs, log_append=log_append, cores=cores)
+
+
+    def add_job(self, cmd, log='', cmd_type='', processors=1, mem=0, name=None, depends=None, inputs=None, outputs=None, journal_cmd=None, log_append=False, cores=None):
+        """
+        Append an already formatted command to the list of jobs of the next run
+        cores: processors used to pack the job on the node without qsub (default: processors)
+        journal_cmd: string used in place of cmd to make the journal key
+        """
+        if depends == None: depends = []
+        if inputs == None: inputs = []
+        if outputs == None: outputs = []
+        if journal_cmd == None: journal_cmd = cmd
+        if cores == None: cores = processors
+        if name != None and name in [job['name'] for job in self.action_list]:
+            logger.critical('Job name "'+name+'" is already used in this run.')
+            sys.exit(1)
+
+        # a job larger than the node would never start
+        if processors > self.max_processors: processors = self.max_processors
+        if cores > self.max_processors: cores = self.max_processors
+        if mem > self.max_memory:
+            logger.warning('Job asks for '+str(mem)+' GB, more than the node memory ('+str(self.max_memory)+' GB).')
+            mem = self.max_memory
+
+        self.action_list.append({'cmd':cmd, 'log':log, 'log_append':log_append, 'cmd_type':cmd_type, 'processors':processors, 'cores':cores, 'mem':mem, \
+                                 'name':name, 'depends':list(depends), \
+                                 'inputs':list(inputs), 'outputs':list(outputs), 'journal_cmd':journal_cmd})
 
-        if log != '':
-            self.log_list.append((log,cmd_type))
+
+    def get_journal_key(self, job):
+        """
+        Return the journal key of a job: hash of the command, of the mtimes of its inputs and of its outputs names
+        """
+        key = job['journal_cmd']
+        for f in job['inputs']:
+            if os.path.exists(f): key += '\nin '+f+' '+repr(os.path.getmtime(f))
+            else: key += '\nin '+f+' missing'
+        for f in job['outputs']:
+            key += '\nout '+f
+        return hashlib.sha1(key).hexdigest()
 
 
-    def add_casa(self, cmd='', params={}, wkd=None, log='', log_append=False, processors=None):
+    def write_journal(self, key, cmd):
+        """
+        Record a finished job or step in the journal
+        """
+        with open(self.journal, 'a') as f:
+            f.write(key+' '+cmd.replace('\n',' ')+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+    def end_replay(self):
+        """
+        Stop trusting the journal, from here on everything is done again
+        The data (e.g. MS columns) are modified in place, so this must be the point where the previous run stopped:
+        if the journal has more jobs/steps left the pipeline does not match it and is stopped
+        """
+        if not self.journal_replay: return
+        left = sum(self.journal_done.values())
+        if left > 0:
+            logger.critical('Journal "'+self.journal+'" has '+str(left)+' jobs/steps done after this point (a job failed or the pipeline changed). '+\
+                    'Remove it to start from scratch.')
+            sys.exit(1)
+        logger.info('Journal: resuming from here.')
+        self.journal_replay = False
+
+
+    def skip_step(self, name):
+        """
+        Journal a step done outside the scheduler (check_rm, os.system, make_mask...), use as:
+        if not s.skip_step('name'): do the step
+        name: description of the step, the same name can be used again later in the pipeline
+        return True if the step was done by the replayed run, otherwise False and the step is recorded
+        as done when the next step or run starts (i.e. if the step completed)
+        """
+        if self.journal == None: return False
+        self.flush_steps()
+        key = hashlib.sha1('step '+name).hexdigest()
+        if self.journal_replay and self.journal_done.get(key, 0) > 0:
+            self.journal_done[key] -= 1
+            logger.debug('Journal: skipping step '+name)
+            return True
+        self.end_replay()
+        self.journal_steps.append((key, 'step '+name))
+        return False
+
+
+    def flush_steps(self):
+        """
+        Record in the journal the steps done since the last run
+        """
+        if not self.dry:
+            for key, name in self.journal_steps: self.write_journal(key, name)
+        self.journal_steps = []
+
+
+    def add_casa(self, cmd='', params={}, wkd=None, log='', log_append=False, processors=None, mem=0, name=None, depends=None, inputs=None, outputs=None):
         """
         Run a casa command pickling the parameters passed in params
         NOTE: running casa commands in parallel is a problem for the log file, better avoid
         alternatively all used MS and CASA must be in a separate working dir
 
         wkd = working dir (logs and pickle are in the pipeline dir)
+        mem, name, depends, inputs, outputs = see add()
         """
+        # the pickle file name is random, so the journal key uses the parameters instead
+        if log != '': journal_cmd = cmd+' '+repr(sorted(params.items()))+' '+str(wkd)+' '+log
+        else: journal_cmd = cmd+' '+repr(sorted(params.items()))+' '+str(wkd)
+
+        # cores used to pack local jobs: only when declared, otherwise one slot
+        if processors == None or processors == 'max': cores = 1
+        else: cores = processors
 
         if processors != None and processors == 'max': processors = self.max_processors
         if processors == None: processors=self.max_processors # default use entire node
@@ -210,131 +431,289 @@ class Scheduler():
             logger.error('Cannot find CASA working dir: '+wkd)
             sys.exit(1)
 
-        if self.qsub:
-            if log != '' and not log_append: casacmd = str(processors)+' \''+casacmd+' > '+log+' 2>&1'
-            elif log != '' and log_append: casacmd = str(processors)+' \''+casacmd+' >> '+log+' 2>&1'
-            else: casacmd = str(processors)+' \''+casacmd
+        if log != '' and not log_append: casacmd += ' > '+log+' 2>&1'
+        elif log != '' and log_append: casacmd += ' >> '+log+' 2>&1'
 
+        if self.qsub:
             # clean up casa remnants in Hamburg cluster
             if self.cluster == 'Hamburg':
-                self.action_list.append(casacmd+'; killall -9 -r dbus-daemon Xvfb python casa\*\'')
+                casacmd = '\''+casacmd+'; killall -9 -r dbus-daemon Xvfb python casa\*\''
                 if processors != self.max_processors:
                     logger.error('To clean annoying CASA remnants no more than 1 CASA per node is allowed.')
                     sys.exit(1)
             else:
-                self.action_list.append(casacmd+'\'')
-        else:
-            if log != '' and not log_append: self.action_list.append(casacmd+' > '+log+' 2>&1')
-            elif log != '' and log_append: self.action_list.append(casacmd+' >> '+log+' 2>&1')
-            else: self.action_list.append(casacmd)
+                casacmd = '\''+casacmd+'\''
 
-        if log != '':
-            self.log_list.append((log,'CASA'))
+        self.add_job(casacmd, log, 'CASA', processors, mem, name, depends, inputs, outputs, journal_cmd, log_append, cores)
 
 
-    def run(self, check=False, max_threads=None):
+    def run(self, check=False, max_threads=None, fail_fast=False):
         """
-        If check=True then a check is done on every log in the log_list
+        If check=True then a check is done on the log of every job
         if max_thread != None, then it overrides the global values, useful for special commands that need a lower number of threads
+
+        Jobs without dependencies are all started at once (up to the threads limit) and the run returns when all are done.
+        Jobs with "depends" start as soon as the jobs they depend on are finished, so that e.g. each MS can go through
+        its own solve -> losoto -> correct -> smooth chain without waiting for the other MSs. With check=True every log
+        is checked as soon as its job finishes and the jobs depending on a failed one are not run.
+
+        Without qsub, jobs are also packed on the node budget (max_processors and max_memory) using their
+        declared cores and mem (jobs with processors "max" or not given count as one core): every time resources
+        are freed, the ready jobs are tried from the largest to the smallest and started if they fit (first-fit decreasing).
+
+        With check=True the logs are also followed while the jobs run. If fail_fast=True the first error
+        found kills all running jobs and stops the pipeline instead of waiting for the end of the step.
+
+        With a journal, jobs recorded as done (same command, same inputs mtimes and outputs) are not run again
+        as long as the previous run is being replayed. The first run with a job left to do ends the replay,
+        so that everything after it is done again.
         """
         from threading import Thread
-        from Queue import Queue
-        import subprocess
-
-        def worker(queue):
-            for cmd in iter(queue.get, None):
-                if self.qsub and self.cluster == 'Hamburg':
-                    # run in priority nodes
-                    #cmd = 'salloc --job-name LBApipe --reservation=important_science --time=24:00:00 --nodes=1 --tasks-per-node='+cmd[0]+\
-                    #        ' /usr/bin/srun --ntasks=1 --nodes=1 --preserve-env \''+cmd[1]+'\''
-                    # run on all cluster
-                    cmd = 'salloc --job-name LBApipe --time=24:00:00 --nodes=1 --tasks-per-node='+cmd[0]+\
-                            ' /usr/bin/srun --ntasks=1 --nodes=1 --preserve-env \''+cmd[1]+'\''
-                subprocess.call(cmd, shell=True)
-    
+        from Queue import Queue, Empty
+        import subprocess, signal, errno
+
+        def worker(job, done):
+            cmd = job['cmd']
+            if self.qsub and self.cluster == 'Hamburg':
+                # run in priority nodes
+                #cmd = 'salloc --job-name LBApipe --reservation=important_science --time=24:00:00 --nodes=1 --tasks-per-node='+str(job['processors'])+\
+                #        ' /usr/bin/srun --ntasks=1 --nodes=1 --preserve-env \''+cmd+'\''
+                # run on all cluster
+                cmd = 'salloc --job-name LBApipe --time=24:00:00 --nodes=1 --tasks-per-node='+str(job['processors'])+\
+                        ' /usr/bin/srun --ntasks=1 --nodes=1 --preserve-env \''+cmd+'\''
+            if not self.dry: # don't schedule if dry run
+                start = time.time()
+                # own process group, to be able to kill the shell together with its children
+                job['proc'] = subprocess.Popen(cmd, shell=True, preexec_fn=os.setsid)
+                # wait4 also returns the resources used by the shell and its children
+                while True:
+                    try:
+                        pid, status, rusage = os.wait4(job['proc'].pid, 0)
+                        break
+                    except OSError as e:
+                        if e.errno != errno.EINTR: raise
+                if os.WIFSIGNALED(status): job['proc'].returncode = -os.WTERMSIG(status)
+                else: job['proc'].returncode = os.WEXITSTATUS(status)
+                job['stats'] = {'start':start, 'wall':time.time()-start, 'cpu':rusage.ru_utime+rusage.ru_stime, \
+                                'maxrss':rusage.ru_maxrss/1024., 'exit':job['proc'].returncode}
+            done.put(job)
+
+        def skip(job):
+            """
+            True if the job is in the journal of the replayed run
+            """
+            if not self.journal_replay: return False
+            if self.journal_done.get(job['journal_key'], 0) == 0: return False
+            for f in job['outputs']:
+                if not os.path.exists(f):
+                    logger.critical('Journal "'+self.journal+'": output '+f+' of a job already done is missing. Remove it to start from scratch.')
+                    sys.exit(1)
+            self.journal_done[job['journal_key']] -= 1
+            logger.debug('Journal: skipping '+job['journal_cmd'])
+            return True
+
+        def kill(job):
+            if job.get('proc') != None and job['proc'].poll() == None:
+                try: os.killpg(job['proc'].pid, signal.SIGTERM)
+                except OSError: pass
+
         # limit threads only when qsub doesn't do it
         if max_threads != None: max_threads_run = min(max_threads, self.max_threads)
         else: max_threads_run = self.max_threads
 
-        q = Queue()
-        threads = [Thread(target=worker, args=(q,)) for _ in range(max_threads_run)]
-    
-        for i, t in enumerate(threads): # start workers
-            t.daemon = True
-            t.start()
-    
-        for action in self.action_list:
-            if self.dry: continue # don't schedule if dry run
-            q.put_nowait(action)
-        for _ in threads: q.put(None) # signal no more commands
-        for t in threads: t.join()
+        # check dependencies
+        names = [job['name'] for job in self.action_list if job['name'] != None]
+        for job in self.action_list:
+            for dep in job['depends']:
+                if not dep in names:
+                    logger.critical('Job "'+str(job['name'])+'" depends on unknown job "'+dep+'".')
+                    sys.exit(1)
 
-        # check outcomes on logs
-        if check:
-            for log, cmd_type in self.log_list:
-                self.check_run(log, cmd_type)
+        # jobs done by the replayed run are not started
+        replayed = []
+        if self.journal != None:
+            self.flush_steps()
+            for job in self.action_list:
+                job['journal_key'] = self.get_journal_key(job)
+                job['replayed'] = skip(job)
+                if job['replayed']: replayed.append(job)
+            if len(replayed) > 0:
+                logger.info('Journal: '+str(len(replayed))+' jobs already done, skipped.')
+            # stop trusting the journal as soon as something has to run
+            if len(replayed) < len(self.action_list): self.end_replay()
+        self.step += 1
+
+        pending = [job for job in self.action_list if not job.get('replayed')]
+        finished = set([job['name'] for job in replayed if job['name'] != None]) # names of jobs done with success
+        failed = set() # names of jobs failed or skipped
+        done = Queue()
+        running = [] # jobs started and not yet finished
+        used_processors = 0
+        used_mem = 0
+        while len(pending) > 0 or len(running) > 0:
+
+            # drop jobs depending on failed ones
+            for job in list(pending):
+                if any(dep in failed for dep in job['depends']):
+                    logger.error('Skipping job "'+str(job['name'])+'", a dependency failed.')
+                    if job['name'] != None: failed.add(job['name'])
+                    pending.remove(job)
+
+            # start jobs with satisfied dependencies, largest first (stable sort keeps the order of equal jobs)
+            ready = [job for job in pending if all(dep in finished for dep in job['depends'])]
+            ready.sort(key=lambda job: (job['cores'], job['mem']), reverse=True)
+            for job in ready:
+                if len(running) >= max_threads_run: break
+                # qsub allocates its own nodes
+                if not self.qsub and (used_processors+job['cores'] > self.max_processors or \
+                        used_mem+job['mem'] > self.max_memory): continue
+                pending.remove(job)
+                if check and job['log'] != '':
+                    # the shell would truncate the log anyway, do it now so that old lines are not followed
+                    if not job['log_append'] and not self.dry: open(job['log'], 'w').close()
+                    job['scanner'] = LogScanner(job['log'], job['cmd_type'])
+                t = Thread(target=worker, args=(job, done))
+                t.daemon = True
+                t.start()
+                running.append(job)
+                used_processors += job['cores']
+                used_mem += job['mem']
+
+            if len(running) == 0:
+                # nothing runs and nothing can start: either all skipped or circular dependencies
+                if any(not any(dep in failed for dep in job['depends']) for job in pending):
+                    logger.critical('Circular dependencies among jobs: '+', '.join([str(job['name']) for job in pending]))
+                    sys.exit(1)
+                continue
+
+            try:
+                job = done.get(timeout=1)
+            except Empty:
+                # follow the logs of the running jobs
+                for job in running:
+                    if not 'scanner' in job: continue
+                    job['scanner'].scan()
+                    if fail_fast and job['scanner'].error != None:
+                        logger.critical('Error in '+job['log']+': '+job['scanner'].error.strip())
+                        for job in running: kill(job)
+                        sys.exit(1)
+                continue
+
+            running.remove(job)
+            used_processors -= job['cores']
+            used_mem -= job['mem']
+            if 'stats' in job: self.write_report(job)
+
+            # check outcomes on logs
+            if 'scanner' in job and job['scanner'].check() != 0:
+                if job['name'] != None: failed.add(job['name'])
+                if fail_fast:
+                    logger.critical('Stopping, a job failed.')
+                    for job in running: kill(job)
+                    sys.exit(1)
+            else:
+                if job['name'] != None: finished.add(job['name'])
+                if self.journal != None and not self.dry: self.write_journal(job['journal_key'], job['journal_cmd'])
 
         # reset list of commands
         self.action_list = []
-        self.log_list = []
+
+
+    def write_report(self, job):
+        """
+        Append timing and resources of a finished job to the report
+        start (unix time), wall and cpu time in s, maxrss (peak resident memory of the largest process) in MB
+        with qsub these are the numbers of salloc, not of the job
+        """
+        record = {'step':self.step, 'name':job['name'], 'cmd_type':job['cmd_type'], 'log':job['log'], 'cmd':job['cmd'], \
+                  'cores':job['cores'], 'mem':job['mem']}
+        record.update(job['stats'])
+        with open(self.report, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True)+'\n')
+        logger.debug('Job done in %.1f s (cpu: %.1f s, mem: %.0f MB, exit: %i): %s' % \
+                (job['stats']['wall'], job['stats']['cpu'], job['stats']['maxrss'], job['stats']['exit'], job['cmd']))
 
 
     def check_run(self, log='', cmd_type=''):
         """
         Produce a warning if a command didn't close the log properly i.e. it crashed
-        NOTE: grep, -L inverse match, -l return only filename
         """
-        import subprocess
+        return LogScanner(log, cmd_type).check()
+
+
+# checks on the logs for each cmd_type: name used in the error message and list of (regexp, ignore case, must be present),
+# a log is bad if a "must be present" regexp is not found or any other regexp is found
+log_checks = {
+    'BBS':     ('BBS', [('success', False, True)]),
+    'NDPPP':   ('NDPPP', [('Finishing processing', False, True), ('Exception', False, False), \
+                          (r'\*\*\*\* uncaught exception \*\*\*\*', False, False)]),
+    'CASA':    ('CASA', [('[a-z]Error', False, False), ('An error occurred running', False, False), \
+                         (r'\*\*\* Error \*\*\*', False, False)]),
+    'wsclean': ('WSClean', [('exception occurred', False, False), ('Cleaning up temporary files...', False, True)]),
+    'python':  ('Python', [(r'Traceback \(most recent call last\):', False, False), ('Error', True, False), \
+                           ('Critical', True, False)]),
+    'general': ('', [('error', True, False)])
+    }
+
+
+class LogScanner():
+    def __init__(self, log, cmd_type):
+        """
+        Check a log against the regexps of its cmd_type in a single pass,
+        the log can be scanned while it is still being written and only the new lines are read
+        log: log filename
+        cmd_type: one of the types in log_checks
+        """
+        self.log = log
+        self.cmd_type = cmd_type
+        self.offset = 0 # position of the first line not yet scanned
+        self.error = None # first line matching an error regexp
+        if cmd_type in log_checks:
+            self.regexps = [(re.compile(r, re.IGNORECASE if nocase else 0), present) for r, nocase, present in log_checks[cmd_type][1]]
+        else:
+            self.regexps = []
+        self.found = [False]*len(self.regexps)
+
 
-        if not os.path.exists(log):
-            logger.warning('No log file found to check results: '+log)
+    def scan(self, partial=False):
+        """
+        Scan the lines added to the log since the last call
+        partial: if True also scan the last line even if not terminated (job finished)
+        """
+        if not os.path.exists(self.log): return
+        with open(self.log) as f:
+            if os.fstat(f.fileno()).st_size < self.offset: # log rewritten
+                self.offset = 0
+                self.found = [False]*len(self.regexps)
+                self.error = None
+            f.seek(self.offset)
+            while True:
+                line = f.readline()
+                if line == '' or (not line.endswith('\n') and not partial): break
+                self.offset += len(line)
+                for i, (regexp, present) in enumerate(self.regexps):
+                    if self.found[i] or not regexp.search(line): continue
+                    self.found[i] = True
+                    if not present and self.error == None: self.error = line
+
+
+    def check(self):
+        """
+        Scan what is left of the log and return 1 if there is a problem, 0 otherwise
+        """
+        if not os.path.exists(self.log):
+            logger.warning('No log file found to check results: '+self.log)
             return 1
 
-        if cmd_type == 'BBS':
-            out = subprocess.check_output('grep -L success '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            if out != '':
-                logger.error('BBS run problem on:\n'+out.split("\n")[0])
-                return 1
-
-        elif cmd_type == 'NDPPP':
-            out = subprocess.check_output('grep -L "Finishing processing" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "Exception" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "**** uncaught exception ****" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            if out != '':
-                logger.error('NDPPP run problem on:\n'+out.split("\n")[0])
-                return 1
-
-        elif cmd_type == 'CASA':
-            out = subprocess.check_output('grep -l "[a-z]Error" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "An error occurred running" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "\*\*\* Error \*\*\*" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            if out != '':
-                logger.error('CASA run problem on:\n'+out.split("\n")[0])
-                return 1
-
-        elif cmd_type == 'wsclean':
-            out = subprocess.check_output('grep -l "exception occurred" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -L "Cleaning up temporary files..." '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            if out != '':
-                logger.error('WSClean run problem on:\n'+out.split("\n")[0])
-                return 1
-
-        elif cmd_type == 'python':
-            out = subprocess.check_output('grep -l "Traceback (most recent call last):" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -i -l "Error" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -i -l "Critical" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            if out != '':
-                logger.error('Python run problem on:\n'+out.split("\n")[0])
-                return 1
-
-        elif cmd_type == 'general':
-            out = subprocess.check_output('grep -l -i "error" '+log+' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            if out != '':
-                logger.error('Run problem on:\n'+out.split("\n")[0])
-                return 1
+        if not self.cmd_type in log_checks:
+            logger.warning('Unknown command type for log checking: "'+self.cmd_type+'"')
+            return 1
 
-        else:
-            logger.warning('Unknown command type for log checking: "'+cmd_type+'"')
+        self.scan(partial=True)
+        if self.error != None or not all(found for found, (regexp, present) in zip(self.found, self.regexps) if present):
+            name = log_checks[self.cmd_type][0]
+            if name == '': logger.error('Run problem on:\n'+self.log)
+            else: logger.error(name+' run problem on:\n'+self.log)
             return 1
 
         return 0
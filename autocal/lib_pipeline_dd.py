@@ -1,4 +1,4 @@
-import os, sys, itertools
+import os, sys, itertools, bisect
 import numpy as np
 from astropy.table import Table
 from astropy.coordinates import Angle, SkyCoord, match_coordinates_sky
@@ -9,7 +9,7 @@ import pyregion
 from pyregion.parser_helper import Shape
 import bdsf
 try:
-    from scipy.spatial import Voronoi
+    from scipy.spatial import Voronoi, cKDTree
 except:
     logger.error("Load latest scipy with 'use Pythonlibs'")
     sys.exit(1)
@@ -17,6 +17,62 @@ except:
 import logging
 logger = logging.getLogger('PiLL')
 
+def radec2xyz(ra, dec):
+    """
+    Unit vectors of ra, dec (degree)
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)]).T
+
+
+class SkyTree(object):
+    """
+    kd-tree on the unit vectors of a set of sources to find them around a direction
+    the tree only selects candidates, distances are computed with SkyCoord.separation as usual
+    """
+    def __init__(self, ra, dec):
+        """
+        ra, dec : arrays (degree)
+        """
+        self.ra = np.array(ra)
+        self.dec = np.array(dec)
+        self.tree = cKDTree(radec2xyz(self.ra, self.dec))
+
+    def within(self, ra, dec, radius):
+        """
+        Return indexes and distances (degree) of the sources within radius (degree) from ra, dec
+        """
+        if radius >= 180.:
+            idx = np.arange(len(self.ra))
+        else:
+            # a bit larger for rounding, the exact cut is done on the separations
+            chord = 2*np.sin(np.radians(radius)/2.)*(1+1e-6)
+            idx = np.array(self.tree.query_ball_point(radec2xyz(ra, dec), chord), dtype=int)
+        dists = SkyCoord(ra=ra*u.degree, dec=dec*u.degree).separation(SkyCoord(ra=self.ra[idx]*u.degree, dec=self.dec[idx]*u.degree)).degree
+        return idx[dists <= radius], dists[dists <= radius]
+
+    def closests(self, ra, dec):
+        """
+        Iterate on (distance, index) of all sources from the closest to the farthest from ra, dec
+        ties are sorted on index, as sorted(zip(dists, indexes)) would do
+        """
+        if len(self.ra) == 0: return
+        # start from the distance of the 16th closest source and enlarge it until needed
+        chord = np.max(self.tree.query(radec2xyz(ra, dec), k=min(16, len(self.ra)))[0])
+        radius = max(np.degrees(2*np.arcsin(min(chord/2., 1.))), 1/3600.)
+        done = 0
+        while True:
+            # everything closer than radius is there, so the first sources are always the same
+            idx, dists = self.within(ra, dec, radius)
+            closests = sorted(zip(dists, idx.tolist()))
+            for dist_idx in closests[done:]:
+                yield dist_idx
+            if radius >= 180.: return
+            done = len(closests)
+            # once half of the sources are needed just take them all
+            radius = 180. if done > len(self.ra)/2 else radius*4
+
+
 def table_to_circ_region(table, outfile, racol='RA', deccol='DEC', sizecol='size', color='red', label=True):
     """
     Get a table with ra, dec, size and generate a circular ds9 region 
@@ -96,31 +152,54 @@ def make_directions_from_skymodel(filename, outdir='regions/', flux_min_Jy=1.0,
     t.reverse()
 
     # combine nearby sources
-    for s in t:
+    # work on arrays and mark removed rows in a mask, neighbours are found with a kd-tree on unit vectors.
+    # Rows are still addressed by their position among the surviving ones (alive), as it was done
+    # removing rows from the table while looping on it, so that sources are grouped in the same way.
+    ra, dec = np.array(t['RA']), np.array(t['DEC'])
+    size, peak, flux = np.array(t['dd_size']), np.array(t['Peak_flux']), np.array(t['Total_flux'])
+    tree = cKDTree(radec2xyz(ra, dec))
+    chord = 2*np.sin(np.radians(directions_separation_max_arcmin/60.)/2.)*(1+1e-6) # a bit larger for rounding
+    keep = np.ones(len(t), dtype=bool)
+    moved = np.zeros(len(t), dtype=bool) # sources moved away from their position in the tree
+    alive = range(len(t))
+    k = 0
+    while k < len(alive):
         # if ra/dec changes, continue finding nearby sources until no-sources are found
         updated = True
         while updated:
-            dists = SkyCoord(ra=s['RA']*u.degree, dec=s['DEC']*u.degree).separation(SkyCoord(ra=t['RA'], dec=t['DEC']))
+            j = alive[k]
+            near = [n for n in tree.query_ball_point(radec2xyz(ra[j], dec[j]), chord) if keep[n] and not moved[n]]
+            idx_moved = np.where(keep & moved)[0]
+            near = np.sort(np.concatenate([near, idx_moved[ np.sum((radec2xyz(ra[idx_moved], dec[idx_moved]) - \
+                    radec2xyz(ra[j], dec[j]))**2, axis=1) < chord**2 ]])).astype(int)
+            dists = SkyCoord(ra=ra[j]*u.degree, dec=dec[j]*u.degree).separation(SkyCoord(ra=ra[near]*u.degree, dec=dec[near]*u.degree))
+            close = (dists < directions_separation_max_arcmin*u.arcmin) & (dists > 0.*u.degree)
             updated = False
-            for i, dist in enumerate(dists):
-                if dist < directions_separation_max_arcmin*u.arcmin and dist > 0.*u.degree:
-                    # if a source is dominant keep that at the center of the patch
-                    if t['Peak_flux'][i] > 3*s['Peak_flux']:
-                        s['RA'] = t['RA'][i]
-                        s['DEC'] = t['DEC'][i]
-                        updated = True
-                    # other wise weighted mean
-                    elif t['Peak_flux'][i] > s['Peak_flux']:
-                        s['RA'] = (s['RA']*s['Peak_flux'] + t['RA'][i]*t['Peak_flux'][i])/(s['Peak_flux']+t['Peak_flux'][i])
-                        s['DEC'] = (s['DEC']*s['Peak_flux'] + t['DEC'][i]*t['Peak_flux'][i])/(s['Peak_flux']+t['Peak_flux'][i])
-                        updated = True
-
-                    s['dd_size'] = max(s['dd_size'], t['dd_size'][i]) + dist.degree
-
-                    s['Total_flux'] += t['Total_flux'][i]
-                    s['Peak_flux'] = max(s['Peak_flux'], t['Peak_flux'][i])
-
-                    t.remove_rows(i)
+            for i, dist in zip([bisect.bisect_left(alive, n) for n in near[close]], dists[close]):
+                j, n = alive[k], alive[i]
+                # if a source is dominant keep that at the center of the patch
+                if peak[n] > 3*peak[j]:
+                    ra[j] = ra[n]
+                    dec[j] = dec[n]
+                    moved[j] = updated = True
+                # other wise weighted mean
+                elif peak[n] > peak[j]:
+                    ra[j] = (ra[j]*peak[j] + ra[n]*peak[n])/(peak[j]+peak[n])
+                    dec[j] = (dec[j]*peak[j] + dec[n]*peak[n])/(peak[j]+peak[n])
+                    moved[j] = updated = True
+
+                size[j] = max(size[j], size[n]) + dist.degree
+
+                flux[j] += flux[n]
+                peak[j] = max(peak[j], peak[n])
+
+                keep[n] = False
+                del alive[i]
+        k += 1
+
+    t['RA'][:], t['DEC'][:] = ra, dec
+    t['dd_size'][:], t['Peak_flux'][:], t['Total_flux'][:] = size, peak, flux
+    t = t[keep]
     logger.info('# sources after combining close-by sources: %i' % len(t))
 
     # Filter patches on total flux density limit
@@ -140,10 +219,9 @@ def make_directions_from_skymodel(filename, outdir='regions/', flux_min_Jy=1.0,
 
     for s in t_large:
         dists = SkyCoord(ra=s['RA']*u.degree, dec=s['DEC']*u.degree).separation(SkyCoord(ra=t['RA'], dec=t['DEC']))
-        for i, dist in enumerate(dists):
-            if dist < directions_separation_max_arcmin*u.arcmin:
-                t['Total_flux'][i] += s['Total_flux']
-                t['dd_size'][i] = max(s['dd_size'], t['dd_size'][i]) + dist.degree
+        idx = np.where(dists < directions_separation_max_arcmin*u.arcmin)[0]
+        t['Total_flux'][idx] += s['Total_flux']
+        t['dd_size'][idx] = np.maximum(s['dd_size'], t['dd_size'][idx]) + dists[idx].degree
 
     # sort on a weighted mix of total and peak flux
     t['Comb_flux'] = 0.33*t['Total_flux']+0.66*t['Peak_flux']
@@ -213,6 +291,7 @@ def make_directions_from_img(imagename, outdir='regions/', target_flux_jy=10, br
     ddcal['Peak_flux'].unit = 'Jy/beam'
 
     # find ddcal as regions of enough flux around bright sources
+    tree = SkyTree(t['RA'], t['DEC'])
     idx_sources = []
     for idx_ddcal, dd in enumerate(ddcal):
         #print "### source number %i" % idx_ddcal
@@ -223,10 +302,8 @@ def make_directions_from_img(imagename, outdir='regions/', target_flux_jy=10, br
         dd['dd_size'] = s['size']
         dd['Total_flux'] = 0.
         dd['Peak_flux'] = 0.
-        dists = SkyCoord(ra=dd['RA']*u.degree, dec=dd['DEC']*u.degree).separation(SkyCoord(ra=t['RA'], dec=t['DEC'])).degree
-        idx_closests = [idx for (dist,idx) in sorted(zip(dists,xrange(len(dists))))] # idx list from closest to farthest
         idx_sources.append([])
-        for idx_closest in idx_closests:
+        for dist, idx_closest in tree.closests(dd['RA'], dd['DEC']): # from closest to farthest
 
             # first cycle matches at distance=0 the calibrator
             s = t[idx_closest]
@@ -248,12 +325,11 @@ def make_directions_from_img(imagename, outdir='regions/', target_flux_jy=10, br
     logger.info('Number of ddcal after size cut: %i' % len(ddcal))
 
     # for bright sources keep only centered regions
-    idx_brights = np.where(t['Total_flux'] > bright_source_jy)[0]
+    idx_brights = set(np.where(t['Total_flux'] > bright_source_jy)[0])
     toremove = []
     for i in xrange(len(idx_sources)):
-        for idx_bright in idx_brights:
-            if idx_bright in idx_sources[i][1:]:
-                toremove.append(i)
+        # once per bright source found
+        toremove += [i]*len(idx_brights.intersection(idx_sources[i][1:]))
     ddcal.remove_rows(toremove)
     for r in sorted(toremove, reverse=True):
         del idx_sources[r]
@@ -265,12 +341,18 @@ def make_directions_from_img(imagename, outdir='regions/', target_flux_jy=10, br
         
     # TODO: wrong, regions must be independent or calibration is messed up
     # finally retain only independent regions
+    # only the previous regions sharing a source with this one can overlap, they are found from the sources
     toremove = []
+    regions_of_source = {}
     for i, dd in enumerate(ddcal):
-        for j, dd2 in enumerate(ddcal[:i]):
+        n_matches = {}
+        for s in idx_sources[i]:
+            for j in regions_of_source.get(s, []):
+                n_matches[j] = n_matches.get(j, 0) + 1
+            regions_of_source.setdefault(s, []).append(i)
+        for j in sorted(n_matches):
             if j in toremove: continue
-            n_match = len([s for s in idx_sources[i] if s in idx_sources[j]])
-            if n_match > 0.25*len(idx_sources[i]):
+            if n_matches[j] > 0.25*len(idx_sources[i]):
                 toremove.append(i)
                 break
     ddcal.remove_rows(toremove)
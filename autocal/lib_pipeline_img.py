@@ -172,6 +172,61 @@ def blank_image_fits(filename, maskname, outfile=None, inverse=False, blankval=0
         fits.writeto(outfile, clobber=True)
 
  
+# rasterised region masks, keyed on the region file content and the image geometry
+region_masks = {}
+region_masks_order = []
+region_masks_max = 4
+
+def get_region_mask(region, header, shape, op='AND'):
+    """
+    Return the (read-only) mask of a region or list of regions on an image,
+    rasterised masks are cached so that blanking many images with the same
+    geometry and regions does not redo the rasterisation.
+
+    region: ds9 region or list of regions
+    header: header of the (flattened) image
+    shape: shape of the (flattened) image
+    op: how to combine multiple regions with AND or OR
+    """
+    import hashlib
+    import astropy.wcs as pywcs
+    import pyregion
+
+    if not type(region) is list: region=[region]
+
+    geometry = hashlib.sha1(pywcs.WCS(header).to_header_string(relax=True)+str(shape)).hexdigest()
+    keys = []
+    for this_region in region:
+        with open(this_region) as f:
+            keys.append(hashlib.sha1(f.read()).hexdigest()+geometry)
+    key = (op,)+tuple(keys)
+
+    def cache(k, mask):
+        mask.flags.writeable = False
+        region_masks[k] = mask
+        region_masks_order.append(k)
+        while len(region_masks_order) > region_masks_max:
+            del region_masks[region_masks_order.pop(0)]
+        return mask
+
+    if key in region_masks: return region_masks[key]
+
+    if op=='AND': total_mask = np.ones(shape=shape).astype(bool)
+    if op=='OR': total_mask = np.zeros(shape=shape).astype(bool)
+    for this_region, k in zip(region, keys):
+        if k in region_masks:
+            mask = region_masks[k]
+        else:
+            # extract mask
+            r = pyregion.open(this_region)
+            mask = cache(k, r.get_mask(header=header, shape=shape))
+        if op=='AND': total_mask = total_mask & mask
+        if op=='OR': total_mask = total_mask | mask
+
+    if len(region) == 1: return region_masks[keys[0]]
+    return cache(key, total_mask)
+
+
 def blank_image_reg(filename, region, outfile=None, inverse=False, blankval=0., op='AND'):
     """
     Set to "blankval" all the pixels inside the given region
@@ -186,24 +241,15 @@ def blank_image_reg(filename, region, outfile=None, inverse=False, blankval=0.,
     op: how to combine multiple regions with AND or OR
     """
     import astropy.io.fits as pyfits
-    import pyregion
 
     if outfile == None: outfile = filename
-    if not type(region) is list: region=[region]
 
     # open fits
     with pyfits.open(filename) as fits:
         origshape = fits[0].data.shape
         header, data = flatten(fits)
         sum_before = np.sum(data)
-        if op=='AND': total_mask = np.ones(shape=data.shape).astype(bool)
-        if op=='OR': total_mask = np.zeros(shape=data.shape).astype(bool)
-        for this_region in region:
-            # extract mask
-            r = pyregion.open(this_region)
-            mask = r.get_mask(header=header, shape=data.shape)
-            if op=='AND': total_mask = total_mask & mask
-            if op=='OR': total_mask = total_mask | mask
+        total_mask = get_region_mask(region, header, data.shape, op=op)
         if inverse: total_mask = ~total_mask
         data[total_mask] = blankval
         # save fits
@@ -213,14 +259,16 @@ def blank_image_reg(filename, region, outfile=None, inverse=False, blankval=0.,
     logger.debug("%s: Blanking (%s): sum of values: %f -> %f" % (filename, region, sum_before, np.sum(data)))
 
 
-def get_noise_img(filename, boxsize=None, niter=20, eps=1e-5):
+def get_noise_img(filename, boxsize=None, niter=20, eps=1e-5, sample=1000000):
     """
     Return the rms of all the pixels in an image
     boxsize : limit to central box of this pixelsize
     niter : robust rms estimation
     eps : convergency
+    sample : max number of pixels used, None for all
     """
     import astropy.io.fits as pyfits
+    from lib_noise import robust_rms
     with pyfits.open(filename) as fits:
         data = fits[0].data
         if boxsize is None:
@@ -228,19 +276,11 @@ def get_noise_img(filename, boxsize=None, niter=20, eps=1e-5):
         else:
            if len(data.shape)==4:
                 _,_,ys,xs = data.shape
-                subim = data[0,0,ys/2-boxsize/2:ys/2+boxsize/2,xs/2-boxsize/2:xs/2+boxsize/2].flatten()
+                subim = data[0,0,ys/2-boxsize/2:ys/2+boxsize/2,xs/2-boxsize/2:xs/2+boxsize/2]
            else:
                 ys,xs = data.shape
-                subim = data[ys/2-boxsize/2:ys/2+boxsize/2,xs/2-boxsize/2:xs/2+boxsize/2].flatten()
-        oldrms = 1.
-        for i in range(niter):
-            rms = np.nanstd(subim)
-            #print len(subim),rms
-            if np.abs(oldrms-rms)/rms < eps:
-                return rms
-            subim=subim[np.abs(subim)<5*rms]
-            oldrms=rms
-        raise Exception('Failed to converge')
+                subim = data[ys/2-boxsize/2:ys/2+boxsize/2,xs/2-boxsize/2:xs/2+boxsize/2]
+        return robust_rms(subim, nsigma=5., niter=niter, eps=eps, sample=sample)
 
 #def nan2zeros(filename):
 #    """
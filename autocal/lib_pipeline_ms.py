@@ -41,6 +41,80 @@ class AllMss(object):
         self.s.run(check=True)
 
     
+# metadata of the MSs, read once from the subtables and cached in memory and in the MS dir,
+# as long as the tables are not modified
+metadata_version = 1
+metadata_file = 'pill-metadata.pickle'
+metadata_cache = {}
+
+def table_mtime(ms):
+    """
+    Return the last modification time of the MS main table and of the subtables used for the metadata
+    """
+    mtimes = [os.path.getmtime(ms+'/table.dat')]
+    for subtable in ['SPECTRAL_WINDOW', 'FIELD', 'OBSERVATION']:
+        for f in os.listdir(ms+'/'+subtable):
+            mtimes.append(os.path.getmtime(ms+'/'+subtable+'/'+f))
+    return max(mtimes)
+
+
+def read_metadata(ms, nsample=10000):
+    """
+    Read the metadata of ms from its subtables
+    the time interval is derived from the TIME of the first nsample rows
+    """
+    meta = {}
+    with tb.table(ms+'/SPECTRAL_WINDOW', ack=False) as t:
+        meta['nchan'] = t.getcol('NUM_CHAN')
+        meta['chan_width'] = t.getcol('CHAN_WIDTH')[0]
+    with tb.table(ms+'/FIELD', ack=False) as t:
+        meta['phase_dir'] = t.getcol('PHASE_DIR')[0,0]
+    with tb.table(ms+'/OBSERVATION', ack=False) as t:
+        meta['time_range'] = t.getcol('TIME_RANGE')[0]
+    with tb.table(ms, ack=False) as t:
+        times = np.unique(t.getcol('TIME', nrow=min(nsample, t.nrows())))
+        if len(times) < 2: times = np.unique(t.getcol('TIME')) # more than nsample rows per timeslot
+    # time range / number of timeslots, as counting all the times in the MS (assumes no missing timeslots)
+    timespan = meta['time_range'][1]-meta['time_range'][0]
+    if len(times) < 2: meta['timeint'] = timespan
+    else: meta['timeint'] = timespan/max(round(timespan/np.min(np.diff(times))), 1)
+    return meta
+
+
+def get_metadata(ms):
+    """
+    Return a dict with the metadata of ms (nchan, chan_width, phase_dir, time_range, timeint),
+    cached in memory and on disk (ms/pill-metadata.pickle) with the modification time of the tables
+    """
+    import pickle
+    key = (metadata_version, table_mtime(ms))
+    ms = os.path.abspath(ms)
+    if ms in metadata_cache and metadata_cache[ms][0] == key:
+        return metadata_cache[ms][1]
+
+    cachefile = ms+'/'+metadata_file
+    meta = None
+    if os.path.exists(cachefile):
+        try:
+            with open(cachefile, 'rb') as f:
+                cachekey, meta = pickle.load(f)
+            if cachekey != key: meta = None
+        except Exception as e:
+            logger.warning('%s: cannot read metadata cache (%s).' % (ms, e))
+            meta = None
+
+    if meta is None:
+        meta = read_metadata(ms)
+        try:
+            with open(cachefile, 'wb') as f:
+                pickle.dump((key, meta), f, 2)
+        except (IOError, OSError) as e:
+            logger.debug('%s: cannot write metadata cache (%s).' % (ms, e))
+
+    metadata_cache[ms] = (key, meta)
+    return meta
+
+
 class Ms(object):
 
     def __init__(self, filename):
@@ -66,10 +140,9 @@ class Ms(object):
         """
         Find number of channels
         """
-        with tb.table(self.ms+'/SPECTRAL_WINDOW', ack=False) as t:
-            nchan = t.getcol('NUM_CHAN')
+        nchan = get_metadata(self.ms)['nchan']
         assert (nchan[0] == nchan).all() # all spw have same channels?
-        logger.debug('%s: Number of channels: %i' (self.ms, nchan[0]))
+        logger.debug('%s: Number of channels: %i' % (self.ms, nchan[0]))
         return nchan[0]
     
     
@@ -77,10 +150,9 @@ class Ms(object):
         """
         Find bandwidth of a channel in Hz
         """
-        with tb.table(self.ms+'/SPECTRAL_WINDOW', ack=False) as t:
-            chan_w = t.getcol('CHAN_WIDTH')[0]
+        chan_w = get_metadata(self.ms)['chan_width']
         assert all(x==chan_w[0] for x in chan_w) # all chans have same width
-        logger.debug('%s: Chan-width: %f MHz' (self.ms, chan_w[0]/1.e6))
+        logger.debug('%s: Chan-width: %f MHz' % (self.ms, chan_w[0]/1.e6))
         return chan_w[0]
     
     
@@ -88,11 +160,8 @@ class Ms(object):
         """
         Get time interval in seconds
         """
-        with tb.table(self.ms, ack=False) as t:
-            Ntimes = len(set(t.getcol('TIME')))
-        with tb.table(self.ms+'/OBSERVATION', ack=False) as t:
-            deltat = (t.getcol('TIME_RANGE')[0][1]-t.getcol('TIME_RANGE')[0][0])/Ntimes
-        logger.debug('%s: Time interval: %f s' (self.ms, deltat))
+        deltat = get_metadata(self.ms)['timeint']
+        logger.debug('%s: Time interval: %f s' % (self.ms, deltat))
         return deltat
     
     
@@ -101,13 +170,8 @@ class Ms(object):
         Get the phase centre of the first source (is it a problem?) of an MS
         values in deg
         """
-        field_no = 0
-        ant_no = 0
-        with tb.table(self.ms + '/FIELD', ack=False) as field_table:
-            direction = field_table.getcol('PHASE_DIR')
-            ra = direction[ ant_no, field_no, 0 ]
-            dec = direction[ ant_no, field_no, 1 ]
-        logger.debug('%s: Phase centre: %f deg - %f deg' (self.ms, ra*180/np.pi, dec*180/np.pi))
+        ra, dec = get_metadata(self.ms)['phase_dir']
+        logger.debug('%s: Phase centre: %f deg - %f deg' % (self.ms, ra*180/np.pi, dec*180/np.pi))
         if ra < 0: ra += 2*np.pi
         return (ra*180/np.pi, dec*180/np.pi)
 
@@ -116,8 +180,7 @@ def find_nchan(ms):
     """
     Find number of channel in this ms
     """
-    with tb.table(ms+'/SPECTRAL_WINDOW', ack=False) as t:
-        nchan = t.getcol('NUM_CHAN')
+    nchan = get_metadata(ms)['nchan']
     assert (nchan[0] == nchan).all() # all spw have same channels?
     logger.debug('Channel in '+ms+': '+str(nchan[0]))
     return nchan[0]
@@ -127,8 +190,7 @@ def find_chanband(ms):
     """
     Find bandwidth of a channel
     """
-    with tb.table(ms+'/SPECTRAL_WINDOW', ack=False) as t:
-        chan_w = t.getcol('CHAN_WIDTH')[0]
+    chan_w = get_metadata(ms)['chan_width']
     assert all(x==chan_w[0] for x in chan_w) # all chans have same width
     logger.debug('Channel width in '+ms+': '+str(chan_w[0]/1e6)+' MHz')
     return chan_w[0]
@@ -138,10 +200,7 @@ def find_timeint(ms):
     """
     Get time interval in seconds
     """
-    with tb.table(ms, ack=False) as t:
-        Ntimes = len(set(t.getcol('TIME')))
-    with tb.table(ms+'/OBSERVATION', ack=False) as t:
-        deltat = (t.getcol('TIME_RANGE')[0][1]-t.getcol('TIME_RANGE')[0][0])/Ntimes
+    deltat = get_metadata(ms)['timeint']
     logger.debug('Time interval for '+ms+': '+str(deltat))
     return deltat
 
@@ -151,11 +210,5 @@ def get_phase_centre(ms):
     Get the phase centre of the first source (is it a problem?) of an MS
     values in deg
     """
-    field_no = 0
-    ant_no = 0
-    with tb.table(ms + '/FIELD', ack=False) as field_table:
-        direction = field_table.getcol('PHASE_DIR')
-        ra = direction[ ant_no, field_no, 0 ]
-        dec = direction[ ant_no, field_no, 1 ]
+    ra, dec = get_metadata(ms)['phase_dir']
     return (ra*180/np.pi, dec*180/np.pi)
-
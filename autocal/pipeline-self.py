@@ -11,6 +11,9 @@
 # last high/low resolution models are copied in the "self/models" dir
 # last high/low resolution images + masks + empty images (CORRECTED_DATA) are copied in the "self/images" dir
 # h5parm solutions and plots are copied in the "self/solutions" dir
+# Resume:
+# finished jobs and steps are recorded in pipeline-self.journal, a rerun skips them and starts from the first one left to do
+# remove pipeline-self.journal to start from scratch
 
 import sys, os, glob, re
 import numpy as np
@@ -63,18 +66,20 @@ def ft_model_wsclean(mss, imagename, c, user_mask = None, keep_in_beam=True, res
     # remove CC not in mask
     logger.info('Predict (mask)...')
     maskname = imagename+'-mask.fits'
-    make_mask(image_name = imagename+'-MFS-image.fits', mask_name = maskname, threshisl = 5, atrous_do=True)
-    if user_mask is not None: 
-        blank_image_reg(maskname, user_mask, inverse=False, blankval=1)
-    blank_image_reg(maskname, 'self/beam.reg', inverse=keep_in_beam)
-    for modelname in sorted(glob.glob(imagename+'*model.fits')):
-        blank_image_fits(modelname, maskname, inverse=True)
+    if not s.skip_step('mask '+imagename+' models keep_in_beam='+str(keep_in_beam)):
+        make_mask(image_name = imagename+'-MFS-image.fits', mask_name = maskname, threshisl = 5, atrous_do=True)
+        if user_mask is not None: 
+            blank_image_reg(maskname, user_mask, inverse=False, blankval=1)
+        blank_image_reg(maskname, 'self/beam.reg', inverse=keep_in_beam)
+        for modelname in sorted(glob.glob(imagename+'*model.fits')):
+            blank_image_fits(modelname, maskname, inverse=True)
 
     if resamp is not None:
         logger.info('Predict (resamp)...')
         for model in sorted(glob.glob(imagename+'*model.fits')):
             model_out = model.replace(imagename, imagename+'-resamp')
-            s.add('/home/fdg/opt/src/nnradd/build/nnradd '+resamp+' '+model_out+' '+model, log='resamp-c'+str(c)+'.log', log_append=True, cmd_type='general')
+            s.add('/home/fdg/opt/src/nnradd/build/nnradd '+resamp+' '+model_out+' '+model, log='resamp-c'+str(c)+'.log', log_append=True, cmd_type='general', \
+                    inputs=[model], outputs=[model_out])
         s.run(check=True)
         imagename = imagename+'-resamp'
  
@@ -101,27 +106,30 @@ def ft_model_cc(mss, imagename, c, user_mask = None, keep_in_beam=True, model_co
     skymodel_cut = imagename+'-sources-cut.txt'
     skydb = imagename+'-sources.skydb'
 
-    # prepare mask
-    if not os.path.exists(maskname):
-        logger.info('Predict (make mask)...')
-        make_mask(image_name = imagename+'-MFS-image.fits', mask_name = maskname, threshisl = 5, atrous_do=True)
-    if user_mask is not None:
-        blank_image_reg(maskname, user_mask, inverse=False, blankval=1) # set to 1 pixels into user_mask
-    blank_image_reg(maskname, 'self/beam.reg', inverse=keep_in_beam, blankval=0) # if keep_in_beam set to 0 everything outside beam.reg
-
-    # apply mask
-    logger.info('Predict (apply mask)...')
-    lsm = lsmtool.load(skymodel)
-    lsm.select('%s == True' % maskname)
-    fluxes = lsm.getColValues('I')
-    #lsm.remove(np.abs(fluxes) < 5e-4) # TEST
-    lsm.write(skymodel_cut, format='makesourcedb', clobber=True)
-    del lsm
+    if not s.skip_step('mask and cut '+skymodel+' keep_in_beam='+str(keep_in_beam)):
+        # prepare mask
+        if not os.path.exists(maskname):
+            logger.info('Predict (make mask)...')
+            make_mask(image_name = imagename+'-MFS-image.fits', mask_name = maskname, threshisl = 5, atrous_do=True)
+        if user_mask is not None:
+            blank_image_reg(maskname, user_mask, inverse=False, blankval=1) # set to 1 pixels into user_mask
+        blank_image_reg(maskname, 'self/beam.reg', inverse=keep_in_beam, blankval=0) # if keep_in_beam set to 0 everything outside beam.reg
+
+        # apply mask
+        logger.info('Predict (apply mask)...')
+        lsm = lsmtool.load(skymodel)
+        lsm.select('%s == True' % maskname)
+        fluxes = lsm.getColValues('I')
+        #lsm.remove(np.abs(fluxes) < 5e-4) # TEST
+        lsm.write(skymodel_cut, format='makesourcedb', clobber=True)
+        del lsm
+
+        check_rm(skydb)
 
     # convert to skydb
     logger.info('Predict (makesourcedb)...')
-    check_rm(skydb)
-    s.add('makesourcedb outtype="blob" format="<" in="'+skymodel_cut+'" out="'+skydb+'"', log='makesourcedb-c'+str(c)+'.log', cmd_type='general')
+    s.add('makesourcedb outtype="blob" format="<" in="'+skymodel_cut+'" out="'+skydb+'"', log='makesourcedb-c'+str(c)+'.log', cmd_type='general', \
+            inputs=[skymodel_cut], outputs=[skydb])
     s.run(check=True)
 
     # predict
@@ -135,29 +143,31 @@ def ft_model_cc(mss, imagename, c, user_mask = None, keep_in_beam=True, model_co
 #############################################################################
 
 logger = set_logger('pipeline-self.logger')
-check_rm('logs')
-s = Scheduler(dry=False)
+s = Scheduler(dry=False, journal='pipeline-self.journal')
 
 ##################################################
-# Clear
-logger.info('Cleaning...')
+# Clear (not when resuming)
+if not s.skip_step('clean'):
+    logger.info('Cleaning...')
 
-check_rm('img')
-os.makedirs('img')
-os.makedirs('logs/mss')
+    check_rm('logs')
+    check_rm('img')
+    os.makedirs('img')
+    os.makedirs('logs/mss')
 
-# here images, models, solutions for each group will be saved
-check_rm('self')
-if not os.path.exists('self/images'): os.makedirs('self/images')
-if not os.path.exists('self/solutions'): os.makedirs('self/solutions')
+    # here images, models, solutions for each group will be saved
+    check_rm('self')
+    if not os.path.exists('self/images'): os.makedirs('self/images')
+    if not os.path.exists('self/solutions'): os.makedirs('self/solutions')
 
 mss = sorted(glob.glob('mss/TC*[0-9].MS'))
 concat_ms = 'mss/concat.MS'
 
 # make beam
 phasecentre = get_phase_centre(mss[0])
-make_beam_reg(phasecentre[0], phasecentre[1], 12, 'self/beam.reg') # go to 7 deg, first null
-#make_beam_reg(phasecentre[0], phasecentre[1], 8, 'self/beam.reg') # go to 7 deg, first null
+if not s.skip_step('beam'):
+    make_beam_reg(phasecentre[0], phasecentre[1], 12, 'self/beam.reg') # go to 7 deg, first null
+    #make_beam_reg(phasecentre[0], phasecentre[1], 8, 'self/beam.reg') # go to 7 deg, first null
 
 ###############################################################################################
 # Create columns (non compressed)
@@ -171,6 +181,7 @@ s.run(check=True)
 # copy sourcedb into each MS to prevent concurrent access from multiprocessing to the sourcedb
 sourcedb_basename = sourcedb.split('/')[-1]
 for ms in mss:
+    if s.skip_step('copy '+sourcedb+' -> '+ms): continue
     check_rm(ms+'/'+sourcedb_basename)
     logger.debug('Copy: '+sourcedb+' -> '+ms)
     os.system('cp -r '+sourcedb+' '+ms)
@@ -186,7 +197,6 @@ s.run(check=True)
 # Preapre fake FR parmdb
 logger.info('Prepare fake FR parmdb...')
 for ms in mss:
-    if os.path.exists(ms+'/instrument-fr'): continue
     s.add('calibrate-stand-alone -f --parmdb-name instrument-fr '+ms+' '+parset_dir+'/bbs-fakeparmdb-fr.parset '+skymodel, log=ms+'_fakeparmdb-fr.log', cmd_type='BBS')
 s.run(check=True)
 for ms in mss:
@@ -211,16 +221,17 @@ for c in xrange(niter):
         s.add('BLsmooth.py -r -f 0.2 -i '+incol+' -o SMOOTHED_DATA '+ms, log=ms+'_smooth1-c'+str(c)+'.log', cmd_type='python')
     s.run(check=True, max_threads=6)
 
-    logger.info('Concatenating TCs...')
-    check_rm(concat_ms+'*')
-    pt.msutil.msconcat(mss, concat_ms, concatTime=False)
+    if not s.skip_step('concat c'+str(c)):
+        logger.info('Concatenating TCs...')
+        check_rm(concat_ms+'*')
+        pt.msutil.msconcat(mss, concat_ms, concatTime=False)
 
     # solve TEC - group*_TC.MS:SMOOTHED_DATA
     logger.info('Solving TEC...')
     for ms in mss:
-        check_rm(ms+'/instrument-tec')
+        if not s.skip_step('rm '+ms+'/instrument-tec'): check_rm(ms+'/instrument-tec')
         s.add('NDPPP '+parset_dir+'/NDPPP-solTEC.parset msin='+ms+' sol.parmdb='+ms+'/instrument-tec', \
-                log=ms+'_solTEC-c'+str(c)+'.log', cmd_type='NDPPP')
+                log=ms+'_solTEC-c'+str(c)+'.log', cmd_type='NDPPP', outputs=[ms+'/instrument-tec'])
     s.run(check=True)
 
     # LoSoTo plot
@@ -229,8 +240,9 @@ for c in xrange(niter):
             run_losoto(s, 'tec'+str(c)+'-ms'+str(i), [ms], [parset_dir+'/losoto-plot.parset'], ininstrument='instrument-tec', putback=False)
     else:
         run_losoto(s, 'tec'+str(c), mss, [parset_dir+'/losoto-plot.parset'], ininstrument='instrument-tec', putback=False)
-    os.system('mv plots-tec'+str(c)+'* self/solutions/')
-    os.system('mv cal-tec'+str(c)+'*.h5 self/solutions/')
+    if not s.skip_step('save solutions tec'+str(c)):
+        os.system('mv plots-tec'+str(c)+'* self/solutions/')
+        os.system('mv cal-tec'+str(c)+'*.h5 self/solutions/')
 
     # correct TEC - group*_TC.MS:(SUBTRACTED_)DATA -> group*_TC.MS:CORRECTED_DATA
     logger.info('Correcting TEC...')
@@ -259,9 +271,9 @@ for c in xrange(niter):
         # Solve G SB.MS:SMOOTHED_DATA (only solve)
         logger.info('Solving G...')
         for ms in mss:
-            check_rm(ms+'/instrument-g')
+            if not s.skip_step('rm '+ms+'/instrument-g'): check_rm(ms+'/instrument-g')
             s.add('NDPPP '+parset_dir+'/NDPPP-solG.parset msin='+ms+' sol.parmdb='+ms+'/instrument-g sol.solint=30 sol.nchan=8', \
-                    log=ms+'_sol-g1-c'+str(c)+'.log', cmd_type='NDPPP')
+                    log=ms+'_sol-g1-c'+str(c)+'.log', cmd_type='NDPPP', outputs=[ms+'/instrument-g'])
         s.run(check=True)
 
         if multiepoch:
@@ -271,8 +283,9 @@ for c in xrange(niter):
         else:
             run_losoto(s, 'fr'+str(c), mss, [parset_dir+'/losoto-fr.parset'], ininstrument='instrument-g', inglobaldb='globaldb',
             outinstrument='instrument-fr', outglobaldb='globaldb-fr', outtab='rotationmeasure000', putback=True)
-        os.system('mv plots-fr'+str(c)+'* self/solutions/')
-        os.system('mv cal-fr'+str(c)+'*.h5 self/solutions/')
+        if not s.skip_step('save solutions fr'+str(c)):
+            os.system('mv plots-fr'+str(c)+'* self/solutions/')
+            os.system('mv cal-fr'+str(c)+'*.h5 self/solutions/')
        
         # To linear - SB.MS:CORRECTED_DATA -> SB.MS:CORRECTED_DATA (linear)
         logger.info('Convert to linear...')
@@ -295,9 +308,9 @@ for c in xrange(niter):
         # Solve G SB.MS:SMOOTHED_DATA (only solve)
         logger.info('Solving G...')
         for ms in mss:
-            check_rm(ms+'/instrument-g')
+            if not s.skip_step('rm '+ms+'/instrument-g'): check_rm(ms+'/instrument-g')
             s.add('NDPPP '+parset_dir+'/NDPPP-solG.parset msin='+ms+' sol.parmdb='+ms+'/instrument-g sol.solint=30 sol.nchan=8', \
-                    log=ms+'_sol-g2-c'+str(c)+'.log', cmd_type='NDPPP')
+                    log=ms+'_sol-g2-c'+str(c)+'.log', cmd_type='NDPPP', outputs=[ms+'/instrument-g'])
         s.run(check=True)
 
         if multiepoch:
@@ -307,8 +320,9 @@ for c in xrange(niter):
         else:
             run_losoto(s, 'cd'+str(c), mss, [parset_dir+'/losoto-cd.parset'], ininstrument='instrument-g', inglobaldb='globaldb',
                 outinstrument='instrument-cd', outglobaldb='globaldb', outtab='amplitude000,crossdelay', putback=True)
-        os.system('mv plots-cd'+str(c)+'* self/solutions/')
-        os.system('mv cal-cd'+(str(c))+'*.h5 self/solutions/')
+        if not s.skip_step('save solutions cd'+str(c)):
+            os.system('mv plots-cd'+str(c)+'* self/solutions/')
+            os.system('mv cal-cd'+(str(c))+'*.h5 self/solutions/')
 
         if multiepoch:
             for i, ms in enumerate(mss):
@@ -317,8 +331,9 @@ for c in xrange(niter):
         else:
             run_losoto(s, 'amp'+str(c), mss, [parset_dir+'/losoto-amp.parset'], ininstrument='instrument-g', inglobaldb='globaldb',
                 outinstrument='instrument-amp', outglobaldb='globaldb', outtab='amplitude000,phase000', putback=True)
-        os.system('mv plots-amp'+str(c)+'* self/solutions/')
-        os.system('mv cal-amp'+str(c)+'*.h5 self/solutions/')
+        if not s.skip_step('save solutions amp'+str(c)):
+            os.system('mv plots-amp'+str(c)+'* self/solutions/')
+            os.system('mv cal-amp'+str(c)+'*.h5 self/solutions/')
 
         # Correct CD SB.MS:SUBTRACTED_DATA->CORRECTED_DATA
         logger.info('Cross-delay correction...')
@@ -346,9 +361,9 @@ for c in xrange(niter):
         # solve TEC - group*_TC.MS:SMOOTHED_DATA
         logger.info('Solving TEC...')
         for ms in mss:
-            check_rm(ms+'/instrument-tec')
+            if not s.skip_step('rm '+ms+'/instrument-tec'): check_rm(ms+'/instrument-tec')
             s.add('NDPPP '+parset_dir+'/NDPPP-solTEC.parset msin='+ms+' sol.parmdb='+ms+'/instrument-tec', \
-                    log=ms+'_solTEC-c'+str(c)+'.log', cmd_type='NDPPP')
+                    log=ms+'_solTEC-c'+str(c)+'.log', cmd_type='NDPPP', outputs=[ms+'/instrument-tec'])
         s.run(check=True)
 
         # LoSoTo plot
@@ -357,8 +372,9 @@ for c in xrange(niter):
                 run_losoto(s, 'tec'+str(c)+'b-ms'+str(i), [ms], [parset_dir+'/losoto-plot.parset'], ininstrument='instrument-tec', putback=False)
         else:
             run_losoto(s, 'tec'+str(c)+'b', mss, [parset_dir+'/losoto-plot.parset'], ininstrument='instrument-tec', putback=False)
-        os.system('mv plots-tec'+str(c)+'b* self/solutions')
-        os.system('mv cal-tec'+str(c)+'b*.h5 self/solutions')
+        if not s.skip_step('save solutions tec'+str(c)+'b'):
+            os.system('mv plots-tec'+str(c)+'b* self/solutions')
+            os.system('mv cal-tec'+str(c)+'b*.h5 self/solutions')
 
         # correct TEC - group*_TC.MS:CORRECTED_DATA -> group*_TC.MS:CORRECTED_DATA
         logger.info('Correcting TEC...')
@@ -379,7 +395,7 @@ for c in xrange(niter):
                 -scale 8arcsec -weight briggs 0.0 -auto-mask 10 -auto-threshold 1 -niter 100000 -no-update-model-required -mgain 0.8 \
                 -multiscale -multiscale-scale-bias 0.5 -multiscale-scales 0,3,9 \
                 -pol I -joinchannels -fit-spectral-pol 2 -channelsout 10 -apply-primary-beam -use-differential-lofar-beam -minuv-l 30 '+' '.join(mss), \
-                log='wscleanBeam-c'+str(c)+'.log', cmd_type='wsclean', processors='max')
+                log='wscleanBeam-c'+str(c)+'.log', cmd_type='wsclean', processors='max', outputs=[imagename+'-MFS-image.fits'])
         s.run(check=True)
 
         logger.info('Cleaning beam high-res (cycle: '+str(c)+')...')
@@ -388,7 +404,7 @@ for c in xrange(niter):
                 -scale 4arcsec -weight briggs -1.5 -auto-mask 10 -auto-threshold 1 -niter 100000 -no-update-model-required -mgain 0.8 \
                 -multiscale -multiscale-scale-bias 0.5 -multiscale-scales 0,3,9 \
                 -pol I -joinchannels -fit-spectral-pol 2 -channelsout 10 -apply-primary-beam -use-differential-lofar-beam -minuv-l 30 '+' '.join(mss), \
-                log='wscleanBeamHR-c'+str(c)+'.log', cmd_type='wsclean', processors='max')
+                log='wscleanBeamHR-c'+str(c)+'.log', cmd_type='wsclean', processors='max', outputs=[imagename+'-MFS-image.fits'])
         s.run(check=True)
 
     # clean mask clean (cut at 5k lambda)
@@ -398,13 +414,14 @@ for c in xrange(niter):
     s.add('wsclean -reorder -name ' + imagename + ' -size 4000 4000 -trim 3500 3500 -mem 90 -j '+str(s.max_processors)+' -baseline-averaging 2.0 \
             -scale 12arcsec -weight briggs 0.0 -niter 100000 -no-update-model-required -maxuv-l 5000 -mgain 0.9 \
             -pol I -joinchannels -fit-spectral-pol 2 -channelsout 10 -auto-threshold 20 -minuv-l 30 '+' '.join(mss), \
-            log='wsclean-c'+str(c)+'.log', cmd_type='wsclean', processors='max')
+            log='wsclean-c'+str(c)+'.log', cmd_type='wsclean', processors='max', outputs=[imagename+'-MFS-image.fits'])
     s.run(check=True)
 
     maskname = imagename+'-mask.fits'
-    make_mask(image_name = imagename+'-MFS-image.fits', mask_name = maskname, threshisl = 3, atrous_do=True)
-    if user_mask is not None: 
-        blank_image_reg(maskname, user_mask, inverse=False, blankval=1)
+    if not s.skip_step('mask '+maskname):
+        make_mask(image_name = imagename+'-MFS-image.fits', mask_name = maskname, threshisl = 3, atrous_do=True)
+        if user_mask is not None: 
+            blank_image_reg(maskname, user_mask, inverse=False, blankval=1)
 
     logger.info('Cleaning w/ mask (cycle: '+str(c)+')...')
     imagename = 'img/wideM-'+str(c)
@@ -415,14 +432,16 @@ for c in xrange(niter):
             -scale 12arcsec -weight briggs 0.0 -niter 1000000 -no-update-model-required -maxuv-l 5000 -mgain 0.8 \
             -multiscale -multiscale-scale-bias 0.5 -multiscale-scales 0,3,9 \
             -pol I -joinchannels -fit-spectral-pol 2 -channelsout 10 -auto-threshold 0.1 -minuv-l 30 -save-source-list -fitsmask '+maskname+' '+' '.join(mss), \
-            log='wscleanM-c'+str(c)+'.log', cmd_type='wsclean', processors='max')
+            log='wscleanM-c'+str(c)+'.log', cmd_type='wsclean', processors='max', \
+            inputs=[maskname], outputs=[imagename+'-MFS-image.fits', imagename+'-sources.txt'])
     else:
         #s.add('wsclean -reorder -name ' + imagename + ' -size 3000 3000 -trim 2500 2500 -mem 90 -j '+str(s.max_processors)+' -baseline-averaging 2.0 \
         s.add('wsclean -reorder -name ' + imagename + ' -size 4000 4000 -trim 3500 3500 -mem 90 -j '+str(s.max_processors)+' -baseline-averaging 2.0 \
             -scale 12arcsec -weight briggs 0.0 -niter 1000000 -no-update-model-required -maxuv-l 5000 -mgain 0.8 \
             -multiscale -multiscale-scale-bias 0.5 -multiscale-scales 0,3,9 \
             -pol I -joinchannels -fit-spectral-pol 2 -channelsout 10 -auto-threshold 0.1 -minuv-l 30 -fitsmask '+maskname+' '+' '.join(mss), \
-            log='wscleanM-c'+str(c)+'.log', cmd_type='wsclean', processors='max')
+            log='wscleanM-c'+str(c)+'.log', cmd_type='wsclean', processors='max', \
+            inputs=[maskname], outputs=[imagename+'-MFS-image.fits'])
     s.run(check=True)
     os.system('cat logs/wscleanM-c'+str(c)+'.log | grep "background noise"')
 
@@ -450,12 +469,12 @@ for c in xrange(niter):
             s.add('wsclean -reorder -name ' + imagename_lr + ' -size 4500 4500 -trim 4000 4000 -mem 90 -j '+str(s.max_processors)+' -baseline-averaging 2.0 \
                 -scale 20arcsec -weight briggs 0.0 -niter 100000 -no-update-model-required -maxuv-l 2000 -mgain 0.8 \
                 -pol I -joinchannels -fit-spectral-pol 2 -channelsout 10 -auto-threshold 1 -minuv-l 100 -save-source-list '+' '.join(mss), \
-                log='wsclean-lr.log', cmd_type='wsclean', processors='max')
+                log='wsclean-lr.log', cmd_type='wsclean', processors='max', outputs=[imagename_lr+'-MFS-image.fits', imagename_lr+'-sources.txt'])
         else:
             s.add('wsclean -reorder -name ' + imagename_lr + ' -size 4500 4500 -trim 4000 4000 -mem 90 -j '+str(s.max_processors)+' -baseline-averaging 2.0 \
                 -scale 20arcsec -weight briggs 0.0 -niter 100000 -no-update-model-required -maxuv-l 2000 -mgain 0.8 \
                 -pol I -joinchannels -fit-spectral-pol 2 -channelsout 10 -auto-threshold 1 -minuv-l 100 '+' '.join(mss), \
-                log='wsclean-lr.log', cmd_type='wsclean', processors='max')
+                log='wsclean-lr.log', cmd_type='wsclean', processors='max', outputs=[imagename_lr+'-MFS-image.fits'])
         s.run(check=True)
        
         if cc_predict:
@@ -488,15 +507,17 @@ for c in xrange(niter):
     #    s.add('NDPPP '+parset_dir+'/NDPPP-flag.parset msin='+ms, log=ms+'_flag-c'+str(c)+'.log', cmd_type='NDPPP')
     #s.run(check=True
     
-# make beam
-# TODO: remove when wsclean will produce a proper primary beam
-os.system('~/opt/src/makeavgpb/build/wsbeam.py img/wideBeam')
-
-# Copy images
-[ os.system('mv img/wideM-'+str(c)+'-MFS-image.fits self/images') for c in xrange(niter) ]
-if cc_predict: [ os.system('mv img/wideM-'+str(c)+'-sources.txt self/images') for c in xrange(niter) ]
-os.system('mv img/wide-lr-MFS-image.fits self/images')
-os.system('mv img/wideBeam-MFS-image.fits  img/wideBeam-MFS-image-pb.fits self/images')
-os.system('mv logs self')
+if not s.skip_step('save images'):
+    # make beam
+    # TODO: remove when wsclean will produce a proper primary beam
+    os.system('~/opt/src/makeavgpb/build/wsbeam.py img/wideBeam')
+
+    # Copy images
+    [ os.system('mv img/wideM-'+str(c)+'-MFS-image.fits self/images') for c in xrange(niter) ]
+    if cc_predict: [ os.system('mv img/wideM-'+str(c)+'-sources.txt self/images') for c in xrange(niter) ]
+    os.system('mv img/wide-lr-MFS-image.fits self/images')
+    os.system('mv img/wideBeam-MFS-image.fits  img/wideBeam-MFS-image-pb.fits self/images')
+    os.system('mv logs self')
+    s.flush_steps()
 
 logger.info("Done.")
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# run fake "sleep" jobs through the Scheduler and report their peak concurrency (jobs, cores, memory)
+# to check how jobs are packed on the node budget
+# scheduler-check.py --max_processors 12 --max_memory 32 1,8,20,3 20,1,1,1 4,max,0,1
+# each job group is count,cores,mem(GB),seconds, cores can be "max"
+
+import sys, os, tempfile, shutil, json, optparse
+from autocal.lib_pipeline import *
+
+opt = optparse.OptionParser(usage='%prog [options] count,cores,mem,seconds ...')
+opt.add_option('--max_processors', type='int', default=12, help='Cores of the node [default: 12]')
+opt.add_option('--max_memory', type='float', default=32., help='Memory of the node in GB [default: 32]')
+opt.add_option('--max_threads', type='int', default=64, help='Max number of parallel jobs [default: 64]')
+o, args = opt.parse_args()
+if len(args) == 0: args = ['1,8,20,3', '20,1,1,1', '4,max,0,1']
+
+logger = set_logger('scheduler-check.logging')
+
+wkd = tempfile.mkdtemp(prefix='scheduler-check-')
+cwd = os.getcwd()
+os.chdir(wkd)
+try:
+    s = Scheduler(qsub=False, max_threads=o.max_threads, max_processors=o.max_processors, max_memory=o.max_memory, log_dir='logs')
+    for group in args:
+        count, cores, mem, seconds = group.split(',')
+        if cores != 'max': cores = int(cores)
+        for i in xrange(int(count)):
+            s.add('sleep '+seconds, log='sleep-'+group+'-'+str(i)+'.log', cmd_type='general', processors=cores, mem=float(mem))
+    s.run(check=False)
+
+    with open(s.report) as f:
+        jobs = [json.loads(line) for line in f]
+finally:
+    os.chdir(cwd)
+    shutil.rmtree(wkd)
+
+# sweep over starts and ends (ends first at the same time)
+events = []
+for job in jobs:
+    events.append((job['start'], 1, job['cores'], job['mem']))
+    events.append((job['start']+job['wall'], -1, -job['cores'], -job['mem']))
+events.sort(key=lambda e: (e[0], e[1]))
+njobs = cores = mem = 0
+peak_jobs = peak_cores = peak_mem = 0
+for t, dj, dc, dm in events:
+    njobs += dj; cores += dc; mem += dm
+    peak_jobs = max(peak_jobs, njobs); peak_cores = max(peak_cores, cores); peak_mem = max(peak_mem, mem)
+wall = max(job['start']+job['wall'] for job in jobs) - min(job['start'] for job in jobs)
+
+print 'Jobs: %i, wall time: %.1f s' % (len(jobs), wall)
+print 'Peak concurrency: %i jobs, %i/%i cores, %.1f/%.1f GB' % (peak_jobs, peak_cores, o.max_processors, peak_mem, o.max_memory)
+if peak_cores > o.max_processors or peak_mem > o.max_memory or peak_jobs > o.max_threads:
+    print 'Node budget exceeded!'
+    sys.exit(1)
@@ -3,7 +3,6 @@
 import os, sys, logging, itertools
 import pyrap.tables as pt
 import numpy as np
-import scipy.optimize
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -18,38 +17,69 @@ mode = 'double'
 timeavg = 1
 freqavg = 4
 solvetec = False
+timechunk = 10 # solution intervals read and solved together
+tecrange = 0.5 # TEC grid search in [-tecrange, +tecrange]
 
-def getPh(phase, antIdx, ant):
+def blMatrix(vals, tidx, antIdx, Ntime, Nant, sign=1):
     """
-    Get the phases relative to an antenna towards all the other antennas "Phi 1->2"
-    The antenna is assumed to be at the first position of the BL ordinament, sign is corrected accordingly
+    Put the values of all BLs (rows, freq) in a (time, ant1, ant2, freq) matrix
+    m[t,1,2] is the value of BL 1->2 and m[t,2,1] = sign * the value of BL 1->2 (sign=-1 for phases "Phi 1->2")
+    autocorrelations get the sign of the "worng" BL direction, missing BLs are 0
     """
-    phase[antIdx[1] == ant] *= -1 # account for "worng" BL direction
-    p = phase[(antIdx[0] == ant) | (antIdx[1] == ant)]
-    phase[antIdx[1] == ant] *= -1 # correct back the values
-    return p
+    m = np.zeros( (Ntime, Nant, Nant, vals.shape[1]), dtype=vals.dtype )
+    m[tidx, antIdx[0], antIdx[1]] = vals
+    m[tidx, antIdx[1], antIdx[0]] = sign * vals
+    return m
 
 
-def getAmp(amp, antIdx, ant, ant2 = None):
+def closurePh(P, W, antRef, antSol):
     """
-    Get the amps relative to an antenna towards all the other antennas "Lambda_12"
-    if ant2 != None: then return only that BL
+    Get the closure phases of antSol relative to antRef
+    P, W: phases "Phi 1->2" and weights of all BLs (time, ant1, ant2, freq)
+    Return phases and weights of all closures (time, freq, closure)
     """
-    if ant2 == None:
-        return amp[(antIdx[0] == ant) | (antIdx[1] == ant)]
-    else:
-        return amp[((antIdx[0] == ant) & (antIdx[1] == ant2)) | ((antIdx[0] == ant2) & (antIdx[1] == ant))]
-
-
-def getWe(weight, antIdx, ant, ant2 = None):
+    if mode == 'double':
+        # (ph_ref - ph_1) - (ph_sol - ph_1)
+        sols = norm( P[:,antRef] - P[:,antSol] )
+        sols_w = ( W[:,antRef] + W[:,antSol] ) /2.
+
+        # if antSol = ant1: p_rs + p_ss = p_rs (single, remove)
+        sols[:,antSol] = 0
+        sols_w[:,antSol] = 0
+        # if antRef = ant1: p_rr + p_rs = p_rs (single, keep)
+        sols_w[:,antRef] = W[:,antRef,antSol] # autocorr gives 0 weight, no /2
+
+    elif mode == 'triple':
+        # p_r1 + p_1r + p_rs = p_rs (single) and p_r1 + p_1s + p_ss = p_r1 + p_1s (double with 1)
+        ants2 = [a for a in xrange(P.shape[1]) if a != antRef and a != antSol]
+        # if ant1 == ant2: fall back in double -> p_r1 + p_11 + p_1s = p_r1 + p_1s (double with 1==2, keep)
+        # (ph_ref - ph_2) + (ph_2 - ph_1) - (ph_sol - ph_1)
+        sols = norm( P[:,antRef,ants2][:,:,np.newaxis] + P[:,ants2] - P[:,np.newaxis,antSol] )
+        sols_w = ( W[:,antRef,ants2][:,:,np.newaxis] + W[:,np.newaxis,antSol] + W[:,np.newaxis,antRef] ) /3.
+        sols = sols.reshape(P.shape[0], -1, P.shape[3])
+        sols_w = sols_w.reshape(P.shape[0], -1, P.shape[3])
+
+    return np.ascontiguousarray(sols.transpose(0,2,1)), np.ascontiguousarray(sols_w.transpose(0,2,1))
+
+
+def closureAmp(A, W, antSol):
     """
-    Get the weight relative to an antenna
-    if ant2 != None: then return only that BL
+    Get the closure amplitudes of antSol: a1S*aS3/a13 = e1 eS eS e3 / e1 e3 = eS**2
+    A, W: amps "Lambda_12" and weights of all BLs (time, ant1, ant2, freq)
+    Return amps and weights of all closures (time, freq, closure)
     """
-    if ant2 == None:
-        return weight[(antIdx[0] == ant) | (antIdx[1] == ant)]
-    else:
-        return weight[((antIdx[0] == ant) & (antIdx[1] == ant2)) | ((antIdx[0] == ant2) & (antIdx[1] == ant))]
+    ants1 = [a for a in xrange(A.shape[1]) if a != antSol] # skip if 1==S
+    amp_1S = A[:,ants1,antSol][:,:,np.newaxis]
+    we_1S = W[:,ants1,antSol][:,:,np.newaxis]
+    sols = 1./np.sqrt( amp_1S * A[:,np.newaxis,antSol] / A[:,ants1] )
+    sols_w = ( we_1S + W[:,np.newaxis,antSol] + W[:,ants1] ) /3.
+
+    # if any antenna of the closure relation is flagged or an autocorrelation, set the weight to 0
+    sols_w[ (W[:,ants1] == 0) | (W[:,np.newaxis,antSol] == 0) | (we_1S == 0) ] = 0
+    sols[ sols_w == 0 ] = 1. # missing BLs
+    sols = sols.reshape(A.shape[0], -1, A.shape[3])
+    sols_w = sols_w.reshape(A.shape[0], -1, A.shape[3])
+    return np.ascontiguousarray(sols.transpose(0,2,1)), np.ascontiguousarray(sols_w.transpose(0,2,1))
 
 
 def norm(phase):
@@ -64,53 +94,89 @@ def norm(phase):
     return out
 
 
-def angMean(angs, weights):
+def angMean(angs, weights, axis=None, keepdims=False):
     """
-    Find the weighted mean of a series of angles
+    Find the weighted mean of a series of angles (along axis)
     """
     #assert len(angs) == len(weight)
     # normalization is unnecessary as we deal with just the angle
-    return np.angle( np.sum( weights * np.exp(1j*np.array(angs)) ))# / ( len(angs) * sum(weight) ) )
+    return np.angle( np.sum( weights * np.exp(1j*np.array(angs)), axis=axis, keepdims=keepdims ))# / ( len(angs) * sum(weight) ) )
 
 
-def angRMS(angs, weights):
+def angRMS(angs, weights, axis=None):
     """
-    Find the weighted rms of a series of angles
+    Find the weighted rms of a series of angles (along axis)
     """
-    diff = angs - angMean(angs, weights)
+    diff = angs - angMean(angs, weights, axis=axis, keepdims=True)
     diff[diff < -np.pi] += 2*np.pi
     diff[diff > np.pi] -= 2*np.pi
-    return np.sqrt( angMean(diff**2, weights) ) # weighted std dev
+    return np.sqrt( angMean(diff**2, weights, axis=axis) ) # weighted std dev
 
 
-def findtec(phases, weights, freq, time, ant):
+def findtec(phases, weights, freq):
     """
-    Find tec
-    time, ant are just for plotting purposes
+    Find tec for many solutions at once
+    phases, weights: (solution, freq) phases to fit and their weights, freq: (freq) frequencies
+    a grid search in [-tecrange, tecrange] finds the deepest minimum then Gauss-Newton iterations refine it
     """
-    # TODO: add weights
-    par1complex = lambda p, freq, phases, weights: ( abs(np.cos(8.44797245e9*p[0]/freq) - np.cos(phases)) +\
-                                            abs(np.sin(8.44797245e9*p[0]/freq) - np.sin(phases)) ) * weights
-#    par2complex = lambda p, freq, phases, weights: ( abs(np.cos(2.*8.44797245e9*p[0]/freq + p[1]) - np.cos(phases)) +\
-#                                                     abs(np.sin(2.*8.44797245e9*p[0]/freq + p[1]) - np.sin(phases)) ) * weights
-    fitresult, success = scipy.optimize.leastsq(par1complex, [0], args=(freq, phases, weights), maxfev=10000)
-#    fitresult, success = scipy.optimize.basinhopping(par1complex, [0], T=1., minimizer_kwargs={'args':(freq, phases, weights)})
-#    fitresult, success = scipy.optimize.leastsq(par1complex, [0,0], args=(freq, phases, weights), maxfev=10000)
-    logging.debug("leastsqr"+str(fitresult))
-    if plotTEC:
-        fig.clf()
-        ax = fig.add_subplot(110)
-        fitfuncfastplot = lambda p, freq: np.mod(8.44797245e9*p[0]/freq + 1.*np.pi, 2.*np.pi) - np.pi
-        ax.plot(freq, np.mod(phases + np.pi, 2.*np.pi) - np.pi, 'or' )
-        TEC = np.mod((-8.44797245e9*(fitresult[0])/freq)+np.pi, 2*np.pi) - np.pi
-        residual = np.mod(phases-TEC+np.pi,2.*np.pi)-np.pi
-        ax.plot(freq, residual, '.', color='yellow')
-        ax.plot(freq, fitfuncfastplot(fitresult, freq), "r-")
-        plt.savefig(ant+'_T'+str(time)+'.png')
-    return fitresult[0]
-
-
-if plotph or plotamp or plotavg or plotall:
+    weights = np.where(np.isfinite(weights), weights, 0)
+    cos_ph = np.cos(phases)
+    sin_ph = np.sin(phases)
+
+    def res(tec, sel):
+        # residuals and their derivatives of the selected solutions
+        th = 8.44797245e9*tec[:,np.newaxis]/freq
+        dc = np.cos(th) - cos_ph[sel]
+        ds = np.sin(th) - sin_ph[sel]
+        r = ( abs(dc) + abs(ds) ) * weights[sel]
+        J = ( -np.sign(dc)*np.sin(th) + np.sign(ds)*np.cos(th) ) * weights[sel] * 8.44797245e9/freq
+        return r, J
+
+    # grid search, step: 0.25 rad at the lowest frequency
+    # sum w**2 |exp(i th) - exp(i ph)|**2 = sum 2 w**2 (1 - cos(th - ph)): the deepest minimum is max Re sum w**2 exp(i (th - ph))
+    step = 0.25*freq.min()/8.44797245e9
+    grid = np.arange(-int(tecrange/step), int(tecrange/step)+1) * step
+    # tec=0 (the old leastsq starting point) wins ties
+    grid = grid[np.argsort(abs(grid), kind='mergesort')]
+    corr = np.dot( weights**2 * np.exp(-1j*phases), np.exp(1j*8.44797245e9*grid[np.newaxis]/freq[:,np.newaxis]) ).real
+    tec = grid[corr.argmax(axis=1)]
+
+    # Gauss-Newton on the solutions still moving, halve the step of those that do not improve
+    sel = np.arange(len(phases))
+    cost = (res(tec, sel)[0]**2).sum(axis=1)
+    scale = np.ones(len(phases))
+    for i in xrange(100):
+        r, J = res(tec[sel], sel)
+        JJ = (J**2).sum(axis=1)
+        dtec = -scale[sel] * (J*r).sum(axis=1) / np.where(JJ > 0, JJ, 1)
+        c = (res(tec[sel] + dtec, sel)[0]**2).sum(axis=1)
+        better = c < cost[sel]
+        tec[sel[better]] += dtec[better]
+        cost[sel[better]] = c[better]
+        scale[sel] = np.where(better, np.minimum(2.*scale[sel], 1.), scale[sel]/2.)
+        sel = sel[abs(dtec) > 1e-9]
+        if len(sel) == 0: break
+
+    logging.debug("Grid+Gauss-Newton: "+str(i)+" iterations")
+    return tec
+
+
+def plottec(phases, freq, tec, name):
+    """
+    Plot a tec solution
+    """
+    fig.clf()
+    ax = fig.add_subplot(111)
+    fitfuncfastplot = lambda tec, freq: np.mod(8.44797245e9*tec/freq + 1.*np.pi, 2.*np.pi) - np.pi
+    ax.plot(freq, np.mod(phases + np.pi, 2.*np.pi) - np.pi, 'or' )
+    TEC = np.mod((-8.44797245e9*tec/freq)+np.pi, 2*np.pi) - np.pi
+    residual = np.mod(phases-TEC+np.pi,2.*np.pi)-np.pi
+    ax.plot(freq, residual, '.', color='yellow')
+    ax.plot(freq, fitfuncfastplot(tec, freq), "r-")
+    plt.savefig(name+'.png')
+
+
+if plotph or plotamp or plotavg or plotall or plotTEC:
     import matplotlib as mpl
     mpl.rc('font',size =8 )
     mpl.rc('figure.subplot',left=0.05, bottom=0.05, right=0.95, top=0.95,wspace=0.22, hspace=0.22)
@@ -142,190 +208,155 @@ logging.info('Open table and fetch data')
 tms = pt.table(ms, readonly=True, ack=False)
 
 # get time
-Ntime = len(set(tms.getcol('TIME')))
+times = tms.getcol('TIME')
+assert (np.diff(times) >= 0).all() # rows of a time chunk are contiguous
+timesteps = np.unique(times)
+Ntime = len(timesteps)
 assert Ntime%timeavg == 0
 
 # array with solutions
 solall = {'amp':np.zeros( (Ntime/timeavg,Nfreq/freqavg,Nant), dtype=np.float64), 'phase':np.zeros( (Ntime/timeavg,Nfreq/freqavg,Nant), dtype=np.float64)}
-# in these array I store the solution at each time and freq, every timeavg times then I combine them. I need to store all the frequencies.
-solsblock = {'amp':np.zeros( (timeavg,Nfreq,Nant), dtype=np.float64), 'phase':np.zeros( (timeavg,Nfreq,Nant), dtype=np.float64)}
-solsblock_w = {'amp':np.zeros( (timeavg,Nfreq,Nant), dtype=np.float64), 'phase':np.zeros( (timeavg,Nfreq,Nant), dtype=np.float64)}
-
-for t, ts in enumerate(tms.iter('TIME')):
-    logging.info('Working on time: '+str(t))
-    time = ts.getcell('TIME',0)
-    # shape: ant, chan, pol
-    weight = ts.getcol('WEIGHT_SPECTRUM')
-    flags = ts.getcol('FLAG')
+
+for c in xrange(0, Ntime, timeavg*timechunk):
+    tc = timesteps[c:c+timeavg*timechunk]
+    Nt = len(tc)
+    Nb = Nt/timeavg
+    logging.info('Working on times: %i-%i' % (c, c+Nt-1))
+
+    # rows of this chunk, shape: row, chan (first pol only)
+    row = np.searchsorted(times, tc[0])
+    nrow = np.searchsorted(times, tc[-1], side='right') - row
+    weight = tms.getcol('WEIGHT_SPECTRUM', row, nrow)[:,:,0]
+    flags = tms.getcol('FLAG', row, nrow)[:,:,0]
     weight[flags == True] = 0 # weight flagged data 0
-    data = ts.getcol('SMOOTHED_DATA')
+    data = tms.getcol('SMOOTHED_DATA', row, nrow)[:,:,0]
     data[ weight == 0 ] = 1. # remove nans
-    data_m = ts.getcol('MODEL_DATA')
-    ants1 = ts.getcol('ANTENNA1')
-    ants2 = ts.getcol('ANTENNA2')
-    ants = np.array(list(set(ants1)))
-    antIdx = np.array([ants1,ants2])
-
-    for f, freq in enumerate(chans):
-        logging.info('Working on freq: '+str(f))
-
-        # scalar
-        #data_amp = np.absolute(data[:,f,0])+np.absolute(data[:,f,3])
-        #data_ph = norm( np.angle(data[:,f,0])+np.angle(data[:,f,3]) )
-        #data_ph_m = norm( np.angle(data_m[:,f,0])+np.angle(data_m[:,f,3]) )
-        #weight = ( weight[:,f,0] + weight[:,f,3] )/2. # note that flags are not propagated in pol
-    
-        # single pol
-        data_ph = norm( np.angle(data_m[:,f,0]) - np.angle(data[:,f,0]) )
-        data_amp = np.abs( data_m[:,f,0] ) / np.abs ( data[:,f,0]  )
-        data_we = weight[:,f,0]
-        
-        # TODO: if ref ant is flagged?
-    
-        # cycle on antenna to solve for
-        for s, antSol in enumerate(ants):
-            #logging.info('Working on antenna: '+str(antSol))
-    
-            if antSol != antRef: # leave 0 in the solutions
-    
-                # PHASES
-                if mode == 'double':
-                    # double closure
-                    ph_ref = getPh(data_ph, antIdx, antRef)
-                    ph_sol = getPh(data_ph, antIdx, antSol)
-                    # (ph_ref - ph_1) - (ph_sol - ph_1)
-                    sols = norm( ph_ref - ph_sol )
-        
-                    # calculate weights
-                    we_ref = getWe(data_we, antIdx, antRef)
-                    we_sol = getWe(data_we, antIdx, antSol)
-                    sols_w = (we_ref + we_sol ) /2.
-        
-                    # if antSol = ant1: p_rs + p_ss = p_rs (single, remove)
-                    sols[antSol] = 0
-                    sols_w[antSol] = 0
-                    # if antRef = ant1: p_rr + p_rs = p_rs (single, keep)
-                    sols_w[antRef] = we_ref[antSol] # autocorr gives 0 weight, no /2
-        
-                elif mode == 'triple':
-                    ph_ref = getPh(data_ph, antIdx, antRef)
-                    ph_sol = getPh(data_ph, antIdx, antSol)
-                    we_ref = getWe(data_we, antIdx, antRef)
-                    we_sol = getWe(data_we, antIdx, antSol)
-                    # triple closure
-                    sols = []
-                    sols_w = []
-                    for at, ant2 in enumerate(ants):
-                        if ant2 == antRef: continue # p_r1 + p_1r + p_rs = p_rs (single)
-                        if ant2 == antSol: continue # p_r1 + p_1s + p_ss = p_r1 + p_1s (double with 1)
-                        # if ant1 == ant2: fall back in double -> p_r1 + p_11 + p_1s = p_r1 + p_1s (double with 1==2, keep)
-                        
-                        # (ph_ref - ph_2) + (ph_2 - ph_1) - (ph_sol - ph_1)
-                        ph_tri = getPh(data_ph, antIdx, ant2)
-                        sols.append( norm( ph_ref[at] + ph_tri - ph_sol ) )
-                        we_tri = getWe(data_we, antIdx, antRef)
-                        sols_w.append( (we_ref[at] + we_sol + we_tri ) /3. )
-        
-                if not (np.array(sols_w).flatten() == 0).all():
-                    avg = angMean( np.array(sols).flatten(), weights=np.array(sols_w).flatten() ) # weighted angular mean
-                    solsblock['phase'][t%timeavg,f,s] = avg 
-                    solsblock_w['phase'][t%timeavg,f,s] = 1./angRMS( np.array(sols).flatten(), np.array(sols_w).flatten() ) # weighted std dev
-
-                # Debug plots
-                if plotph and ( antNames[antSol] == 'CS002LBA' or antNames[antSol] == 'RS310LBA' or antNames[antSol] == 'RS106LBA' ):
+    data_m = tms.getcol('MODEL_DATA', row, nrow)[:,:,0]
+    tidx = np.searchsorted(tc, times[row:row+nrow])
+    antIdx = np.array([tms.getcol('ANTENNA1', row, nrow), tms.getcol('ANTENNA2', row, nrow)])
+
+    # scalar
+    #data_amp = np.absolute(data[:,:,0])+np.absolute(data[:,:,3])
+    #data_ph = norm( np.angle(data[:,:,0])+np.angle(data[:,:,3]) )
+    #data_ph_m = norm( np.angle(data_m[:,:,0])+np.angle(data_m[:,:,3]) )
+    #weight = ( weight[:,:,0] + weight[:,:,3] )/2. # note that flags are not propagated in pol
+
+    # single pol, shape: time, ant1, ant2, chan
+    P = blMatrix( norm( np.angle(data_m) - np.angle(data) ), tidx, antIdx, Nt, Nant, sign=-1 )
+    A = blMatrix( np.abs( data_m ) / np.abs ( data ), tidx, antIdx, Nt, Nant )
+    W = blMatrix( weight, tidx, antIdx, Nt, Nant )
+
+    # in these array I store the solution at each time and freq of the chunk, then I combine them every timeavg times. I need to store all the frequencies.
+    solsblock = {'amp':np.zeros( (Nt,Nfreq,Nant), dtype=np.float64), 'phase':np.zeros( (Nt,Nfreq,Nant), dtype=np.float64)}
+    solsblock_w = {'amp':np.zeros( (Nt,Nfreq,Nant), dtype=np.float64), 'phase':np.zeros( (Nt,Nfreq,Nant), dtype=np.float64)}
+
+    # TODO: if ref ant is flagged?
+
+    # cycle on antenna to solve for
+    for antSol in xrange(Nant):
+        #logging.info('Working on antenna: '+str(antSol))
+
+        if antSol != antRef: # leave 0 in the solutions
+
+            # PHASES
+            sols, sols_w = closurePh(P, W, antRef, antSol)
+
+            valid = (sols_w != 0).any(axis=-1)
+            solsblock['phase'][:,:,antSol][valid] = angMean( sols, sols_w, axis=-1 )[valid] # weighted angular mean
+            solsblock_w['phase'][:,:,antSol][valid] = 1./angRMS( sols, sols_w, axis=-1 )[valid] # weighted std dev
+
+            # Debug plots
+            if plotph and ( antNames[antSol] == 'CS002LBA' or antNames[antSol] == 'RS310LBA' or antNames[antSol] == 'RS106LBA' ):
+                for t, time in enumerate(tc):
+                    for f, freq in enumerate(chans):
+                        fig.clf()
+                        ax = fig.add_subplot(111)
+                        ax.plot(xrange(sols.shape[2]), sols[t,f], 'ro')
+                        ax.set_title( "Antenna "+antNames[antSol]+" rms: "+str(1./solsblock_w['phase'][t,f,antSol]) )
+                        ax.plot([0,36],[solsblock['phase'][t,f,antSol],solsblock['phase'][t,f,antSol]], 'k-')
+                        ax.set_ylim(ymin=-np.pi, ymax=np.pi)
+                        ax.set_xlim(xmin=-1, xmax=36)
+                        logging.debug('Plotting ph_T%d_F%d_%s.png' % (time, freq, antNames[antSol]))
+                        plt.savefig('ph_T%d_F%d_%s.png' % (time, freq, antNames[antSol]), bbox_inches='tight')
+
+        if solvetec : continue # skip amp if TEC solve
+
+        # AMPLITUDES
+        sols, sols_w = closureAmp(A, W, antSol)
+
+        valid = (sols_w != 0).any(axis=-1)
+        sols = np.log10(sols) # for amplitude work in log space
+        sum_w = np.where(valid, sols_w.sum(axis=-1), 1.)
+        avg = (sols * sols_w).sum(axis=-1) / sum_w # weighted avg
+        std = np.sqrt( ( (sols - avg[:,:,np.newaxis])**2 * sols_w ).sum(axis=-1) / sum_w ) # weighted std dev
+        solsblock['amp'][:,:,antSol][valid] = avg[valid]
+        solsblock_w['amp'][:,:,antSol][valid] = 1./std[valid]
+
+        # Debug plots
+        if plotamp and ( antNames[antSol] == 'CS002LBA' or antNames[antSol] == 'RS310LBA' or antNames[antSol] == 'RS106LBA' ):
+            for t, time in enumerate(tc):
+                for f, freq in enumerate(chans):
                     fig.clf()
                     ax = fig.add_subplot(111)
-                    ax.plot(xrange(len(sols)), sols, 'ro')
-                    ax.set_title( "Antenna "+antNames[antSol]+" rms: "+str(1./solsblock_w['phase'][t%timeavg,f,s]) )
-                    ax.plot([0,36],[solsblock['phase'][t%timeavg,f,s],solsblock['phase'][t%timeavg,f,s]], 'k-')
-                    ax.set_ylim(ymin=-np.pi, ymax=np.pi)
-                    ax.set_xlim(xmin=-1, xmax=36)
-                    logging.debug('Plotting ph_T%d_F%d_%s.png' % (time, freq, antNames[antSol]))
-                    plt.savefig('ph_T%d_F%d_%s.png' % (time, freq, antNames[antSol]), bbox_inches='tight')
-
-            if solvetec : continue # skip amp if TEC solve
-        
-            # AMPLITUDES
-            # a1S*aS3/a13 = e1 eS eS e2 / e1 e2 = e2**2
-            # TODO: convert to log space
-            amp_sol = getAmp(data_amp, antIdx, antSol)
-            we_sol = getWe(data_we, antIdx, antSol)
-            sols = []
-            sols_w = []
-            for ant1 in ants:
-                if ant1 == antSol: continue # skip if 1==S
-                amp_1 = getAmp(data_amp, antIdx, ant1)
-                we_1 = getWe(data_we, antIdx, ant1)
-                amp_1S = getAmp(data_amp, antIdx, ant1, ant2=antSol)
-                we_1S = getWe(data_we, antIdx, ant1, ant2=antSol)
-                sols.append(1./np.sqrt(amp_1S * amp_sol / amp_1))
-                sols_w.append( (we_1S + we_sol + we_1) /3.)
-    
-                # if any antenna of the closure relation is flagged or an autocorrelation, set the weight to 0
-                sols_w[-1][ we_1 == 0 ] = 0
-                sols_w[-1][ we_sol == 0 ] = 0
-                if we_1S == 0: sols_w[-1] = np.zeros_like(sols_w[-1])
-    
-            if not (np.array(sols_w).flatten() == 0).all():
-                sols = np.log10(sols) # for amplitude work in log space
-                avg = np.average( np.array(sols).flatten(), weights=np.array(sols_w).flatten() ) # weighted avg
-                solsblock['amp'][t%timeavg,f,s] = avg 
-                solsblock_w['amp'][t%timeavg,f,s] = 1./np.sqrt( np.average( ( np.array(sols).flatten() - avg )**2,\
-                    weights=np.array(sols_w).flatten()) ) # weighted std dev
+                    s = sols[t,f][sols_w[t,f] != 0]
+                    ax.plot(xrange(len(s)), s, 'bo')
+                    ax.set_title( "Antenna "+antNames[antSol]+" rms: "+str(1./solsblock_w['amp'][t,f,antSol]) )
+                    ax.plot([0,36],[solsblock['amp'][t,f,antSol],solsblock['amp'][t,f,antSol]], 'k-')
+                    logging.debug('Plotting amp_T%d_F%d_%s.png' % (time, freq, antNames[antSol]))
+                    plt.savefig('amp_T%d_F%d_%s.png' % (time, freq, antNames[antSol]), bbox_inches='tight')
 
-            # Debug plots
-            if plotamp and ( antNames[antSol] == 'CS002LBA' or antNames[antSol] == 'RS310LBA' or antNames[antSol] == 'RS106LBA' ):
-                fig.clf()
-                ax = fig.add_subplot(111)
-                for a in xrange(len(sols)):
-                    ax.plot(xrange(len(sols[a][(sols_w[a] != 0)])), sols[a][(sols_w[a] != 0)], 'bo')
-                ax.set_title( "Antenna "+antNames[antSol]+" rms: "+str(1./solsblock_w['amp'][t%timeavg,f,s]) )
-                ax.plot([0,36],[solsblock['amp'][t%timeavg,f,s],solsblock['amp'][t%timeavg,f,s]], 'k-')
-                logging.debug('Plotting amp_T%d_F%d_%s.png' % (time, freq, antNames[antSol]))
-                plt.savefig('amp_T%d_F%d_%s.png' % (time, freq, antNames[antSol]), bbox_inches='tight')
-    
-        # end freq cycle
+    # end ant cycle
 
     # save actual solutions by re-averaging inside the freq/time steps
-    if (t+1) % timeavg == 0:
-        for s in xrange(Nant):
-
-            if plotavg: 
-                fig.clf()
-
-            for f in xrange(Nfreq/freqavg):
-                if solvetec:
-                    solall['phase'][t/timeavg,f,s] = findtec( solsblock['phase'][:,f*freqavg:(f+1)*freqavg,s].flatten(),\
-                        weights=solsblock_w['phase'][:,f*freqavg:(f+1)*freqavg,s].flatten(), freq=chans, time = t/timeavg, ant = antNames[s])
-                else:
-                    solall['phase'][t/timeavg,f,s] = angMean( solsblock['phase'][:,f*freqavg:(f+1)*freqavg,s].flatten(),\
-                        weights=solsblock_w['phase'][:,f*freqavg:(f+1)*freqavg,s].flatten() )
-                    # convert back from log space
-                    solall['amp'][t/timeavg,f,s] = 10**np.average( solsblock['amp'][:,f*freqavg:(f+1)*freqavg,s].flatten(),\
-                        weights=solsblock_w['amp'][:,f*freqavg:(f+1)*freqavg,s].flatten() )
-
-                # Debug plots
-                # color: freq, xaxis: time, table: ant
-                if plotph or plotamp: 
-                    times = range(solsblock['amp'].shape[0])
+    # (time, freq, ant) -> (time block, freq block, ant, timeavg*freqavg)
+    toblocks = lambda a: a.reshape(Nb, timeavg, Nfreq/freqavg, freqavg, Nant).transpose(0,2,4,1,3).reshape(Nb, Nfreq/freqavg, Nant, -1)
+    b = c/timeavg
+    if solvetec:
+        # fit all time blocks and antennas of the chunk together
+        ph = toblocks(solsblock['phase'])[:,0] # a single freq block
+        we = toblocks(solsblock_w['phase'])[:,0]
+        freqs = np.tile(chans, timeavg)
+        tec = findtec( ph.reshape(-1, len(freqs)), we.reshape(-1, len(freqs)), freqs )
+        solall['phase'][b:b+Nb,0] = tec.reshape(Nb, Nant)
+        if plotTEC:
+            for i in xrange(Nb):
+                for s in xrange(Nant):
+                    plottec( ph[i,s], freqs, solall['phase'][b+i,0,s], antNames[s]+'_T'+str(b+i) )
+    else:
+        solall['phase'][b:b+Nb] = angMean( toblocks(solsblock['phase']), weights=toblocks(solsblock_w['phase']), axis=-1 )
+        # convert back from log space
+        w = toblocks(solsblock_w['amp'])
+        solall['amp'][b:b+Nb] = 10**( (toblocks(solsblock['amp']) * w).sum(axis=-1) / np.where(w.sum(axis=-1) != 0, w.sum(axis=-1), 1.) )
+
+    # Debug plots
+    # color: freq, xaxis: time, table: ant
+    if plotph or plotamp:
+        times_b = range(timeavg)
+        for i in xrange(Nb):
+            t = b+i
+            for s in xrange(Nant):
+
+                if plotavg:
+                    fig.clf()
+
+                for f in xrange(Nfreq/freqavg):
                     ax = fig.add_subplot(121)
                     ax.set_title("PHASE - Antenna "+antNames[s])
-                    ax.set_xlim(xmin=-0.5, xmax=len(times)-0.5)
-                    for i in xrange(f*freqavg,(f+1)*freqavg):
-                        ax.errorbar(times, solsblock['phase'][:,i,s], yerr=1./solsblock_w['phase'][:,i,s], c=cmap(float(i)/freqavg), fmt='o')
-                    ax.plot([times[0],times[-1]], [solall['phase'][t/timeavg,f,s], solall['phase'][t/timeavg,f,s]], 'k-')
-            
+                    ax.set_xlim(xmin=-0.5, xmax=len(times_b)-0.5)
+                    for j in xrange(f*freqavg,(f+1)*freqavg):
+                        ax.errorbar(times_b, solsblock['phase'][i*timeavg:(i+1)*timeavg,j,s], yerr=1./solsblock_w['phase'][i*timeavg:(i+1)*timeavg,j,s], c=cmap(float(j)/freqavg), fmt='o')
+                    ax.plot([times_b[0],times_b[-1]], [solall['phase'][t,f,s], solall['phase'][t,f,s]], 'k-')
+
                     ax = fig.add_subplot(122)
                     ax.set_title("AMP - Antenna "+antNames[s])
-                    for i in xrange(f*freqavg,(f+1)*freqavg):
-                        ax.errorbar(times, solsblock['amp'][:,i,s], yerr=1./solsblock_w['amp'][:,i,s], c=cmap(float(i)/freqavg), fmt='o')
-                    ax.plot([times[0],times[-1]], np.log10([solall['amp'][t/timeavg,f,s], solall['amp'][t/timeavg,f,s]]), 'k-')
+                    for j in xrange(f*freqavg,(f+1)*freqavg):
+                        ax.errorbar(times_b, solsblock['amp'][i*timeavg:(i+1)*timeavg,j,s], yerr=1./solsblock_w['amp'][i*timeavg:(i+1)*timeavg,j,s], c=cmap(float(j)/freqavg), fmt='o')
+                    ax.plot([times_b[0],times_b[-1]], np.log10([solall['amp'][t,f,s], solall['amp'][t,f,s]]), 'k-')
 
-                    logging.debug('Plotting Fin_T%d_F%d_%s.png' % (t/timeavg, f, antNames[s]))
-                    plt.savefig('Fin_T%d_F%d_%s.png' % (t/timeavg, f, antNames[s]), bbox_inches='tight')
+                    logging.debug('Plotting Fin_T%d_F%d_%s.png' % (t, f, antNames[s]))
+                    plt.savefig('Fin_T%d_F%d_%s.png' % (t, f, antNames[s]), bbox_inches='tight')
 
-    #if t == 20: break
-    # end time cycle
+    # end time chunk cycle
 
 if plotall:
     for a, ant in enumerate(antNames):
@@ -338,7 +369,7 @@ if plotall:
             ax.set_title("PHASE - Antenna "+ant)
             ax.plot( solall['phase'][:,:,a], 'o', markersize=3 )
             ax = fig.add_subplot(212)
-            ax.set_title("AMP - Antenna "+antNames[s])
+            ax.set_title("AMP - Antenna "+ant)
             ax.plot( solall['amp'][:,:,a], '-', markersize=3 )
         logging.debug('Plotting '+ant+'.png')
         plt.savefig(ant+'.png', bbox_inches='tight')
@@ -20,6 +20,7 @@
 import re
 import math
 import optparse
+import lib_skymodel
 
 
 def convert_sky_bbs_lsm(infilename,outfilename):
@@ -262,30 +263,26 @@ def convert_sky_bbs_lsm(infilename,outfilename):
 
 
 
- infile=open(infilename,'r')
- all=infile.readlines()
- infile.close()
+ # parsed lines are cached in a binary file next to the sky model
+ sky=lib_skymodel.read_skymodel(infilename,[pp1,pp,pp2,pp3],patch='col3',radec=lib_skymodel.radec_bbs)
  outfile=open(outfilename,'w')
  outfile.write("## LSM file\n")
  outfile.write("### Name  | RA (hr,min,sec) | DEC (deg,min,sec) | I | Q | U |  V | SI | RM | eX | eY | eP | freq0\n")
- for eachline in all:
-   v=pp1.search(eachline)
-   if v!= None:
+ for (p,v) in sky:
+   if p==0:
       strline=str(v.group('col1'))+' '+str(v.group('col4'))+' '+str(v.group('col5'))+' '+str(v.group('col6'))
       strline=strline+' '+str(v.group('col7'))+' '+str(v.group('col8'))+' '+str(v.group('col9'))+' '+str(v.group('col10'))
       strline=strline+' '+str(v.group('col11'))+' '+str(v.group('col12'))+' '+str(v.group('col13'))+' '+str(v.group('col15'))
       strline=strline+' 0 0 0 0 '+str(v.group('col14'))+'\n'
       outfile.write(strline)
    else:
-     v=pp.search(eachline)
-     if v!= None:
+     if p==1:
       strline=str(v.group('col1'))+' '+str(v.group('col4'))+' '+str(v.group('col5'))+' '+str(v.group('col6'))
       strline=strline+' '+str(v.group('col7'))+' '+str(v.group('col8'))+' '+str(v.group('col9'))+' '+str(v.group('col10'))
       strline=strline+' 0 0 0 0 0 0 0 0 0\n'
       outfile.write(strline)
      else:
-       v=pp2.search(eachline)
-       if v!= None:
+       if p==2:
         stype=v.group('col2')
         sname=str(v.group('col1'))
         bad_source=False
@@ -315,8 +312,7 @@ def convert_sky_bbs_lsm(infilename,outfilename):
         else:
           print 'Error in source '+strline
        else:
-         v=pp3.search(eachline)
-         if v!= None:
+         if p==3:
           stype=v.group('col2')
           sname=str(v.group('col1'))
           bad_source=False
@@ -387,17 +383,14 @@ def convert_sky_lsm_bbs(infilename,outfilename):
    (?P<col17>[-+]?(\d+(\.\d*)?|\d*\.\d+)([eE][-+]?\d+)?)?   # reference frequency
    [\S\s]*""",re.VERBOSE)
 
-  infile=open(infilename,'r')
-  all=infile.readlines()
-  infile.close()
+  # parsed lines are cached in a binary file next to the sky model
+  sky=lib_skymodel.read_skymodel(infilename,[pp],radec=lib_skymodel.radec_lsm)
   outfile=open(outfilename,'w')
   outfile.write("# (Name, Type, Patch, Ra, Dec, I, Q, U, V, ReferenceFrequency='150e6',  SpectralIndex='[0.0]', Ishapelet) = format\n")
   outfile.write("# The above line defines the field order and is required.\n")
   outfile.write(", , CENTER, put:ra:here, put.dec.here\n") 
 
-  for eachline in all:
-    v=pp.search(eachline)
-    if v!= None:
+  for (p,v) in sky:
      strline=str(v.group('col1'))+', POINT, CENTER, '+str(v.group('col2'))+':'+str(v.group('col3'))+':'+str(v.group('col4'))
      strline=strline+', '+str(v.group('col5'))+'.'+str(v.group('col6'))+'.'+str(v.group('col7'))+', '+str(v.group('col8'))+', '+str(v.group('col9'))+', '+str(v.group('col10'))+', '+str(v.group('col11'))+', '
      strline=strline+str(v.group('col17'))+', ['+str(v.group('col12'))+']\n'
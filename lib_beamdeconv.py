@@ -233,128 +233,82 @@ def findCommonBeam(beams, debugplots=False, confidence=0.005):
     
     Common beam means that all beams can be convolved to the common beam.
     
+    In the quadratic parametrization Q = [[A,B/2],[B/2,C]] a beam can be convolved to the common beam
+    if Q_common <= Q_i (Q_i - Q_common positive semi-definite), and the area goes as 1/sqrt(det(Q_common)).
+    So we maximise log(det(Q_common)) with those constraints, which is a convex problem solved with a barrier method.
+    
     `confidence` parameter is basically how confident you want solution. So 0.01 is knowing solution to 1%.
-    Specifically it's how long to sample so that there are enough statistics to properly sample likelihood with required accuracy.
-    default is 0.005. Computation time scale inversely with it.'''
+    Specifically the returned beam is at most this fraction larger in area than the minimal one, and it is always
+    strictly larger than each input beam, so that the convolving kernels are never degenerate.
+    default is 0.005. Computation time scale with log(1/confidence).'''
     def beamArea(bmaj,bmin,bpa=None):
         return bmaj*bmin*np.pi/4./np.log(2.)
-    def isCommonBeam(beamCandQuad,beamsQuad):
-        for beamQuad in beamsQuad:
-            try:
-                Ak,Bk,Ck = deconvolve(beamCandQuad[0],beamCandQuad[1],beamCandQuad[2],beamQuad[0],beamQuad[1],beamQuad[2])
-                bmaj,bmin,bpa = quadratic2elliptic(Ak,Bk,Ck)
-            except:
-                return False
-        return True 
-    def samplePrior(beamLast, beamsQuad):
-        iter = 0
-        while True:
-            std = 1.5
-            beam = [beamLast[0]*np.exp(np.log(std)*np.random.uniform(low=-1,high=1.)),
-                     beamLast[1]*np.exp(np.log(std)*np.random.uniform(low=-1,high=1.)),
-                     beamLast[2] + np.random.uniform(low=-5,high=5)]
-            #beam[0] = np.abs(beam[0])
-            #beam[1] = np.abs(beam[1])
-            if beam[1] > beam[0]:
-                temp = beam[1]
-                beam[1] = beam[0]
-                beam[0] = temp
-            while beam[2] > 90.:
-                beam[2] -= 180.
-            while beam[2] < -90.:
-                beam[2] += 180.
-            A,B,C = elliptic2quadratic(*beam)
-            if isCommonBeam((A,B,C),beamsQuad):
-                return beam
-            iter += 1
-        
-    # TODO: is it OK to minimize only area? Or we should put a penalty on maj/min to avoid very long beams?
-    def misfit(beam,areaLargest):
-        area = beamArea(*beam)
-        L2 = (area - areaLargest)**2/2.
-        return L2
-    #Get beam areas
+    def toMatrix(q):
+        return np.array([[q[0],q[1]/2.],[q[1]/2.,q[2]]])
+    def isPosDef(M):
+        return np.all(M[...,0,0] > 0) and np.all(M[...,0,0]*M[...,1,1] - M[...,0,1]*M[...,1,0] > 0)
+    # derivatives of Q = A*E[0] + B*E[1] + C*E[2]
+    E = np.array([[[1.,0.],[0.,0.]], [[0.,.5],[.5,0.]], [[0.,0.],[0.,1.]]])
+    def logdetDerivs(M):
+        '''value, gradient and hessian (w.r.t. A,B,C) of sum(log(det(M))) for a stack of matrices M'''
+        M = M.reshape(-1,2,2)
+        ME = np.einsum('nij,kjl->nkil', np.linalg.inv(M), E)
+        val = np.sum(np.log(np.linalg.det(M)))
+        grad = np.einsum('nkii->k', ME)
+        hess = -np.einsum('nkij,nlji->kl', ME, ME)
+        return val, grad, hess
+    def barrier(q, t):
+        '''value, gradient and hessian of -t*log(det(Q)) - sum_i log(det(Q_i - Q))'''
+        v0, g0, h0 = logdetDerivs(toMatrix(q))
+        v1, g1, h1 = logdetDerivs(beamsQuad - toMatrix(q))
+        return -t*v0 - v1, -t*g0 + g1, -t*h0 - h1
+    def isFeasible(q):
+        return isPosDef(toMatrix(q)) and isPosDef(beamsQuad - toMatrix(q))
+
     N = len(beams)
-    areas = []
-    beamsQuad = []
-    i = 0
-    while i < N:
-        areas.append(beamArea(*beams[i]))
-        beamsQuad.append(elliptic2quadratic(*beams[i]))
-        i += 1
+    areas = np.array([beamArea(*beam) for beam in beams])
+    beamsQuad = np.array([toMatrix(elliptic2quadratic(*beam)) for beam in beams])
+    # if the largest beam is already common there's nothing to do
     beam0 = beams[np.argmax(areas)]
-    areaLargest = np.max(areas)
-    beam0Quad = elliptic2quadratic(*beam0)
-    if isCommonBeam(beam0Quad,beamsQuad):
+    beam0Quad = toMatrix(elliptic2quadratic(*beam0))
+    if isPosDef(beamsQuad - beam0Quad + 1e-12*np.abs(beam0Quad).max()*np.identity(2)):
         return beam0
-    else:
-        bmajMax = np.max(beams,axis=0)[0]
-        beam0 = [bmajMax,bmajMax,0.]
-    #MC search, 1/binning = confidence
-    binning = int(1./confidence)
-    Nmax = 1e6
-    beamsMH = np.zeros([binning*binning,3],dtype=np.double)
-    beamsMul = np.zeros(binning*binning,dtype=np.double)
-    beamsMH[0,:] = beam0
-    beamsMul[0] = 1
-    accepted = 1
-    Si = misfit(beam0,areaLargest)
-    Li = np.exp(-Si)
-    maxL = Li
-    maxLBeam = beam0
-    iter = 0
-    while accepted < binning**2 and iter < Nmax:
-        beam_j = samplePrior(beamsMH[accepted-1], beamsQuad)
-        Sj = misfit(beam_j,areaLargest)
-        Lj = np.exp(-Sj)
-        #print("Sj = {}".format(Sj))
-        if Sj < Si or np.log(np.random.uniform()) < Si - Sj:
-            Si = Sj
-            beamsMH[accepted,:] = beam_j
-            beamsMul[accepted] += 1
-            #print("Accepted")
-            accepted += 1
-        else:
-            beamsMul[accepted-1] += 1
-        if Lj > maxL:
-            maxL = Lj
-            maxLBeam = beam_j
-        iter += 1
-    if accepted == binning**2:
-        pass
-        #print("Converged in {} steps with an acceptance rate of {}".format(iter,float(accepted)/iter))
-    else:
-        beamsMH = beamsMH[:iter,:]
-        beamsMul = beamsMul[:iter]
+
+    # start from a circular beam larger than every beam, each log(det) constraint adds at most 1/t to the duality gap
+    # on log(det(Q)), and the area goes as exp(-log(det(Q))/2)
+    q = np.array([0.5*np.min(np.linalg.eigvalsh(beamsQuad)), 0., 0.])
+    q[2] = q[0]
+    t = 1.
+    while True:
+        # Newton centring (capped, as at large t roundoff may stop the steps from moving q)
+        for i in range(50):
+            val, grad, hess = barrier(q, t)
+            step = -np.linalg.solve(hess, grad)
+            decrement = -np.dot(grad, step)
+            if decrement/2. < 1e-10: break
+            alpha = 1.
+            while not isFeasible(q + alpha*step) or barrier(q + alpha*step, t)[0] > val - 0.25*alpha*decrement:
+                alpha /= 2.
+                if alpha < 1e-10: break
+            if alpha < 1e-10: break
+            q += alpha*step
+        if N/t < np.log(1.+confidence): break
+        t *= 10.
+
+    commonBeam = quadratic2elliptic(*q)
     if debugplots:
         import pylab as plt
-#         plt.hist(beamsMH[:,0],bins=binning)
-#         plt.show()
-#         plt.hist(beamsMH[:,1],bins=binning)
-#         plt.show()
-#         plt.hist(beamsMH[:,2],bins=binning)
-#         plt.show()
         from matplotlib.patches import Ellipse
         ax = plt.subplot(1,1,1)
-        ax.add_artist(Ellipse(xy=(0,0), width=maxLBeam[0], height=maxLBeam[1], angle=maxLBeam[2], facecolor="none",edgecolor='red',alpha=1,label='common beam'))
+        ax.add_artist(Ellipse(xy=(0,0), width=commonBeam[0], height=commonBeam[1], angle=commonBeam[2], facecolor="none",edgecolor='red',alpha=1,label='common beam'))
         for beam in beams:
             ax.add_artist(Ellipse(xy=(0,0), width=beam[0], height=beam[1], angle=beam[2], facecolor="none",edgecolor='black',ls='--',alpha=1))
         ax.set_xlim(-0.5,0.5)
         ax.set_ylim(-0.5,0.5)
         plt.legend(frameon=False)
         plt.show()
-        
-#     meanBeam = np.sum(beamsMH.T*beamsMul,axis=1)/np.sum(beamsMul)
-#     stdBeam = np.sqrt(np.sum(beamsMH.T**2*beamsMul,axis=1)/np.sum(beamsMul) - meanBeam**2)
-#     print ("(Gaussian) beam is {} +- {}".format(meanBeam,stdBeam))
-#     logmeanBmajBmin = np.sum(np.log(beamsMH[:,:2]).T*beamsMul,axis=1)/np.sum(beamsMul)
-#     logstdBmajBmin = np.sqrt(np.sum(np.log(beamsMH[:,:2]).T**2*beamsMul,axis=1)/np.sum(beamsMul) - logmeanBmajBmin**2)
-#     logstdBmajBminu = np.exp(logmeanBmajBmin + logstdBmajBmin) - np.exp(logmeanBmajBmin)
-#     logstdBmajBminl = np.exp(logmeanBmajBmin) - np.exp(logmeanBmajBmin - logstdBmajBmin)
-#     logmeanBmajBmin = np.exp(logmeanBmajBmin)
-#     print("(Lognormal) bmaj/bmin is {} + {} - {}".format(logmeanBmajBmin,logstdBmajBminu,logstdBmajBminl))
-#     print ("Max Likelihood beam is {}".format(maxLBeam))
-    return maxLBeam
+
+    return list(commonBeam)
     
 def fftGaussian(A,B,C,X,Y):
     D = 4*A*C-B**2
@@ -138,24 +138,16 @@ class Image(object):
         if invert: self.img_data[~mask] = blankvalue
         else: self.img_data[mask] = blankvalue
 
-    def calc_noise(self, niter=100, eps=1e-6):
+    def calc_noise(self, niter=100, eps=1e-6, sample=1000000):
         """
         Return the rms of all the pixels in an image
         niter : robust rms estimation
         eps : convergency
+        sample : max number of pixels used, None for all
         """
-        data = self.img_data[ ~np.isnan(self.img_data) ] # remove nans
-        oldrms = 1.
-        for i in range(niter):
-            rms = np.nanstd(data)
-            if np.abs(oldrms-rms)/rms < eps:
-                self.noise = rms
-                logging.debug('%s: Noise: %.3f mJy/b' % (self.imagefile, self.noise*1e3))
-                return
-
-            data = data[np.abs(data)<3*rms]
-            oldrms = rms
-        raise Exception('Noise estimation failed to converge.')
+        from lib_noise import robust_rms
+        self.noise = robust_rms(self.img_data, nsigma=3., niter=niter, eps=eps, sample=sample)
+        logging.debug('%s: Noise: %.3f mJy/b' % (self.imagefile, self.noise*1e3))
 
     def convolve(self, target_beam):
         """
@@ -88,45 +88,44 @@ def linear_fit_bootstrap(x, y, yerr=None, niter=1000, tolog=False):
     #
     # tolog : convert in log space x, y, and yerr before doing linear regression
     # use: (a, b, sa, sb) = linear_fit_bootstrap(x, y, yerr)
+    #
+    # y (and yerr) can also be (..., len(x)) arrays, e.g. one row per pixel:
+    # all rows are fitted together and a, b, sa, sb are (...) arrays
 
     x = np.array(x)
     y = np.array(y)
-    yerr = np.array(yerr)
-
-    from scipy import optimize
-    errfunc = lambda B, x, y: f(x, B[0], B[1]) - y
+    if yerr is not None: yerr = np.array(yerr)
 
     if tolog:
-        yerr=0.434*yerr/y
+        if yerr is not None: yerr=0.434*yerr/y
         x=np.log10(x)
         y=np.log10(y)
 
-    pfit, pcov, infodict, errmsg, success = optimize.leastsq( errfunc, [-1, 0], args=(x, y), full_output=1)
+    # least squares line in closed form for every row of ys (..., len(x))
+    dx = x - np.mean(x)
+    def fit(ys):
+        B0 = np.dot(ys, dx) / np.sum(dx**2)
+        return B0, np.mean(ys, axis=-1) - B0*np.mean(x)
+
+    pfit = fit(y)
 
     # 2 vals without error, cannot estimate sigmas
-    if len(y) == 2 and yerr is None: return (pfit[0], pfit[1], 0, 0)
-
-    residuals = errfunc( pfit, x, y )
-    s_res = np.std(residuals)
-    ps = []
-    # TODO: remove cycle and use only array shapes
-    # n random data sets are generated and fitted
-    for i in range(niter):
-      if yerr is None:
-          randomDelta = np.random.normal(0., s_res, len(y))
-          randomdataY = y + randomDelta
-      else:
-          randomDelta = np.array( [ np.random.normal(0., derr, 1)[0] for derr in yerr ] ) 
-          randomdataY = y + randomDelta
-      randomfit, randomcov = optimize.leastsq( errfunc, [-1, 0], args=(x, randomdataY), full_output=0)
-      ps.append( randomfit ) 
-
-    ps = np.array(ps)
-    mean_pfit = np.mean(ps,0)
+    if y.shape[-1] == 2 and yerr is None: return (pfit[0], pfit[1], 0, 0)
+
+    # n random data sets are generated (niter, ..., len(y)) and fitted all at once
+    if yerr is None:
+        residuals = f(x, np.expand_dims(pfit[0], -1), np.expand_dims(pfit[1], -1)) - y
+        s_res = np.std(residuals, axis=-1, keepdims=True)
+        randomDelta = np.random.normal(0., 1., (niter,)+y.shape) * s_res
+    else:
+        randomDelta = np.random.normal(0., 1., (niter,)+y.shape) * yerr
+    ps = fit(y + randomDelta)
+
+    mean_pfit = [np.mean(p,0) for p in ps]
     Nsigma = 1. # 1sigma gets approximately the same as methods above
                 # 1sigma corresponds to 68.3% confidence interval
                 # 2sigma corresponds to 95.44% confidence interval
-    err_pfit = Nsigma * np.std(ps,0) 
+    err_pfit = [Nsigma * np.std(p,0) for p in ps]
 
     return (mean_pfit[0], mean_pfit[1], err_pfit[0], err_pfit[1])
 
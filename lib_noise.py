@@ -0,0 +1,61 @@
+import numpy as np
+
+# Robust noise estimation of images
+# USAGE:
+# rms = robust_rms(data, nsigma=3) # clipped rms of an image
+# rmsmap = noise_map(data, box=100) # clipped rms in boxes of 100x100 pixels
+#
+# The sigma clipping (rms of the pixels with |value| < nsigma*rms, repeated until the rms converges)
+# is done on a random subsample of the pixels, so that its cost does not depend on the image size.
+
+
+def robust_rms(data, nsigma=3., niter=100, eps=1e-6, sample=1000000, seed=0):
+    """
+    Return the sigma clipped rms of data (nans are ignored)
+    nsigma : clip pixels with abs value above nsigma*rms
+    niter : max number of iterations
+    eps : convergency (relative change of rms)
+    sample : max number of (random) pixels to use, None to use all pixels
+    seed : seed of the random subsample
+    """
+    data = np.asarray(data).ravel()
+    if sample is not None and data.size > sample:
+        data = data[np.random.RandomState(seed).randint(0, data.size, sample)]
+    data = data[~np.isnan(data)].astype(np.float64)
+    if data.size == 0:
+        raise Exception('No valid pixels for noise estimation.')
+
+    oldrms = 1.
+    for i in range(niter):
+        if data.size == 0: break
+        rms = np.std(data)
+        if rms == 0 or np.abs(oldrms-rms)/rms < eps:
+            return rms
+        data = data[np.abs(data) < nsigma*rms]
+        oldrms = rms
+    raise Exception('Noise estimation failed to converge.')
+
+
+def noise_map(data, box=100, step=None, nsigma=3., niter=100, eps=1e-6, minpix=None):
+    """
+    Return a coarse map of the local noise, the robust_rms() of boxes of box pixels
+    every step pixels (default: step=box, not overlapping boxes).
+    Pixel [j,i] of the map is centred on pixel [j*step+box/2, i*step+box/2] of data.
+    Boxes with less than minpix (default: box**2/10) valid pixels or not converging are nan.
+    """
+    if step is None: step = box
+    if minpix is None: minpix = box**2/10
+    ys, xs = data.shape
+    ny = max((ys-box)//step+1, 1)
+    nx = max((xs-box)//step+1, 1)
+    rmsmap = np.empty((ny, nx))
+    rmsmap.fill(np.nan)
+    for j in range(ny):
+        for i in range(nx):
+            subim = data[j*step:j*step+box, i*step:i*step+box]
+            if np.count_nonzero(~np.isnan(subim)) < minpix: continue
+            try:
+                rmsmap[j, i] = robust_rms(subim, nsigma=nsigma, niter=niter, eps=eps, sample=None)
+            except Exception:
+                pass
+    return rmsmap
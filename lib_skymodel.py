@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Cached parsing of text skymodels (BBS, LSM)
+# USAGE:
+# sky = read_skymodel('bbs.skymodel', [pp1, pp2], patch='col3', radec=radec_bbs)
+# for p, v in sky:
+#     # p: index of the first pattern matching the line, v: same group()/string of a match
+#     print p, v.group('col1')
+# sky.column('col10') # all values of a group as array of floats
+# sky.patch('CENTER') # rows of a patch
+# sky.near(ra, dec, radius) # rows around a position (rad)
+#
+# The matched groups are saved in a compressed columnar binary sidecar of the skymodel (skymodel.<parser>.npz):
+# numeric groups as floats (their exact strings are cut from the skymodel text, kept for the lossless
+# round-trip), the others as strings, together with the patch/position indexes (ra/dec in rad).
+# The sidecar is used as long as the content hash of the skymodel and the patterns are the same.
+
+import os, hashlib, logging
+import numpy as np
+
+version = 2
+
+# names of the groups with ra (h,m,s) and dec (d,m,s) in the regexps of the parsers
+radec_bbs = (('col4','col5','col6'), ('col7','col8','col9'))
+radec_lsm = (('col2','col3','col4'), ('col5','col6','col7'))
+
+
+class SkyRow(object):
+    """
+    A row of a SkyModel, with the group() and string of a regexp match
+    """
+    __slots__ = ('sky', 'i')
+
+    def __init__(self, sky, i):
+        self.sky = sky
+        self.i = i
+
+    def group(self, name):
+        return self.sky.group(name)[self.i]
+
+    @property
+    def string(self):
+        return self.sky.line(self.i)
+
+
+class SkyModel(object):
+
+    def __init__(self, text, pattern, start, end, strings, numbers, offsets, nones):
+        """
+        text: the skymodel text (bytes)
+        pattern: index of the pattern matching each row
+        start, end: position of each row in text
+        strings: dict of group name -> array of the matched strings (bytes, '' if not matched), for non numeric groups
+        numbers: dict of group name -> array of the matched values (float, nan if not matched), for numeric groups
+        offsets: dict of group name -> (start, length) in the row of the matched strings, for numeric groups
+        nones: dict of group name -> bool array, True where the group was not matched
+        """
+        self.text = text
+        self.pattern = pattern
+        self.start = start
+        self.end = end
+        self.strings = strings
+        self.numbers = numbers
+        self.offsets = offsets
+        self.nones = nones
+        self._lists = {}
+        self._columns = {}
+        self.patch_names = self.patch_order = self.patch_start = None
+        self.ra = self.dec = self.dec_order = None
+
+    def __len__(self):
+        return len(self.pattern)
+
+    def __iter__(self):
+        pattern = self.pattern.tolist()
+        for i in xrange(len(self)):
+            yield pattern[i], SkyRow(self, i)
+
+    def strings_of(self, name):
+        """
+        Return the group name of all rows as an array of strings ('' where it was not matched)
+        """
+        if name in self.strings: return self.strings[name]
+        # numeric groups: cut the exact strings from the text
+        return cut_strings(self.text, self.start, self.offsets[name])
+
+    def group(self, name):
+        """
+        Return the group name of all rows as a list, None where it was not matched
+        """
+        if name not in self._lists:
+            values = self.strings_of(name).tolist()
+            for i in np.where(self.nones[name])[0]: values[i] = None
+            self._lists[name] = values
+        return self._lists[name]
+
+    def column(self, name, dtype=float):
+        """
+        Return the group name of all rows as an array of dtype
+        """
+        if dtype is float and name in self.numbers: return self.numbers[name]
+        if (name, dtype) not in self._columns:
+            self._columns[(name, dtype)] = self.strings_of(name).astype(dtype)
+        return self._columns[(name, dtype)]
+
+    def line(self, i):
+        """
+        Text of row i
+        """
+        return self.text[self.start[i]:self.end[i]]
+
+    def make_patch_index(self, patch):
+        """
+        Index the rows on the group patch
+        """
+        patches = self.strings_of(patch)
+        self.patch_order = np.argsort(patches, kind='mergesort')
+        self.patch_names, self.patch_start = np.unique(patches[self.patch_order], return_index=True)
+        self.patch_start = np.append(self.patch_start, len(self))
+
+    def patch(self, name):
+        """
+        Return the indexes of the rows of patch name
+        """
+        i = np.searchsorted(self.patch_names, name)
+        if i == len(self.patch_names) or self.patch_names[i] != name: return np.array([], dtype=int)
+        return np.sort(self.patch_order[self.patch_start[i]:self.patch_start[i+1]])
+
+    def make_position_index(self, radec):
+        """
+        Index the rows on their position, radec: names of the groups ((ra h,m,s), (dec d,m,s))
+        """
+        (rh, rm, rs), (dd, dm, ds) = radec
+        self.ra = np.radians(15*(np.abs(self.column(rh)) + self.column(rm)/60. + self.column(rs)/3600.))
+        sign = np.where(np.char.startswith(np.char.strip(self.strings_of(dd)), '-'), -1., 1.)
+        self.dec = np.radians(sign*(np.abs(self.column(dd)) + self.column(dm)/60. + self.column(ds)/3600.))
+        self.dec_order = np.argsort(self.dec, kind='mergesort')
+
+    def near(self, ra, dec, radius):
+        """
+        Return the indexes of the rows within radius of ra, dec (rad)
+        """
+        dec_sorted = self.dec[self.dec_order]
+        i0 = np.searchsorted(dec_sorted, dec-radius, side='left')
+        i1 = np.searchsorted(dec_sorted, dec+radius, side='right')
+        idx = self.dec_order[i0:i1]
+        d = 2*np.arcsin(np.sqrt(np.sin((self.dec[idx]-dec)/2.)**2 + \
+                np.cos(dec)*np.cos(self.dec[idx])*np.sin((self.ra[idx]-ra)/2.)**2))
+        return np.sort(idx[d <= radius])
+
+    def write(self, filename):
+        """
+        Write back the skymodel text
+        """
+        with open(filename, 'wb') as f:
+            f.write(self.text)
+
+    def save(self, filename, key):
+        """
+        Save in a compressed binary (npz) file
+        """
+        arrays = {'key': np.array(key), 'text': np.frombuffer(self.text, dtype=np.uint8),
+                  'pattern': self.pattern, 'start': self.start, 'end': self.end}
+        for name in self.nones:
+            arrays['none_'+name] = self.nones[name]
+        for name in self.strings:
+            arrays['string_'+name] = self.strings[name]
+        for name in self.numbers:
+            arrays['number_'+name] = self.numbers[name]
+            arrays['offset_'+name] = self.offsets[name]
+        for name in ('patch_names', 'patch_order', 'patch_start', 'ra', 'dec', 'dec_order'):
+            if getattr(self, name) is not None: arrays[name] = getattr(self, name)
+        with open(filename, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+
+    @classmethod
+    def load(cls, filename, key=None):
+        """
+        Load from a binary (npz) file, return None if it is not for key
+        """
+        with np.load(filename) as data:
+            if key is not None and str(data['key']) != key: return None
+            def prefixed(prefix):
+                return dict((f[len(prefix):], data[f]) for f in data.files if f.startswith(prefix))
+            numbers = prefixed('number_')
+            sky = cls(data['text'].tobytes(), data['pattern'], data['start'], data['end'],
+                      prefixed('string_'), numbers, prefixed('offset_'), prefixed('none_'))
+            for name in ('patch_names', 'patch_order', 'patch_start', 'ra', 'dec', 'dec_order'):
+                if name in data.files: setattr(sky, name, data[name])
+        return sky
+
+
+def cut_strings(text, start, offsets):
+    """
+    Return the array of strings text[start+offsets[:,0]:start+offsets[:,0]+offsets[:,1]]
+    """
+    offsets = offsets.astype(np.int64)
+    length = max(offsets[:,1].max(), 1) if len(offsets) else 1
+    text = np.frombuffer(text, dtype=np.uint8)
+    if len(text) == 0: return np.zeros(len(offsets), dtype='S1')
+    chars = np.arange(length)
+    idx = np.minimum(start[:,np.newaxis] + offsets[:,0:1] + chars, len(text)-1)
+    values = np.where(chars < offsets[:,1:2], text[idx], 0).astype(np.uint8)
+    return np.ascontiguousarray(values).view('S%i' % length).ravel()
+
+
+def parse_skymodel(text, patterns, patch=None, radec=None):
+    """
+    Match each line of text with the first matching of the patterns (compiled regexps)
+    return a SkyModel with the named groups of the matches, lines not matching are skipped
+    """
+    names = sorted(set(name for p in patterns for name in p.groupindex))
+    # index of each group name in each pattern (0: not in the pattern)
+    groupidx = [[p.groupindex.get(name, 0) for name in names] for p in patterns]
+    pattern, start, end, spans = [], [], [], []
+    pos = 0
+    # latin-1: one character per byte, so that positions are the same in text
+    lines = text.decode('latin-1').split('\n')
+    for j, line in enumerate(lines):
+        # same lines of readlines()
+        if j < len(lines)-1: line += '\n'
+        elif line == '': break
+        for i, p in enumerate(patterns):
+            v = p.search(line)
+            if v is not None:
+                pattern.append(i)
+                start.append(pos)
+                end.append(pos+len(line))
+                regs = v.regs
+                spans.append([regs[g] if g else (-1, -1) for g in groupidx[i]])
+                break
+        pos += len(line)
+
+    start = np.array(start, dtype=np.int64)
+    spans = np.array(spans, dtype=np.int64).reshape(len(start), len(names), 2)
+    nones, strings, numbers, offsets = {}, {}, {}, {}
+    for k, name in enumerate(names):
+        nones[name] = spans[:,k,0] == -1
+        offset = np.where(nones[name][:,np.newaxis], 0, np.column_stack((spans[:,k,0], spans[:,k,1]-spans[:,k,0])))
+        values = cut_strings(text, start, offset)
+        try:
+            # numeric group: values as floats, the exact strings stay in the text
+            numbers[name] = np.where(nones[name], np.nan, np.where(nones[name], '0', values).astype(np.float64))
+            offsets[name] = offset.astype(np.uint16) if offset.size == 0 or offset.max() < 2**16 else offset
+        except ValueError:
+            strings[name] = values
+    sky = SkyModel(text, np.array(pattern, dtype=np.int8), start, np.array(end, dtype=np.int64), \
+                   strings, numbers, offsets, nones)
+    if patch is not None: sky.make_patch_index(patch)
+    if radec is not None: sky.make_position_index(radec)
+    return sky
+
+
+def read_skymodel(filename, patterns, patch=None, radec=None, cache=True):
+    """
+    Parse filename with parse_skymodel(), using and updating the binary sidecar filename.<parser>.npz
+    patch: name of the group with the patch name, to index rows on patches
+    radec: names of the groups with ra and dec ((h,m,s), (d,m,s)), to index rows on positions
+    """
+    with open(filename, 'rb') as f:
+        text = f.read()
+    if not cache: return parse_skymodel(text, patterns, patch, radec)
+
+    parser = hashlib.sha1(repr((version, [p.pattern for p in patterns], [p.flags for p in patterns], patch, radec)).encode()).hexdigest()
+    key = parser + hashlib.sha1(text).hexdigest()
+    cachefile = '%s.%s.npz' % (filename, parser[:8])
+    if os.path.exists(cachefile):
+        try:
+            sky = SkyModel.load(cachefile, key)
+            if sky is not None:
+                logging.debug('Skymodel %s read from %s' % (filename, cachefile))
+                return sky
+        except Exception as e:
+            logging.warning('Cannot read skymodel cache %s (%s)' % (cachefile, e))
+
+    sky = parse_skymodel(text, patterns, patch, radec)
+    try:
+        sky.save(cachefile, key)
+        logging.info('Skymodel %s cached in %s' % (filename, cachefile))
+    except (IOError, OSError) as e:
+        logging.warning('Cannot write skymodel cache %s (%s)' % (cachefile, e))
+    return sky
@@ -22,6 +22,7 @@
 import os.path, sys, pickle, glob, argparse, re, logging
 import numpy as np
 from lib_fits import flatten
+from lib_multiproc import multiprocManager
 from astropy.io import fits as pyfits
 from astropy.wcs import WCS as pywcs
 from astropy.table import Table
@@ -47,6 +48,8 @@ parser.add_argument('--shift', dest='shift', action='store_true', help='Shift im
 parser.add_argument('--find_noise', dest='find_noise', action='store_true', help='Find noise from image (default: assume equal weights, ignored if noises are given)')
 parser.add_argument('--save', dest='save', action='store_true', help='Save intermediate results (default: False)')
 parser.add_argument('--output', dest='output', default='mosaic.fits', help='Name of output mosaic (default: mosaic.fits)')
+parser.add_argument('--tile', dest='tile', type=int, help='Make the mosaic in square tiles of this size (pixels), written directly in the memory-mapped output (default: whole mosaic in memory)')
+parser.add_argument('--ncpu', dest='ncpu', default=1, type=int, help='Number of directions to reproject in parallel (default: 1)')
 
 args = parser.parse_args()
 logging.root.setLevel(logging.DEBUG)
@@ -256,53 +259,187 @@ else:
         logging.error("--header must be a fits file.")
         sys.exit(1)
 
-logging.info('Making mosaic...')
-isum = np.zeros([ysize,xsize])
-wsum = np.zeros_like(isum)
-mask = np.zeros_like(isum,dtype=np.bool)
-for d in directions:
-    logging.info('Working on: %s' % d.imagefile)
-
+def reproject_direction(d, hdr, tile=None):
+    """
+    Reproject image and weights of direction d on hdr
+    tile: (yslice, xslice) of the full mosaic covered by hdr, to cut images reprojected and saved by a previous run
+    return image, weights and the mask of the pixels covered by d
+    """
     outname = d.imagefile.replace('.fits','-reproj.fits')
     if os.path.exists(outname):
         logging.debug('Loading %s...' % outname)
-        r = pyfits.open(outname)[0].data
+        r = pyfits.open(outname, memmap=True)[0].data
+        if tile is not None: r = np.array(r[tile])
     else:
         logging.debug('Reprojecting data...')
-        r, footprint = reproj((d.img_data, d.img_hdr), regrid_hdr)#, parallel=True)
+        r, footprint = reproj((d.img_data, d.img_hdr), hdr)#, parallel=True)
         r[ np.isnan(r) ] = 0
-        hdu = pyfits.PrimaryHDU(header=regrid_hdr, data=r)
-        if args.save:
+        if args.save and tile is None:
+            hdu = pyfits.PrimaryHDU(header=hdr, data=r)
             hdu.writeto(outname, clobber=True)
 
     outname = d.imagefile.replace('.fits','-reprojW.fits')
     if os.path.exists(outname):
         logging.debug('Loading %s...' % outname)
-        w = pyfits.open(outname)[0].data
-        mask |= (w>0)
+        w = pyfits.open(outname, memmap=True)[0].data
+        if tile is not None: w = np.array(w[tile])
+        mask = (w>0)
     else:
         logging.debug('Reprojecting weights...')
-        w, footprint = reproj((d.weight_data, d.img_hdr), regrid_hdr)#, parallel=True)
-        mask |= ~np.isnan(w)
+        w, footprint = reproj((d.weight_data, d.img_hdr), hdr)#, parallel=True)
+        mask = ~np.isnan(w)
         w[ np.isnan(w) ] = 0
-        hdu = pyfits.PrimaryHDU(header=regrid_hdr, data=w)
-        if args.save:
+        if args.save and tile is None:
+            hdu = pyfits.PrimaryHDU(header=hdr, data=w)
             hdu.writeto(outname, clobber=True)
-    logging.debug('Add to mosaic...')
-    isum += r*w
-    wsum += w
 
-logging.debug('Write mosaic: %s...' % args.output)
-# mask now contains True where a non-nan region was present in either map
-isum /= wsum
-isum[~mask] = np.nan
+    return r, w, mask
+
+
+def reproject_worker(i, hdr, tile, outQueue=None):
+    """
+    Reproject the i-th direction in a separate process
+    on error [i, exception] is returned, as the parent waits for a result of every direction
+    """
+    try:
+        outQueue.put([i] + [np.asarray(x) for x in reproject_direction(directions[i], hdr, tile)])
+    except Exception as e:
+        logging.exception('Reprojection of %s failed.' % directions[i].imagefile)
+        try: pickle.dumps(e)
+        except Exception: e = Exception(repr(e))
+        outQueue.put([i, e])
+
+
+def make_mosaic(hdr, dirs, tile=None):
+    """
+    Combine the directions reprojected on hdr
+    with ncpu > 1 directions are reprojected in parallel (at most ncpu ahead of the next one to sum),
+    but always summed in the given order
+    return the mosaic, nan where no direction is present
+    """
+    isum = np.zeros([hdr['NAXIS2'],hdr['NAXIS1']])
+    wsum = np.zeros_like(isum)
+    mask = np.zeros_like(isum,dtype=np.bool)
+
+    def add(d, r, w, m):
+        logging.debug('Add to mosaic: %s...' % d.imagefile)
+        isum[:] += r*w
+        wsum[:] += w
+        mask[:] |= m
+
+    if args.ncpu > 1 and len(dirs) > 1:
+        # processes are forked: directions are found in the global list
+        idxs = [directions.index(d) for d in dirs]
+        ahead = min(args.ncpu, len(dirs))
+        mpm = multiprocManager(ahead, reproject_worker)
+        # keep results coming out of order until all the previous ones are summed,
+        # the window of directions submitted ahead bounds how many full-size results are held
+        done = {}
+        submitted = received = 0
+        for n, i in enumerate(idxs):
+            while submitted < min(n+ahead, len(idxs)):
+                logging.info('Working on: %s' % directions[idxs[submitted]].imagefile)
+                mpm.put([idxs[submitted], hdr, tile])
+                submitted += 1
+            while not i in done:
+                res = mpm.outQueue.get()
+                received += 1
+                if isinstance(res[1], Exception):
+                    # collect the directions still running before stopping the workers
+                    for j in xrange(submitted-received): mpm.outQueue.get()
+                    mpm.wait()
+                    raise res[1]
+                done[res[0]] = res[1:]
+            add(directions[i], *done.pop(i))
+        mpm.wait()
+    else:
+        for d in dirs:
+            logging.info('Working on: %s' % d.imagefile)
+            add(d, *reproject_direction(d, hdr, tile))
+
+    # mask now contains True where a non-nan region was present in either map
+    isum /= wsum
+    isum[~mask] = np.nan
+    return isum
+
+
+def direction_bbox(d, rwcs, margin=2):
+    """
+    Return the box (xmin, xmax, ymin, ymax) of the mosaic pixels where direction d has non-zero weights
+    the edges of the weighted region are sampled, as they are not straight lines in the mosaic projection
+    """
+    ys, xs = np.where(d.weight_data)
+    if len(xs) == 0: return None
+    # one more input pixel for the interpolation
+    x0, x1 = max(xs.min()-1, 0), min(xs.max()+1, d.weight_data.shape[1]-1)
+    y0, y1 = max(ys.min()-1, 0), min(ys.max()+1, d.weight_data.shape[0]-1)
+    del(xs)
+    del(ys)
+    ex = np.linspace(x0, x1, 100)
+    ey = np.linspace(y0, y1, 100)
+    xs = np.concatenate([ex, ex, np.full(100, x0), np.full(100, x1)])
+    ys = np.concatenate([np.full(100, y0), np.full(100, y1), ey, ey])
+    ra, dec = d.get_wcs().wcs_pix2world(xs, ys, 0)
+    nx, ny = rwcs.wcs_world2pix(ra, dec, 0)
+    if np.isnan(nx).any() or np.isnan(ny).any(): return (-np.inf, np.inf, -np.inf, np.inf)
+    return (nx.min()-margin, nx.max()+margin, ny.min()-margin, ny.max()+margin)
+
+
+def create_fits(filename, header, dtype=np.float64):
+    """
+    Create filename with header and a data array of header's size written straight on disk
+    return the file opened in update mode, with the data memory-mapped
+    """
+    hdr = pyfits.PrimaryHDU(data=np.zeros((1,1), dtype=dtype), header=header).header
+    hdr['NAXIS1'] = header['NAXIS1']
+    hdr['NAXIS2'] = header['NAXIS2']
+    hdr.tofile(filename, clobber=True)
+    nbytes = header['NAXIS1'] * header['NAXIS2'] * np.dtype(dtype).itemsize
+    with open(filename, 'rb+') as f:
+        f.seek(len(hdr.tostring()) + int(np.ceil(nbytes/2880.))*2880 - 1)
+        f.write(b'\0')
+    return pyfits.open(filename, mode='update', memmap=True)
+
 
 for ch in ('BMAJ', 'BMIN', 'BPA'):
     regrid_hdr[ch] = pyfits.open(directions[0].imagefile)[0].header[ch]
     regrid_hdr['ORIGIN'] = 'pill-pipe-mosaic'
     regrid_hdr['UNITS'] = 'Jy/beam'
 
-hdu = pyfits.PrimaryHDU(header=regrid_hdr, data=isum)
-hdu.writeto(args.output, clobber=True)
+if args.tile is None:
+    logging.info('Making mosaic...')
+    isum = make_mosaic(regrid_hdr, directions)
+
+    logging.debug('Write mosaic: %s...' % args.output)
+    hdu = pyfits.PrimaryHDU(header=regrid_hdr, data=isum)
+    hdu.writeto(args.output, clobber=True)
+
+else:
+    if args.save:
+        logging.warning('Reprojected images are not saved when making the mosaic in tiles.')
+    logging.info('Making mosaic in tiles of %i pixels...' % args.tile)
+    rwcs = pywcs(regrid_hdr).celestial
+    bboxes = [direction_bbox(d, rwcs) for d in directions]
+    out = create_fits(args.output, regrid_hdr)
+    for y0 in xrange(0, ysize, args.tile):
+        for x0 in xrange(0, xsize, args.tile):
+            y1 = min(y0+args.tile, ysize)
+            x1 = min(x0+args.tile, xsize)
+            tile_dirs = [d for d, b in zip(directions, bboxes) if b is not None and \
+                         b[0] <= x1 and b[1] >= x0 and b[2] <= y1 and b[3] >= y0]
+            logging.info('Tile x: %i-%i y: %i-%i (%i directions)' % (x0, x1, y0, y1, len(tile_dirs)))
+            if len(tile_dirs) == 0:
+                out[0].data[y0:y1,x0:x1] = np.nan
+                continue
+            # same header with the reference pixel moved to the tile
+            tile_hdr = regrid_hdr.copy()
+            tile_hdr['CRPIX1'] -= x0
+            tile_hdr['CRPIX2'] -= y0
+            tile_hdr['NAXIS1'] = x1-x0
+            tile_hdr['NAXIS2'] = y1-y0
+            out[0].data[y0:y1,x0:x1] = make_mosaic(tile_hdr, tile_dirs, (slice(y0,y1),slice(x0,x1)))
+            out.flush()
+    logging.debug('Write mosaic: %s...' % args.output)
+    out.close()
 
 logging.debug('Done.')
@@ -47,17 +47,39 @@ def setupiofiles(inms, outms, incolumn, outcolumn):
   to.close()
   return outms
 
-def mslin2circ(incol, outcol, outms, skipmetadata):
+# polarisation conversion matrices: out[...,i] = sum_j M[i,j] * in[...,j]
+I=numpy.complex(0.0,1.0)
+LIN2CIRC = 0.5*numpy.array([[ 1,-I, I, 1],
+                            [ 1, I, I,-1],
+                            [ 1,-I,-I,-1],
+                            [ 1, I,-I, 1]])
+CIRC2LIN = 0.5*numpy.array([[ 1, 1, 1, 1],
+                            [ I,-I, I,-I],
+                            [-I,-I, I, I],
+                            [ 1,-1,-1, 1]])
+
+def convertcol(tc, incol, outcol, matrix, chunk):
+  """
+  Apply the polarisation matrix to incol and write outcol, chunk rows at a time.
+  Read and output buffers are allocated once and reused, so memory is bounded by the chunk size
+  and incol can be overwritten in place.
+  """
+  nrows = tc.nrows()
+  cell = tc.getcell(incol,0)
+  bufin = numpy.empty((min(chunk,nrows),)+cell.shape, dtype=cell.dtype)
+  bufout = numpy.empty_like(bufin)
+  # (row, chan, pol) x (pol, pol) in the column precision
+  matrixT = matrix.T.astype(cell.dtype)
+  for row in xrange(0, nrows, chunk):
+    nrow = min(chunk, nrows-row)
+    print "Rows %i-%i of %i" % (row, row+nrow, nrows)
+    tc.getcolnp(incol, bufin[:nrow], row, nrow)
+    numpy.matmul(bufin[:nrow], matrixT, out=bufout[:nrow])
+    tc.putcol(outcol, bufout[:nrow], row, nrow)
+
+def mslin2circ(incol, outcol, outms, skipmetadata, chunk):
   tc = pt.table(outms, readonly=False, ack=False)
-  dataXY = tc.getcol(incol)
-  I=numpy.complex(0.0,1.0)
-  dataRL = 0.5* numpy.transpose(numpy.array([
-           +dataXY[:,:,0]-I*dataXY[:,:,1]+I*dataXY[:,:,2]+dataXY[:,:,3],
-           +dataXY[:,:,0]+I*dataXY[:,:,1]+I*dataXY[:,:,2]-dataXY[:,:,3],
-           +dataXY[:,:,0]-I*dataXY[:,:,1]-I*dataXY[:,:,2]-dataXY[:,:,3],
-           +dataXY[:,:,0]+I*dataXY[:,:,1]-I*dataXY[:,:,2]+dataXY[:,:,3]]),
-           (1,2,0))
-  tc.putcol(outcol,dataRL)
+  convertcol(tc, incol, outcol, LIN2CIRC, chunk)
 
   #Change metadata information to be circular feeds
   if not skipmetadata:
@@ -70,17 +92,9 @@ def mslin2circ(incol, outcol, outms, skipmetadata):
 
   tc.close()
 
-def mscirc2lin(incol, outcol, outms, skipmetadata):
+def mscirc2lin(incol, outcol, outms, skipmetadata, chunk):
   tc = pt.table(outms,readonly=False, ack=False)
-  dataRL = tc.getcol(incol)
-  I=numpy.complex(0.0,1.0)
-  dataXY = 0.5* numpy.transpose(numpy.array([
-              +dataRL[:,:,0]+dataRL[:,:,1]+dataRL[:,:,2]+dataRL[:,:,3],
-           I*(+dataRL[:,:,0]-dataRL[:,:,1]+dataRL[:,:,2]-dataRL[:,:,3]),
-           I*(-dataRL[:,:,0]-dataRL[:,:,1]+dataRL[:,:,2]+dataRL[:,:,3]),
-              +dataRL[:,:,0]-dataRL[:,:,1]-dataRL[:,:,2]+dataRL[:,:,3] ]),
-           (1,2,0))
-  tc.putcol(outcol,dataXY)
+  convertcol(tc, incol, outcol, CIRC2LIN, chunk)
 
   #Change metadata information to be circular feeds
   if not skipmetadata:
@@ -94,35 +108,39 @@ def mscirc2lin(incol, outcol, outms, skipmetadata):
   tc.close()
 
 
-def mergeweights(outms):
+def mergeweights(outms, chunk):
   """
   Merge weights (weights become the average across the 4 polarizations)
   """
   print "WARNING: updating weights, cannot reverse to original."
   tc = pt.table(outms,readonly=False, ack=False)
-  weights = tc.getcol('WEIGHT_SPECTRUM')
-  shape = weights.shape
-  # find the mean along the pol axis and then expand the array
-  weights = numpy.repeat(numpy.mean(weights, axis=2), 4, axis=1).reshape(shape)
-  tc.putcol('WEIGHT_SPECTRUM',weights)
+  for row in xrange(0, tc.nrows(), chunk):
+    weights = tc.getcol('WEIGHT_SPECTRUM', row, chunk)
+    # find the mean along the pol axis and then expand the array
+    weights[:] = numpy.mean(weights, axis=2)[:,:,numpy.newaxis]
+    tc.putcol('WEIGHT_SPECTRUM',weights, row, chunk)
   tc.close()
 
 
-def mergeflags(outms):
+def mergeflags(outms, chunk):
   """
   Merge flags (if a pol is flagged, flag everything)
   """
   tc = pt.table(outms,readonly=False, ack=False)
-  flag = tc.getcol('FLAG')
-  print "Initial flags:", numpy.count_nonzero(flag)
-  shape = flag.shape
-  # find if any data is flagged along the pol axis and then expand the array
-  flag = numpy.repeat( numpy.any(flag, axis=2), 4, axis=1).reshape(shape)
-  #for time in xrange(flag.shape[0]):
-  #    for chan in xrange(flag.shape[1]):
-  #        flag[time][chan] = numpy.count_nonzero(flag[time][chan]) > 0
-  print "Final flags:", numpy.count_nonzero(flag)
-  tc.putcol('FLAG',flag)
+  nflag_in = 0
+  nflag_out = 0
+  for row in xrange(0, tc.nrows(), chunk):
+    flag = tc.getcol('FLAG', row, chunk)
+    nflag_in += numpy.count_nonzero(flag)
+    # find if any data is flagged along the pol axis and then expand the array
+    flag[:] = numpy.any(flag, axis=2)[:,:,numpy.newaxis]
+    #for time in xrange(flag.shape[0]):
+    #    for chan in xrange(flag.shape[1]):
+    #        flag[time][chan] = numpy.count_nonzero(flag[time][chan]) > 0
+    nflag_out += numpy.count_nonzero(flag)
+    tc.putcol('FLAG',flag, row, chunk)
+  print "Initial flags:", nflag_in
+  print "Final flags:", nflag_out
   tc.close()
 
 
@@ -144,6 +162,7 @@ opt.add_option('-o','--outms',help='Output MS (format: ms:COLUMN, default ms: In
 opt.add_option('-r','--reverse',action="store_true",default=False,help='Convert from circular to linear')
 opt.add_option('-s','--skipmetadata',action="store_true",default=False,help='Skip setting the metadata correctly')
 opt.add_option('-w','--weights',action="store_true",default=False,help='Weights are updated to reflect the combined polarization (cannot be undone with -r)')
+opt.add_option('-c','--chunk',help='Number of rows read and converted at once',type='int',default=100000)
 options, arguments = opt.parse_args()
 
 if options.outms == '':
@@ -168,9 +187,9 @@ print "INFO: inms: "+inms+" (column: "+incolumn+")"
 print "INFO: outms: "+outms+" (column: "+outcolumn+")"
 
 if options.reverse == True:
-   mscirc2lin(incolumn, outcolumn, outms, options.skipmetadata)
+   mscirc2lin(incolumn, outcolumn, outms, options.skipmetadata, options.chunk)
 else:
-   mslin2circ(incolumn, outcolumn, outms, options.skipmetadata)
-if options.weights: mergeweights(outms)
-mergeflags(outms)
+   mslin2circ(incolumn, outcolumn, outms, options.skipmetadata, options.chunk)
+if options.weights: mergeweights(outms, options.chunk)
+mergeflags(outms, options.chunk)
 updatehistory(outms)
@@ -20,6 +20,7 @@
 import re
 import math
 import optparse
+import lib_skymodel
 
 
 def convert_sky_bbs_lsm(infilename,outfilename):
@@ -267,15 +268,13 @@ def convert_sky_bbs_lsm(infilename,outfilename):
 
 
 
- infile=open(infilename,'r')
- all=infile.readlines()
- infile.close()
+ # parsed lines are cached in a binary file next to the sky model
+ sky=lib_skymodel.read_skymodel(infilename,[pp3,pp2,pp1,pp],patch='col3',radec=lib_skymodel.radec_bbs)
  outfile=open(outfilename,'w')
  outfile.write("## LSM file\n")
  outfile.write("### Name  | RA (hr,min,sec) | DEC (deg,min,sec) | I | Q | U |  V | SI | RM | eX | eY | eP | freq0\n")
- for eachline in all:
-   v=pp3.search(eachline)
-   if v!= None:
+ for (p,v) in sky:
+   if p==0:
 ################################################################################
           stype=v.group('col2')
           sname=str(v.group('col1'))
@@ -308,10 +307,9 @@ def convert_sky_bbs_lsm(infilename,outfilename):
             #print 'Error in source '+strline
 ################################################################################
    else:
-     v=pp2.search(eachline)
-     if v!= None:
+     if p==1:
 ################################################################################
-        print eachline
+        print v.string
         stype=v.group('col2')
         sname=str(v.group('col1'))
         bad_source=False
@@ -346,8 +344,7 @@ def convert_sky_bbs_lsm(infilename,outfilename):
 
 ################################################################################
      else:
-       v=pp1.search(eachline)
-       if v!= None:
+       if p==2:
 ################################################################################
         strline=str(v.group('col1'))+' '+str(v.group('col4'))+' '+str(v.group('col5'))+' '+str(v.group('col6'))
         strline=strline+' '+str(v.group('col7'))+' '+str(v.group('col8'))+' '+str(v.group('col9'))+' '+str(v.group('col10'))
@@ -357,8 +354,7 @@ def convert_sky_bbs_lsm(infilename,outfilename):
 
 ################################################################################
        else:
-        v=pp.search(eachline)
-        if v!= None:
+        if p==3:
 ################################################################################
          strline=str(v.group('col1'))+' '+str(v.group('col4'))+' '+str(v.group('col5'))+' '+str(v.group('col6'))
          strline=strline+' '+str(v.group('col7'))+' '+str(v.group('col8'))+' '+str(v.group('col9'))+' '+str(v.group('col10'))
@@ -454,17 +450,14 @@ def convert_sky_lsm_bbs(infilename,outfilename):
    [\S\s]*""",re.VERBOSE)
 
 
-  infile=open(infilename,'r')
-  all=infile.readlines()
-  infile.close()
+  # parsed lines are cached in a binary file next to the sky model
+  sky=lib_skymodel.read_skymodel(infilename,[pp],radec=lib_skymodel.radec_lsm)
   outfile=open(outfilename,'w')
   outfile.write("# (Name, Type, Patch, Ra, Dec, I, Q, U, V, ReferenceFrequency='150e6',  SpectralIndex='[0.0]', Ishapelet) = format\n")
   outfile.write("# The above line defines the field order and is required.\n")
   outfile.write(", , CENTER, put:ra:here, put.dec.here\n") 
 
-  for eachline in all:
-    v=pp.search(eachline)
-    if v!= None:
+  for (p,v) in sky:
      # check for /GAUSSIANS
      firstchar=v.group('col1')[0]
      if firstchar=='G' or firstchar=='g':
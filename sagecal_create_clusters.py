@@ -20,6 +20,12 @@
 import re
 import math,numpy
 import optparse
+from collections import OrderedDict
+import lib_skymodel
+try:
+  from scipy.spatial import cKDTree
+except ImportError:
+  cKDTree=None
 
 
 # read sky model text file and return dictionary
@@ -107,43 +113,48 @@ def read_lsm_sky(infilename):
    [\S\s]*""",re.VERBOSE)
 
 
-  infile=open(infilename,'r')
-  all=infile.readlines()
-  infile.close()
-
-  SR={} # sources
-  for eachline in all:
-    v=pp1.search(eachline)
-    if v!= None:
-      # find RA,DEC (rad) and flux
-      mra=(float(v.group('col2'))+float(v.group('col3'))/60.0+float(v.group('col4'))/3600.0)*360.0/24.0*math.pi/180.0
-      mdec=(float(v.group('col5'))+float(v.group('col6'))/60.0+float(v.group('col7'))/3600.0)*math.pi/180.0
-      SR[str(v.group('col1'))]=(v.group('col1'),mra,mdec,float(v.group('col8')))
-    else:  
-      v=pp.search(eachline)
-      if v!= None:
-        mra=(float(v.group('col2'))+float(v.group('col3'))/60.0+float(v.group('col4'))/3600.0)*360.0/24.0*math.pi/180.0
-        mdec=(float(v.group('col5'))+float(v.group('col6'))/60.0+float(v.group('col7'))/3600.0)*math.pi/180.0
-        SR[str(v.group('col1'))]=(v.group('col1'),mra,mdec,float(v.group('col8')))
+  # parsed lines are cached in a binary file next to the sky model
+  sky=lib_skymodel.read_skymodel(infilename,[pp1,pp],radec=lib_skymodel.radec_lsm)
+  # find RA,DEC (rad) and flux
+  mra=(sky.column('col2')+sky.column('col3')/60.0+sky.column('col4')/3600.0)*360.0/24.0*math.pi/180.0
+  mdec=(sky.column('col5')+sky.column('col6')/60.0+sky.column('col7')/3600.0)*math.pi/180.0
+  sI=sky.column('col8')
+
+  SR=OrderedDict() # sources, in the order of the file so that clustering is reproducible
+  for ci,name in enumerate(sky.group('col1')):
+    SR[name]=(name,mra[ci],mdec[ci],sI[ci])
 
   print 'Read %d sources'%len(SR)
 
   return SR
 
 
-# find closet cluster for this source ra,dec
+# find closest cluster for each source ra,dec (arrays)
 # C: ra,dec of cluster centroids
 # Ccos: cos(C), Csin: sin(C)
-def find_closest(ra,dec,C,Ccos,Csin):
-   sin_deltaalpha=numpy.sin(C[:,0]-ra)
-   cos_deltaalpha=numpy.cos(C[:,0]-ra)
-
-   sin_delta_a=math.sin(dec)
-   cos_delta_a=math.cos(dec)
-   denominator=sin_delta_a*Csin+cos_delta_a*numpy.multiply(Ccos,cos_deltaalpha)
-   numerator=numpy.square(numpy.multiply(Ccos,sin_deltaalpha)) + numpy.square(cos_delta_a*Csin-sin_delta_a*numpy.multiply(Ccos,cos_deltaalpha))
-   d=numpy.arctan2(numpy.sqrt(numerator),denominator)
-   idx=numpy.argmin(numpy.abs(d))
+# block: max number of source-cluster distances computed at once
+def find_closest(ra,dec,C,Ccos,Csin,block=1000000):
+   idx=numpy.zeros(len(ra),dtype=int)
+   step=max(1,block//len(C))
+   for i0 in range(0,len(ra),step):
+     mra=ra[i0:i0+step,None]
+     mdec=dec[i0:i0+step,None]
+     sin_deltaalpha=numpy.sin(C[:,0]-mra)
+     cos_deltaalpha=numpy.cos(C[:,0]-mra)
+
+     sin_delta_a=numpy.sin(mdec)
+     cos_delta_a=numpy.cos(mdec)
+     denominator=sin_delta_a*Csin+cos_delta_a*numpy.multiply(Ccos,cos_deltaalpha)
+     numerator=numpy.square(numpy.multiply(Ccos,sin_deltaalpha)) + numpy.square(cos_delta_a*Csin-sin_delta_a*numpy.multiply(Ccos,cos_deltaalpha))
+     d=numpy.arctan2(numpy.sqrt(numerator),denominator)
+     idx[i0:i0+step]=numpy.argmin(numpy.abs(d),axis=1)
+   return idx
+
+# same as find_closest, using a kd-tree on the unit vectors of the centroids
+# the closest chord is the closest angular distance
+def find_closest_tree(ra,dec,C,Ccos,Csin):
+   tree=cKDTree(numpy.array([Ccos*numpy.cos(C[:,0]),Ccos*numpy.sin(C[:,0]),Csin]).T)
+   dist,idx=tree.query(numpy.array([numpy.cos(dec)*numpy.cos(ra),numpy.cos(dec)*numpy.sin(ra),numpy.sin(dec)]).T)
    return idx
 
 
@@ -180,14 +191,15 @@ def radec_to_lm_SIN(ra0,dec0,ra,dec):
     #l=-math.sin(ra-ra0)*math.cos(dec)
     #m=-(math.cos(ra-ra0)*math.cos(dec)*math.sin(dec0)-math.cos(dec0)*math.sin(dec))
     l=-numpy.multiply(sin_alpha,cos_dec)
-    m=-math.sin(dec0)*numpy.multiply(cos_alpha,cos_dec)+math.cos(dec0)*sin_dec
+    m=-numpy.sin(dec0)*numpy.multiply(cos_alpha,cos_dec)+numpy.cos(dec0)*sin_dec
     return (l,m)
 
 
 
 
 #### main clustering routine : Q clusters
-def cluster_this(skymodel,Q,outfile,max_iterations):
+# with more than tree_min clusters, the closest one is found with a kd-tree (if scipy is available)
+def cluster_this(skymodel,Q,outfile,max_iterations,tree_min=100):
    SKY=read_lsm_sky(skymodel)
    K=len(SKY)
    # check if we have more sources than clusters, otherwise change Q
@@ -195,31 +207,23 @@ def cluster_this(skymodel,Q,outfile,max_iterations):
      Q=K
 
    # create arrays for all source info (ra,dec,sI) for easy access
-   X=numpy.zeros([K,3])
-   # iterate over sources
-   ci=0;
-   for val in SKY.itervalues():
-      X[ci,0]=val[1]
-      X[ci,1]=val[2]
-      X[ci,2]=val[3]
-      ci=ci+1
+   X=numpy.array([val[1:4] for val in SKY.itervalues()],dtype=float).reshape(K,3)
    # source names
    sources=SKY.keys()
    # centroids of Q clusters
-   C=numpy.zeros([Q,2])
    # 1: select the Q brightest sources, initialize cluster centroids as their locations
-   sItmp=numpy.copy(X[:,2])
-   for ci in range(0,Q):
-      # find max 
-      sImax=numpy.argmax(sItmp)
-      C[ci,0]=X[sImax,0]
-      C[ci,1]=X[sImax,1]
-      sItmp[sImax]=0.0
+   # (stable sort: the first in the sky model wins between equal fluxes)
+   C=numpy.copy(X[numpy.argsort(-X[:,2],kind='mergesort')[:Q],0:2])
    #print C
    # calculate weights
 
+   if Q>=tree_min and cKDTree is not None:
+     closest=find_closest_tree
+   else:
+     closest=find_closest
+
    # arrays to store which cluster each source belongs to
-   CL=numpy.zeros(K)
+   CL=numpy.zeros(K,dtype=int)
    CLold=numpy.copy(CL)
 
    no_more_cluster_changes=False
@@ -229,59 +233,25 @@ def cluster_this(skymodel,Q,outfile,max_iterations):
       Ccos=numpy.cos(C[:,1])
       Csin=numpy.sin(C[:,1])
 
-
-      D={} # empty dict
       # 2:  assign each source to the cluster closest to it 
-      for ci in range(0,K):
-          mra=X[ci,0]
-          mdec=X[ci,1]
-          closest=find_closest(mra,mdec,C,Ccos,Csin)
-          #print "src %d closest %d"%(ci,closest)
-          CL[ci]=closest
-          # add this source to dict
-          if D.has_key(closest):
-              D[closest].append(ci)
-          else:
-              D[closest]=list()
-              D[closest].append(ci)
-      #print D
-      
+      CL=closest(X[:,0],X[:,1],C,Ccos,Csin)
+
       # check to see also if source assignment changes
-      if numpy.sum(CL-CLold)==0:
+      if numpy.all(CL==CLold):
        no_more_cluster_changes=True
 
       CLold=numpy.copy(CL)
   
       # 3: update the  cluster centroids
-      for (clusid,sourcelist) in D.items():
-        # update centroid of cluster id 'clusid'
-        # project soure ra,dec coordinates to l,m with center of projection
-        # taken as current centroid, then take the weighted average 
-        #print clusid,sourcelist
-        aRa=numpy.zeros(len(sourcelist))
-        aDec=numpy.zeros(len(sourcelist))
-        aW=numpy.zeros(len(sourcelist))
-        ck=0
-        for sourceid in sourcelist:
-          aRa[ck]=X[sourceid,0] 
-          aDec[ck]=X[sourceid,1] 
-          aW[ck]=X[sourceid,2] 
-          #print sources[sourceid],aRa[ck],aDec[ck],aW[ck]
-          ck=ck+1
-        ### check
-        ###(l1,m1)=radec_to_lm_SIN(C[clusid,0],C[clusid,1],aRa[0],aDec[0])
-        ###(ra1,dec1)=lm_to_radec(C[clusid,0],C[clusid,1],l1,m1)
-        ###print "CHECK %f,%f -> %f,%f"%(aRa[0],aDec[0],ra1,dec1)
-        (L,M)=radec_to_lm_SIN(C[clusid,0],C[clusid,1],aRa,aDec)
-        #print L,M
-        sumsI=numpy.sum(aW)
-        Lmean=numpy.sum(numpy.multiply(aW,L))/sumsI
-        Mmean=numpy.sum(numpy.multiply(aW,M))/sumsI
-        (ra1,dec1)=lm_to_radec(C[clusid,0],C[clusid,1],Lmean,Mmean)
-        ##sumsI=numpy.sum(aW)
-        ##ra1=numpy.sum(numpy.multiply(aW,aRa))/sumsI
-        ##dec1=numpy.sum(numpy.multiply(aW,aDec))/sumsI
-        #print "Cen %f,%f -> %f,%f"%(C[clusid,0],C[clusid,1],ra1,dec1)
+      # project soure ra,dec coordinates to l,m with center of projection
+      # taken as current centroid of their cluster, then take the weighted average 
+      (L,M)=radec_to_lm_SIN(C[CL,0],C[CL,1],X[:,0],X[:,1])
+      sumsI=numpy.bincount(CL,weights=X[:,2],minlength=Q)
+      Lsum=numpy.bincount(CL,weights=numpy.multiply(X[:,2],L),minlength=Q)
+      Msum=numpy.bincount(CL,weights=numpy.multiply(X[:,2],M),minlength=Q)
+      # only clusters with sources are updated
+      for clusid in numpy.unique(CL):
+        (ra1,dec1)=lm_to_radec(C[clusid,0],C[clusid,1],Lsum[clusid]/sumsI[clusid],Msum[clusid]/sumsI[clusid])
         # update centroid
         C[clusid,0]=ra1
         C[clusid,1]=dec1
@@ -292,9 +262,9 @@ def cluster_this(skymodel,Q,outfile,max_iterations):
    # write output
    outF=open(outfile,'w+')
    outF.write('# Cluster file\n')
-   for (clusid,sourcelist) in D.items():
+   for clusid in numpy.unique(CL):
      outF.write(str(clusid+1)+' 1')
-     for sourceid in sourcelist:
+     for sourceid in numpy.where(CL==clusid)[0]:
        outF.write(' '+sources[sourceid])
      outF.write('\n')
    outF.close()
@@ -305,7 +275,7 @@ if __name__ == '__main__':
   parser.add_option('-s', '--skymodel', help='Input sky model')
   parser.add_option('-c', '--clusters', type='int', help='Number of clusters')
   parser.add_option('-o', '--outfile', help='Output cluster file')
-  parser.add_option('-i', '--iterations', type='int', help='Number of iterations')
+  parser.add_option('-i', '--iterations', type='int', default=100, help='Max number of iterations, stops before if clusters do not change (default: 100)')
   (opts,args)=parser.parse_args()
 
   if opts.skymodel and opts.clusters and opts.outfile:
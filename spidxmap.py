@@ -20,6 +20,7 @@
 import os, sys, argparse, logging
 import numpy as np
 from lib_linearfit import linear_fit_bootstrap as linearfit
+from lib_multiproc import multiprocManager
 from lib_fits import flatten
 from lib_beamdeconv import findCommonBeam
 from astropy.io import fits as pyfits
@@ -45,6 +46,7 @@ parser.add_argument('--save', dest='save', action='store_true', help='Save inter
 parser.add_argument('--sigma', dest='sigma', type=float, help='Restrict to pixels above this sigma in all images')
 parser.add_argument('--circbeam', dest='circbeam', action='store_true', help='Force final beam to be circular (default: False, use minimum common beam area)')
 parser.add_argument('--output', dest='output', default='spidx.fits', help='Name of output mosaic (default: mosaic.fits)')
+parser.add_argument('--ncpu', dest='ncpu', type=int, default=1, help='Number of processes used to fit the pixels, split in tiles of rows (default: 1)')
 
 args = parser.parse_args()
 
@@ -229,20 +231,49 @@ for image in all_images:
 frequencies = [ image.freq for image in all_images ]
 if args.noise: yerr = [ image.noise for image in all_images ]
 else: yerr = None
-spidx_data = np.empty(shape=(xsize, ysize))
-spidx_data[:] = np.nan
-spidx_err_data = np.empty(shape=(xsize, ysize))
-spidx_err_data[:] = np.nan
-
-for i in xrange(xsize):
-    print '.',
-    sys.stdout.flush()
-    for j in xrange(ysize):
-        val4reg = [ image.img_data[i,j] for image in all_images ]
-        if np.isnan(val4reg).any(): continue
-        (a, b, sa, sb) = linearfit(x=frequencies, y=val4reg, yerr=yerr, tolog=True)
-        spidx_data[i,j] = a
-        spidx_err_data[i,j] = sa
+# stack the regridded images in a cube (image, x, y)
+cube = np.array([ image.img_data for image in all_images ])
+
+def fit_pixels(cube, npix=1000):
+    """
+    Fit spidx and its error for all the pixels of cube (image, x, y)
+    pixels blanked or not positive in any image are skipped (left nan)
+    pixels are fitted together in blocks of npix to bound the bootstrap memory (niter x npix x images)
+    """
+    spidx_data = np.empty(shape=cube.shape[1:])
+    spidx_data[:] = np.nan
+    spidx_err_data = np.empty(shape=cube.shape[1:])
+    spidx_err_data[:] = np.nan
+
+    with np.errstate(invalid='ignore'):
+        good = np.all(cube > 0, axis=0) # nan are not > 0
+    val4reg = cube[:,good].T # (pixel, image)
+    a = np.empty(len(val4reg))
+    sa = np.empty(len(val4reg))
+    for p in xrange(0, len(val4reg), npix):
+        (a[p:p+npix], b, sa[p:p+npix], sb) = linearfit(x=frequencies, y=val4reg[p:p+npix], yerr=yerr, tolog=True)
+    spidx_data[good] = a
+    spidx_err_data[good] = sa
+    return spidx_data, spidx_err_data
+
+if args.ncpu > 1:
+    def fit_tile(i0, i1, outQueue=None):
+        np.random.seed() # forked processes would share the random state
+        outQueue.put([i0, i1] + list(fit_pixels(cube[:,i0:i1])))
+
+    spidx_data = np.empty(shape=cube.shape[1:])
+    spidx_err_data = np.empty(shape=cube.shape[1:])
+    # a few tiles of rows per process to balance the load
+    tiles = np.unique(np.linspace(0, cube.shape[1], 4*args.ncpu+1).astype(int))
+    mpm = multiprocManager(args.ncpu, fit_tile)
+    for i0, i1 in zip(tiles[:-1], tiles[1:]):
+        mpm.put([i0, i1])
+    mpm.wait()
+    for i0, i1, tile, tile_err in mpm.get():
+        spidx_data[i0:i1] = tile
+        spidx_err_data[i0:i1] = tile_err
+else:
+    spidx_data, spidx_err_data = fit_pixels(cube)
 
 spidx = pyfits.PrimaryHDU(spidx_data, regrid_hdr)
 spidx_err = pyfits.PrimaryHDU(spidx_err_data, regrid_hdr)